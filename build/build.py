@@ -2,53 +2,72 @@ import re
 import yaml
 import os
 
+def normalize_image_name(image):
+    # FROM lines may leave out the tag, build configs always have one
+    if "@" in image or ":" in image.rsplit("/", 1)[-1]:
+        return image
+    return image + ":latest"
+
+def parse_app_config(app_config_file):
+    with open(app_config_file) as f:
+        raw_jinja = f.read()
+        app_config_yaml = re.sub(r".*\{[{%].*\n", "", raw_jinja)
+        app_config = yaml.safe_load(app_config_yaml)
+
+    if os.path.basename(os.path.dirname(app_config_file)) == "configs":
+        build_dir = os.path.abspath(os.path.join(os.path.dirname(app_config_file), os.pardir))
+    else:
+        build_dir = os.path.dirname(app_config_file)
+
+    if app_config.get("build") and app_config["build"].get("dockerfile"):
+        dockerfile = os.path.join(build_dir, app_config["build"].get("dockerfile"))
+    else:
+        dockerfile = os.path.join(build_dir, "Dockerfile")
+
+    depends_on = []
+    if os.path.exists(dockerfile):
+        stages = set()
+        with open(dockerfile) as f:
+            for line in f:
+                line = line.strip()
+                if line.upper().startswith("FROM "):
+                    # Get the dependent image inside of the Dockerfile, skipping flags and earlier build stages
+                    words = [word for word in line.split()[1:] if not word.startswith("--")]
+                    if len(words) >= 3 and words[1].upper() == "AS":
+                        stages.add(words[2])
+                    if words and words[0] not in stages:
+                        dependency = normalize_image_name(words[0])
+                        if dependency not in depends_on:
+                            depends_on.append(dependency)
+
+    return {
+        "raw_jinja" : raw_jinja,
+        "app_config" : app_config,
+        "build_dir" : os.path.expanduser(build_dir),
+        "dockerfile" : dockerfile,
+        "depends_on" : depends_on,
+    }
+
 class Build:
-    def __init__(self, app_config_file, args, base_config, client):
+    def __init__(self, app_config_file, args, base_config, client, parsed=None):
 
         self.app_config_file = app_config_file
         self.args = args
         self.base_config = base_config
         self.client = client
 
-        with open(app_config_file) as f:
-            self.raw_jinja = f.read()
-            app_config_yaml = re.sub(r".*\{[{%].*\n", "", self.raw_jinja)
-            self.app_config = yaml.safe_load(app_config_yaml)
+        # buildimage.py passes what the discovery index already has
+        if parsed is None:
+            parsed = parse_app_config(app_config_file)
 
-        self.app_config = self.app_config
+        self.raw_jinja = parsed["raw_jinja"]
+        self.app_config = parsed["app_config"]
         self.automatic = self.app_config.get("build", {}).get("automatic", False)
         self.image = self.app_config.get("build", {}).get("image", None)
         self.tag = self.app_config.get("build", {}).get("tag", None)
 
         self.full_image_name = format("%s:%s" % ( self.image, self.tag))
 
-        if os.path.basename(os.path.dirname(self.app_config_file)) == "configs":
-            build_dir = os.path.abspath(os.path.join(os.path.dirname(self.app_config_file), os.pardir))
-        else:
-            build_dir = os.path.dirname(self.app_config_file)
-
-        dockerfile = self.app_config.get("build", {}).get("dockerfile", None)
-
-        if self.app_config.get("build"):
-            if self.app_config["build"].get("dockerfile"):
-                dockerfile = os.path.join(build_dir, self.app_config["build"].get("dockerfile"))
-            else:
-                dockerfile = os.path.join(build_dir, "Dockerfile")
-        else:
-            dockerfile = os.path.join(build_dir, "Dockerfile")
-
-        self.build_dir = os.path.expanduser(build_dir)
-        self.depends_on = []
-        self.dockerfile = dockerfile
-
-        if os.path.exists(dockerfile):
-            with open(dockerfile) as dockerfile:
-                for line in dockerfile:
-                    line = line.strip()
-                    if line.startswith("FROM"):
-                        # Get the dependent image inside of the Dockerfile
-                        self.depends_on.append(line.split()[1])
-        else:
-            pass
-            # print("No Dockerfile associated with build %s:%s found, skipping." % (image, tag))
-
+        self.build_dir = parsed["build_dir"]
+        self.depends_on = list(parsed["depends_on"])
+        self.dockerfile = parsed["dockerfile"]
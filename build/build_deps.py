@@ -1,12 +1,21 @@
 import os
 import re
+import hashlib
+import functools
+import threading
 import subprocess
 import git
 import requests
-from distutils.version import LooseVersion
+from build import download
+from build.git_tags import get_tag_index
+from build.scripts import ScriptRunner
+from util.output import inherit_output
+from util.cache import DiskCache
+from concurrent.futures import ThreadPoolExecutor
 
 ## Driver resolution functions
 
+@functools.lru_cache(maxsize=None)
 def get_video_card():
     output = subprocess.check_output(["lspci", "-v"]).decode('utf-8')
     manufacturer = re.search(r".*VGA compatible.*: ([A-Za-z]+)|.*3D Controller.*", output)
@@ -17,6 +26,7 @@ def get_video_card():
         return None
 
 def pull_video_driver(driver_cache_path, docker_build_path):
+    result = None
     if get_video_card() == 'nvidia':
         from build import nvidia_driver
         result = nvidia_driver.pull(driver_cache_path, docker_build_path)
@@ -24,166 +34,247 @@ def pull_video_driver(driver_cache_path, docker_build_path):
 
 ## Dependency resolution functions
 
-def resolve_git_dependencies(dependencies):
-    for dependency in dependencies:
-        local_path = dependency.get("local_path")
-        remote_url = dependency.get("remote_url")
-        shallow = dependency.get("shallow", False)
-        branch = dependency.get("branch")
-        get_latest_tag_by_date = dependency.get("get_latest_tag_by_date", False)
-        get_latest_tag_by_symver = dependency.get("get_latest_tag_by_symver", False)
-        tag_regex = dependency.get("tag_regex", False)
-
-        # Create the local directory if it doesn't exist
-        if not os.path.exists(local_path):
-            try:
-                os.makedirs(local_path)
-            except OSError:
-                print(f"Unable to create directory {local_path}")
-                return False
-
-        if not os.path.exists(os.path.join(local_path, ".git")):
-            # Clone the repository if it doesn't exist
-            try:
-                print(f"Cloning repository: {remote_url}")
-                if shallow:
-                    repo = git.Repo.clone_from(remote_url, local_path, depth=1)
-                else:
-                    repo = git.Repo.clone_from(remote_url, local_path)
-            except git.exc.GitCommandError as e:
-                print(f"Unable to clone repository: {e}")
-                return False
-        else:
-            repo = git.Repo(local_path)
-            # Pull the latest changes if the repository already exists
-            try:
-                print(f"Pulling existing branch: {remote_url}")
-                repo.remotes.origin.fetch(tags=True)
-                default_branch = repo.remotes.origin.refs.HEAD.ref.remote_head
-                repo.git.checkout(default_branch)
-                repo.remotes.origin.pull()
-            except git.exc.GitCommandError as e:
-                print(f"Unable to pull latest commit: {e}")
-                return False
-
-        # Update submodules
-        for submodule in repo.submodules:
-            try:
-                submodule.update(init=True, recursive=True)
-            except git.exc.GitCommandError as e:
-                print(f"Unable to update submodule {submodule.name}: {e}")
-                return False
-
-        # Check out the specified branch if it exists
-        if branch:
-            try:
-                repo.git.checkout(branch)
-            except git.exc.GitCommandError:
-                print(f"Unable to check out branch {branch}, please specify a correct branch in the dependency config.")
-                return False
-
-        elif (get_latest_tag_by_date and tag_regex) or get_latest_tag_by_symver:
-            tags = repo.tags
-            try:
-                if get_latest_tag_by_date:
-                    # Filter tags by regex
-                    filtered_tags = [tag for tag in tags if re.match(tag_regex, tag.name)]
-                    # Get the latest tag by commit datetime
-                    latest_tag = max(filtered_tags, key=lambda x: x.commit.committed_datetime)
-                elif get_latest_tag_by_symver:
-                    symver_regex = r'^\d+(\.\d+)*$'
-                    filtered_tags = [tag for tag in tags if re.match(symver_regex, tag.name)]
-                    sorted_tags = sorted(filtered_tags, key=lambda x: LooseVersion(x.name))
-                    latest_tag = sorted_tags[-1]
-                repo.git.checkout(latest_tag.name)
-            except ValueError:
-                print("Could not determine latest tag from repository based on regex, please check your syntax.")
-                return False
-                # Check out the latest tag if specified
-
-    print("Git dependency resolution complete.")
-    return True
+# Every remote is kept as a bare mirror in the cache, fetched at most once per run
+# no matter how many builds depend on it. Checkouts borrow objects from the
+# mirror (--reference --dissociate, so they never depend on the mirror's object
+# store or its host path) and are updated from it rather than from the network.
+GIT_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".py-docker-x11", "cache", "git")
 
-def resolve_script_dependencies(scripts, build_dir):
+_mirror_locks = {}
+_mirror_locks_lock = threading.Lock()
+_mirrors_fetched = set()
 
-    # Ensure we're in the build directory so relative scripts work
-    # Probably need some additional checking to ensure we're not somewhere we shouldn't be
-    if os.getcwd() != build_dir:
-        os.chdir(build_dir)
+def _mirror_lock(remote_url):
+    with _mirror_locks_lock:
+        return _mirror_locks.setdefault(remote_url, threading.Lock())
 
-    for script in scripts:
-        script_path = os.path.join(os.getcwd(), "scripts", script.get("script"))
-        args = script.get("args", [])
+def update_git_mirror(remote_url, cache_dir=GIT_CACHE_DIR):
+    name = re.sub(r"(\.git)?/*$", "", remote_url).rsplit("/", 1)[-1]
+    mirror_path = os.path.join(cache_dir, hashlib.sha256(remote_url.encode('utf-8')).hexdigest()[:16] + "-" + name + ".git")
 
-        if not os.path.exists(script_path):
-            print("Script not found in scripts in app_config scripts entry. Skipping.")
-            continue
+    with _mirror_lock(remote_url):
+        if remote_url in _mirrors_fetched:
+            return mirror_path
 
-        command = [script_path] + args
-        print("Executing %s" % command)
-        result = subprocess.Popen(command, cwd=os.getcwd(), env={})
-        if result.wait() != 0:
-            print("Error encountered while running %s" % command)
+        if not os.path.exists(mirror_path):
+            print(f"Creating mirror of {remote_url}")
+            os.makedirs(cache_dir, exist_ok=True)
+            git.Repo.clone_from(remote_url, mirror_path, mirror=True)
+        else:
+            print(f"Fetching mirror of {remote_url}")
+            git.Repo(mirror_path).git.remote("update", "--prune")
+
+        _mirrors_fetched.add(remote_url)
+    return mirror_path
+
+def resolve_git_dependency(dependency, build_dir=None, cache_dir=GIT_CACHE_DIR):
+    local_path = dependency.get("local_path")
+    remote_url = dependency.get("remote_url")
+    shallow = dependency.get("shallow", False)
+    branch = dependency.get("branch")
+    get_latest_tag_by_date = dependency.get("get_latest_tag_by_date", False)
+    get_latest_tag_by_symver = dependency.get("get_latest_tag_by_symver", False)
+    tag_regex = dependency.get("tag_regex", False)
+
+    if build_dir is not None:
+        local_path = os.path.join(build_dir, local_path)
+
+    try:
+        mirror_path = update_git_mirror(remote_url, cache_dir)
+    except git.exc.GitCommandError as e:
+        print(f"Unable to update mirror of {remote_url}: {e}")
+        return False
+
+    # Create the local directory if it doesn't exist
+    if not os.path.exists(local_path):
+        try:
+            os.makedirs(local_path)
+        except OSError:
+            print(f"Unable to create directory {local_path}")
+            return False
+
+    if not os.path.exists(os.path.join(local_path, ".git")):
+        # Clone the repository if it doesn't exist
+        try:
+            print(f"Cloning repository: {remote_url}")
+            if shallow:
+                repo = git.Repo.clone_from(remote_url, local_path, reference=mirror_path, dissociate=True, depth=1)
+            else:
+                repo = git.Repo.clone_from(remote_url, local_path, reference=mirror_path, dissociate=True)
+        except git.exc.GitCommandError as e:
+            print(f"Unable to clone repository: {e}")
+            return False
+    else:
+        repo = git.Repo(local_path)
+        # Bring the existing checkout up to date from the mirror
+        try:
+            # Checkouts cloned before --dissociate still borrow the mirror's objects
+            alternates = os.path.join(repo.git_dir, "objects", "info", "alternates")
+            if os.path.exists(alternates):
+                repo.git.repack("-a", "-d")
+                os.unlink(alternates)
+            print(f"Updating existing branch from mirror: {remote_url}")
+            repo.git.fetch(mirror_path, "--tags", "--prune", "+refs/heads/*:refs/remotes/origin/*")
+            default_branch = git.Repo(mirror_path).head.reference.name
+            repo.git.checkout(default_branch)
+            repo.git.merge("--ff-only", "origin/" + default_branch)
+        except git.exc.GitCommandError as e:
+            print(f"Unable to pull latest commit: {e}")
+            return False
+
+    # Update submodules
+    for submodule in repo.submodules:
+        try:
+            submodule.update(init=True, recursive=True)
+        except git.exc.GitCommandError as e:
+            print(f"Unable to update submodule {submodule.name}: {e}")
+            return False
+
+    # Check out the specified branch if it exists
+    if branch:
+        try:
+            repo.git.checkout(branch)
+        except git.exc.GitCommandError:
+            print(f"Unable to check out branch {branch}, please specify a correct branch in the dependency config.")
+            return False
+
+    elif (get_latest_tag_by_date and tag_regex) or get_latest_tag_by_symver:
+        tag_index = get_tag_index(repo)
+        if get_latest_tag_by_date:
+            # Latest tag matching the regex by commit datetime
+            latest_tag = tag_index.latest_by_date(tag_regex)
+        else:
+            latest_tag = tag_index.latest_by_symver()
 
+        if latest_tag is None:
+            print("Could not determine latest tag from repository based on regex, please check your syntax.")
+            return False
 
-def resolve_github_release_dependencies(releases, build_dir):
-    if os.getcwd() != build_dir:
-        os.chdir(build_dir)
+        # Check out the latest tag if specified
+        try:
+            repo.git.checkout(latest_tag)
+        except git.exc.GitCommandError as e:
+            print(f"Unable to check out tag {latest_tag}: {e}")
+            return False
 
-    for release in releases:
-        destination = release.get("destination", "./cache")
+    return True
 
-        if not os.path.exists(os.path.join(os.getcwd(), destination)):
-            os.makedirs(os.path.join(os.getcwd(), destination))
+def resolve_git_dependencies(dependencies, build_dir=None, jobs=4, cache_dir=GIT_CACHE_DIR):
+    # Repositories are independent of each other, so resolve them on a bounded pool
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+        results = list(executor.map(inherit_output(lambda dependency: resolve_git_dependency(dependency, build_dir, cache_dir)), dependencies))
 
-        if release.get("release") == "latest":
-            response = requests.get(f'https://api.github.com/repos/{release["repo"]}/releases/{release["release"]}')
-        else:
-            response = requests.get(f'https://api.github.com/repos/{release["repo"]}/releases/tags/{release["release"]}')
+    if not all(results):
+        print("Git dependency resolution failed.")
+        return False
 
-        if response.status_code != 200:
-            print(f'URL: https://api.github.com/repos/{release["repo"]}/releases/{release["release"]}')
-            raise Exception(f'Error {response.status_code} while fetching release {release["release"]} from {release["repo"]}')
+    print("Git dependency resolution complete.")
+    return True
 
-        assets = response.json().get("assets", [])
+def resolve_script_dependencies(scripts, build_dir, log_dir=None, jobs=4, force=False):
+    runner = ScriptRunner(scripts, build_dir, log_dir=log_dir, jobs=jobs, force=force)
+    if not runner.run():
+        print("Script dependency resolution failed.")
+        return False
+    return True
 
-        for remote_file in release.get("files"):
-            file_match = None
-            
-            if remote_file.get("match"):
-                for asset in assets:
-                    file_match = re.match(remote_file.get("match"), asset["name"])
+# Release metadata is cached with its ETag, a 304 answer to a conditional request
+# costs nothing against the API rate limit and skips the JSON transfer.
+GITHUB_API = "https://api.github.com"
+_release_cache = DiskCache("github_releases")
 
-                    if file_match is not None:
-                        file_match = file_match[0]
-                        break
+def _github_headers():
+    headers = { "Accept" : "application/vnd.github+json" }
+    if os.environ.get("GITHUB_TOKEN"):
+        headers["Authorization"] = "Bearer " + os.environ["GITHUB_TOKEN"]
+    return headers
 
-            elif remote_file.get("name"):
-                for asset in assets:
+def get_github_release(repo, release):
+    if release == "latest":
+        url = f'{GITHUB_API}/repos/{repo}/releases/latest'
+    else:
+        url = f'{GITHUB_API}/repos/{repo}/releases/tags/{release}'
+
+    headers = _github_headers()
+    cached = _release_cache.get(url)
+    if cached is not None:
+        headers["If-None-Match"] = cached["etag"]
+
+    response = download.get_session().get(url, headers=headers, timeout=download.TIMEOUT)
+    if response.status_code == 304 and cached is not None:
+        return cached["release"]
+
+    if response.status_code != 200:
+        print(f'URL: {url}')
+        raise Exception(f'Error {response.status_code} while fetching release {release} from {repo}')
+
+    data = response.json()
+    if response.headers.get("ETag"):
+        _release_cache.set(url, { "etag" : response.headers["ETag"], "release" : data })
+    return data
+
+def _find_asset(remote_file, assets):
+    # Returns the asset and the file name it's stored under
+    for asset in assets:
+        if remote_file.get("match"):
+            file_match = re.match(remote_file["match"], asset["name"])
+            if file_match is not None:
+                return asset, file_match[0]
+        elif remote_file.get("name") == asset["name"]:
+            return asset, asset["name"]
+    return None, None
+
+def _asset_sha256(asset):
+    # GitHub publishes "sha256:<hex>" digests for newer assets
+    digest = asset.get("digest") or ""
+    if digest.startswith("sha256:"):
+        return digest[len("sha256:"):]
+    return None
+
+def _download_asset(asset, file_path):
+    try:
+        if download.download(asset["browser_download_url"], file_path, size=asset.get("size"), sha256=_asset_sha256(asset)):
+            print(f'Downloaded {asset["name"]} ({asset.get("size", 0) / 1048576:.1f} MB)')
+        else:
+            print(f'{asset["name"]} exists, not re-downloading.')
+        return True
+    except (download.DownloadError, requests.RequestException) as e:
+        print(f'Error while fetching file {file_path}: {e}')
+        return False
 
-                    if remote_file.get("name") == asset["name"]:
-                        file_match = remote_file.get("name")
-                        break
+def resolve_github_release_dependencies(releases, build_dir, jobs=4):
+    downloads = []
+    symlinks = []
 
-            if file_match:
-                file_path = os.path.join(os.getcwd(), destination, file_match)
-                if not os.path.exists(file_path):
+    for release in releases:
+        destination = os.path.join(build_dir, release.get("destination", "./cache"))
+        os.makedirs(destination, exist_ok=True)
 
-                    response = requests.get(asset["browser_download_url"])
-                    if response.status_code != 200:
-                        raise Exception(f'Error {response.status_code} while fetching file {file_path}')
-                else:
-                    print("File exists, not re-downloading.")
+        assets = get_github_release(release["repo"], release["release"]).get("assets", [])
 
-            with open(file_path, "wb") as f:
-                f.write(response.content)
+        for remote_file in release.get("files"):
+            asset, file_name = _find_asset(remote_file, assets)
+            if asset is None:
+                print(f'No asset matching {remote_file} in release {release["release"]} of {release["repo"]}')
+                continue
 
+            downloads.append((asset, os.path.join(destination, file_name)))
             if remote_file.get("symlink"):
-                symlink_path = os.path.join(os.getcwd(), destination, remote_file["symlink"])
-                try:
-                    os.unlink(symlink_path)
-                except OSError:
-                    pass
-                os.symlink(file_match, symlink_path)
+                symlinks.append((file_name, os.path.join(destination, remote_file["symlink"])))
+
+    # Assets are independent of each other, fetch them on a bounded pool
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+        results = list(executor.map(inherit_output(lambda item: _download_asset(*item)), downloads))
 
+    if not all(results):
+        print("GitHub release dependency resolution failed.")
+        return False
 
+    for file_name, symlink_path in symlinks:
+        try:
+            os.unlink(symlink_path)
+        except OSError:
+            pass
+        os.symlink(file_name, symlink_path)
+
+    return True
@@ -4,6 +4,11 @@ import os
 import docker
 from io import BytesIO
 from .build_deps import *
+from .fingerprint import Fingerprint, FINGERPRINT_LABEL
+from .context import BuildContext
+from util.output import inherit_output
+from . import events
+from concurrent.futures import ThreadPoolExecutor
 
 class Builder:
     def __init__(self, args, base_config, build, client):
@@ -16,6 +21,14 @@ class Builder:
         self.tag = build.tag
         self.app_config = build.app_config
         self.raw_jinja = build.raw_jinja
+        self.depends_on = build.depends_on
+        self.metrics = None
+
+        # Filled in while building, buildimage.py keeps them in the build history
+        self.phases = {}
+        self.fingerprint = None
+        self.context_bytes = None
+        self.outcome = None
 
         # self.update = args.update or args.auto
         self.update = args.update
@@ -24,10 +37,8 @@ class Builder:
         self.nocache = args.full or args.nocache or args.auto
 
         self.always_full_update = self.app_config.get("always_full_update", False)
-
-        # Check if the image exists locally or remotely
-        self.image_exists_locally = client.images(name=self.image + ":" + self.tag)
-        self.image_exists_remotely = False
+        # Set by _get_dockerfile when the build layers updates over the current image
+        self.updating = False
 
     def run_build(self):
 
@@ -35,49 +46,128 @@ class Builder:
         image_exists_locally = self.client.images(name=self.image + ":" + self.tag)
         image_exists_remotely = False
 
-        if image_exists_locally and not self.args.force:
-            image_creation_time = image_exists_locally[0]["Created"]
-            # Don't unnecessarily update too quickly
-            if int(time.time()) - image_creation_time < 85900 and self.args.auto:
-                print("Skipping image build as it's too new.")
-                return 0
-
         # Resolve dependencies for the build
-        self._resolve_dependencies()
+        started = time.monotonic()
+        resolved = self._resolve_dependencies()
+        self.phases["dependencies"] = time.monotonic() - started
+        if not resolved:
+            print("[ERROR] Dependency resolution failed for %s:%s" % (self.image, self.tag))
+            exit(1)
 
         if not image_exists_locally and self.app_config["build"].get("remote"):
             print("[WARN] Could not find image locally, attempting pull...")
             try:
-                image_exists_remotely = client.pull(image, tag=tag)
+                image_exists_remotely = self.client.pull(self.image, tag=self.tag)
+                image_exists_locally = self.client.images(name=self.image + ":" + self.tag)
             except:
                 print("[WARN] Could not find image remotely.")
 
         dockerfile, inline_dockerfile = self._get_dockerfile(image_exists_locally, image_exists_remotely)
-        build_result = self._build_image(dockerfile, inline_dockerfile)
+
+        # An update's inputs never change, the image it starts from does. Keying on
+        # it means the next --update builds again instead of being skipped.
+        update_base = image_exists_locally[0]["Id"] if self.updating and image_exists_locally else None
+        fingerprint = self._fingerprint(dockerfile, inline_dockerfile, update_base)
+        self.fingerprint = fingerprint
+        # --pull/--full/--nocache ask for the build regardless: a newer upstream base
+        # image is only pulled by docker during the build, after the fingerprint
+        # has been taken from whatever parent is present locally.
+        if image_exists_locally and not (self.args.force or self.pull or self.nocache):
+            current_fingerprint = (image_exists_locally[0].get("Labels") or {}).get(FINGERPRINT_LABEL)
+            if current_fingerprint == fingerprint:
+                print("Skipping image build as none of its inputs changed (fingerprint %s)." % fingerprint[:12])
+                self.outcome = "unchanged"
+                return 0
+
+        build_result = self._build_image(dockerfile, inline_dockerfile, fingerprint)
+        self.outcome = "built"
+
+    def _fingerprint(self, dockerfile, inline_dockerfile, update_base=None):
+        fingerprint = Fingerprint(self.client, self.build_dir)
+
+        if update_base is not None:
+            fingerprint.add("update_base", update_base)
+
+        if inline_dockerfile:
+            # Sent on its own, nothing else from the build directory goes into the build
+            fingerprint.add("dockerfile", inline_dockerfile.getvalue())
+        else:
+            fingerprint.add_file("dockerfile", os.path.join(self.build_dir, dockerfile or "Dockerfile"))
+            fingerprint.add_context(dockerfile)
+        fingerprint.add("app_config", self.raw_jinja)
+
+        dependencies = self.app_config["build"].get("dependencies") or {}
+        for repository in (dependencies.get("git") or {}).get("repositories", []):
+            local_path = os.path.join(self.build_dir, repository["local_path"])
+            fingerprint.add_git_head("git:" + repository["local_path"], local_path)
+
+        for release in dependencies.get("github_releases") or []:
+            destination = os.path.join(self.build_dir, release.get("destination", "./cache"))
+            fingerprint.add_directory("release:" + release["repo"], destination)
+
+        for parent in self.depends_on:
+            fingerprint.add_parent_image(parent)
+
+        fingerprint.save()
+        print("Build fingerprint is %s" % fingerprint.hexdigest())
+        return fingerprint.hexdigest()
+
+    def _dependency_step(self, step):
+        name, function = step
+        started = time.monotonic()
+        try:
+            ok = function() is not False
+        except Exception as e:
+            print("[ERROR] Resolving %s dependencies failed: %s" % (name, e))
+            ok = False
+        except SystemExit as e:
+            # Some resolvers (the GPU driver pull among them) bail out with sys.exit()
+            print("[ERROR] Resolving %s dependencies failed (exit status %s)" % (name, e.code))
+            ok = False
+        return name, ok, time.monotonic() - started
 
     def _resolve_dependencies(self):
-        # If the image requires a video driver, pull it in
+        dependencies = self.app_config["build"].get("dependencies") or {}
+        build_config = self.base_config["build"]
+
+        # The driver, git fetches and release downloads don't depend on each other
+        fetch_steps = []
         if self.app_config["build"].get("install_gpu_driver"):
-            drivers_updated = self._update_drivers()
-    
-        # If the app requires external code dependencies, resolve them
-        if self.app_config["build"].get("dependencies", False):
-            if self.app_config["build"]["dependencies"].get("git", False):
-                git_dependencies = self.app_config["build"]["dependencies"]["git"]["repositories"]
-                resolve_git_dependencies(git_dependencies)
-            elif self.app_config["build"]["dependencies"].get("scripts", False):
-                script_dependencies = self.app_config["build"]["dependencies"]["scripts"]
-                resolve_script_dependencies(script_dependencies, self.build_dir)
-            elif self.app_config["build"]["dependencies"].get("github_releases", False):
-                github_release_dependencies = self.app_config["build"]["dependencies"]["github_releases"]
-                resolve_github_release_dependencies(github_release_dependencies, self.build_dir)
-    
+            fetch_steps.append(("gpu_driver", self._update_drivers))
+        if dependencies.get("git"):
+            fetch_steps.append(("git", lambda: resolve_git_dependencies(dependencies["git"]["repositories"], self.build_dir, jobs=build_config.get("git_jobs", 4))))
+        if dependencies.get("github_releases"):
+            fetch_steps.append(("github_releases", lambda: resolve_github_release_dependencies(dependencies["github_releases"], self.build_dir, jobs=build_config.get("download_jobs", 4))))
+
+        summary = []
+        if fetch_steps:
+            with ThreadPoolExecutor(max_workers=len(fetch_steps)) as executor:
+                summary = list(executor.map(inherit_output(self._dependency_step), fetch_steps))
+
+        # Scripts may work on anything fetched above, so they run last
+        if dependencies.get("scripts"):
+            if all(ok for _, ok, _ in summary):
+                log_dir = os.path.join(os.path.expanduser(build_config.get("log_dir", "~/.py-docker-x11/logs/build")), "scripts", self.image.replace("/", "_"))
+                summary.append(self._dependency_step(("scripts", lambda: resolve_script_dependencies(dependencies["scripts"], self.build_dir, log_dir=log_dir, force=self.args.force))))
+            else:
+                summary.append(("scripts", None, 0))
+
+        if not summary:
+            return True
+
+        print("Dependencies of %s:%s:" % (self.image, self.tag))
+        for name, ok, duration in summary:
+            status = "skipped" if ok is None else "ok" if ok else "failed"
+            print("  %-16s %-8s %6.1fs" % (name, status, duration))
+        return all(ok for _, ok, _ in summary)
+
     def _get_dockerfile(self, image_exists_locally, image_exists_remotely):
     
         dockerfile = self.app_config["build"].get("dockerfile")
         inline_dockerfile = None
 
         if self.update and (image_exists_locally or image_exists_remotely) and not self.always_full_update and not self.app_config["build"].get("install_gpu_driver"):
+            self.updating = True
             if self.app_config["build"].get("dockerfile_update_file"):
                 dockerfile = self.app_config["build"]["dockerfile_update_file"]
             elif self.app_config["build"].get("dockerfile_update") and isinstance(self.app_config["build"].get("dockerfile_update"), list):
@@ -89,30 +179,48 @@ class Builder:
                     elif re.match("FROM", dockerfile_update[line]):
                         from_found = True
                 if not from_found:
-                    dockerfile_update = [f"FROM {image}:{tag}\n"] + dockerfile_update
+                    dockerfile_update = [f"FROM {self.image}:{self.tag}\n"] + dockerfile_update
                 inline_dockerfile = BytesIO(bytes("\n".join(dockerfile_update), "utf-8"))
-            elif os.path.exists("Dockerfile-update"):
+            elif os.path.exists(os.path.join(self.build_dir, "Dockerfile-update")):
                 dockerfile = "Dockerfile-update"
+            else:
+                # Nothing to layer on top, this is a regular build of the Dockerfile
+                self.updating = False
     
         return dockerfile, inline_dockerfile
     
-    def _build_image(self, dockerfile, inline_dockerfile):
+    def _build_image(self, dockerfile, inline_dockerfile, fingerprint):
+        labels = { "pdx-app-config": self.raw_jinja, FINGERPRINT_LABEL: fingerprint }
+
+        context = BuildContext(self.build_dir, dockerfile, inline_dockerfile)
+
         # Build the image
+        started = time.monotonic()
         try:
-            if inline_dockerfile:
-                result = self.client.build(path=self.build_dir, labels={"pdx-app-config": self.raw_jinja},
-                        fileobj=inline_dockerfile, tag=self.image + ":" + self.tag, pull=self.pull, 
-                        nocache=self.nocache, decode=True)
-            else:
-                result = self.client.build(path=self.build_dir, labels={"pdx-app-config": self.raw_jinja},
-                        dockerfile=dockerfile, tag=self.image + ":" + self.tag, pull=self.pull, 
+            pipeline = events.EventPipeline(self._event_sinks(), wrap=inherit_output)
+            try:
+                result = self.client.build(fileobj=context.stream(), custom_context=True, labels=labels,
+                        dockerfile=context.dockerfile, tag=self.image + ":" + self.tag, pull=self.pull,
                         nocache=self.nocache, decode=True)
-    
-            for log in result:
-                print(log.get('stream'))
+
+                for log in result:
+                    for event in events.parse(log):
+                        pipeline.put(event)
+                        if isinstance(event, events.ErrorEvent):
+                            result.close()
+                            raise events.BuildFailed(event.message)
+            finally:
+                pipeline.close()
+                elapsed = time.monotonic() - started
+                self.phases["context_upload"] = context.elapsed
+                self.phases["docker_build"] = elapsed - (context.elapsed or 0)
+                self.context_bytes = context.bytes_sent
 
             return True
 
+        except events.BuildFailed as e:
+            print("[ERROR] Docker build of %s:%s failed: %s" % (self.image, self.tag, e))
+            exit(1)
         except docker.errors.BuildError as e:
             print("[ERROR] Docker build failed:")
             print(e)
@@ -123,6 +231,12 @@ class Builder:
             exit(1)
 
     
+    def _event_sinks(self):
+        log_dir = os.path.expanduser(self.base_config["build"].get("log_dir", "~/.py-docker-x11/logs/build"))
+        os.makedirs(log_dir, exist_ok=True)
+        self.metrics = events.MetricsSink()
+        return [events.ConsoleSink(), events.JsonLinesSink(os.path.join(log_dir, self.image.replace("/", "_") + "-" + self.tag + ".events.jsonl")), self.metrics]
+
     def _update_drivers(self):
     
         driver_cache_path = os.path.expanduser(self.base_config["appDirs"].get("driver_cache"))
@@ -130,21 +244,16 @@ class Builder:
         result = pull_video_driver(driver_cache_path, docker_build_path)
         return result
     
-    def _push_image(self):
-        # Save the build configs to variables
-        base_build_config = base_config.get("build")
-        app_build_config = app_config.get("build")
-    
+    def push_image(self, push_stage, on_done=None):
+        base_build_config = self.base_config.get("build")
+        app_build_config = self.app_config.get("build")
+
         # Check if the image should be pushed
-        if push == True or base_build_config.get("always_push") == True or app_build_config.get("always_push") == True:
-            print("Pushing image to %s:%s" % (app_build_config["image"], app_build_config["tag"]) )
-    
-            # Push the image and raise any exceptions that occur
-            result = client.push(repository=app_build_config["image"], tag=app_build_config["tag"], decode=True, raise_for_status=True)
-    
-            print("Build successfully pushed.")
+        if self.args.push or base_build_config.get("always_push") == True or app_build_config.get("always_push") == True:
+            # Runs in the background, the next builds don't wait for it
+            push_stage.submit(self.image + ":" + self.tag, parents=self.depends_on, on_done=on_done)
             return True
-    
+
         return False
 
 def main():
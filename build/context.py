@@ -0,0 +1,251 @@
+import os
+import re
+import stat
+import time
+import tarfile
+import hashlib
+from util.cache import DiskCache
+
+# Streams the build context to the daemon as a tar generator instead of letting
+# docker-py tar the whole build directory into memory first. .dockerignore is
+# compiled into regular expressions once, excluded directories are pruned while
+# walking, and tar headers are cached per file keyed by inode/mtime.
+
+CHUNK_SIZE = 1024 * 1024
+BLOCK_SIZE = tarfile.BLOCKSIZE
+
+def _glob(pattern):
+    # Docker's filepath.Match rules, plus "**" for any number of directories
+    regex = ""
+    index = 0
+    while index < len(pattern):
+        char = pattern[index]
+        if pattern.startswith("**", index):
+            regex += ".*"
+            index += 2
+            if pattern.startswith("/", index):
+                regex = regex[:-2] + "(.*/)?"
+                index += 1
+            continue
+        elif char == "*":
+            regex += "[^/]*"
+        elif char == "?":
+            regex += "[^/]"
+        elif char == "[":
+            end = pattern.find("]", index + 1)
+            if end == -1:
+                regex += re.escape(char)
+            else:
+                body = pattern[index + 1:end]
+                if body.startswith("^") or body.startswith("!"):
+                    body = "^" + body[1:]
+                regex += "[" + body.replace("\\", "\\\\") + "]"
+                index = end
+        elif char == "\\" and index + 1 < len(pattern):
+            index += 1
+            regex += re.escape(pattern[index])
+        else:
+            regex += re.escape(char)
+        index += 1
+    return regex
+
+def _translate(pattern):
+    # A pattern matching a directory excludes everything below it as well
+    return "^" + _glob(pattern) + "(/.*)?$"
+
+class DockerIgnore:
+    def __init__(self, patterns, dockerfile=None):
+        self.rules = []
+        for pattern in patterns:
+            negate = pattern.startswith("!")
+            pattern = os.path.normpath(pattern[1:] if negate else pattern).lstrip("/")
+            if pattern == ".":
+                continue
+            self.rules.append((negate, pattern))
+
+        # The daemon always needs the Dockerfile, same as docker-py does it. Kept
+        # out of the rules, it's one path and shouldn't stop everything else from
+        # being pruned.
+        self.dockerfile = os.path.normpath(dockerfile) if dockerfile else None
+
+        self.has_negations = any(negate for negate, _ in self.rules)
+        if self.has_negations:
+            self.compiled = [(negate, re.compile(_translate(pattern))) for negate, pattern in self.rules]
+            # Per path component, to tell which directories a "!" rule could reach into
+            self.negations = [[None if "**" in part else re.compile("^" + _glob(part) + "$") for part in pattern.split("/")]
+                              for negate, pattern in self.rules if negate]
+        elif self.rules:
+            # Without exceptions any match excludes, so one alternation does the job
+            self.combined = re.compile("|".join("(?:%s)" % _translate(pattern) for _, pattern in self.rules))
+        else:
+            self.combined = None
+
+    def excluded(self, path):
+        if path == self.dockerfile:
+            return False
+        if not self.has_negations:
+            return self.combined is not None and self.combined.match(path) is not None
+        for negate, regex in reversed(self.compiled):
+            if regex.match(path):
+                return not negate
+        return False
+
+    def _reincludes_below(self, path):
+        # Could any "!" rule match path or something below it
+        parts = path.split("/")
+        for negation in self.negations:
+            for index, part in enumerate(parts):
+                if index >= len(negation) or negation[index] is None:
+                    # Matches an ancestor (so everything below), or "**" can reach anywhere
+                    return True
+                if not negation[index].match(part):
+                    break
+            else:
+                return True
+        return False
+
+    def can_prune(self, path):
+        # Safe to skip a whole directory only if nothing below it can come back
+        if self.dockerfile is not None and self.dockerfile.startswith(path + "/"):
+            return False
+        if not self.excluded(path):
+            return False
+        return not self.has_negations or not self._reincludes_below(path)
+
+def read_dockerignore(build_dir):
+    dockerignore = os.path.join(build_dir, ".dockerignore")
+    if not os.path.exists(dockerignore):
+        return []
+    with open(dockerignore) as f:
+        return [line.strip() for line in f.read().splitlines() if line.strip() and not line.strip().startswith("#")]
+
+class BuildContext:
+    def __init__(self, build_dir, dockerfile=None, inline_dockerfile=None):
+        self.build_dir = build_dir
+        self.dockerfile = dockerfile or "Dockerfile"
+        self.inline_dockerfile = None
+        if inline_dockerfile is not None:
+            data = inline_dockerfile.getvalue()
+            self.inline_dockerfile = data
+            self.dockerfile = ".pdx-dockerfile-" + hashlib.sha256(data).hexdigest()[:12]
+        self.ignore = DockerIgnore(read_dockerignore(build_dir), dockerfile=self.dockerfile)
+        self.header_cache = DiskCache("tar_headers")
+        self.bytes_sent = 0
+        self.files_sent = 0
+        self.elapsed = None
+
+    def files(self):
+        # Relative paths of everything in the context, directories included, in a stable order
+        if self.inline_dockerfile is not None:
+            # Same as docker-py with fileobj=: the inline Dockerfile is the whole context
+            return []
+        found = []
+        pending = [""]
+        while pending:
+            directory = pending.pop()
+            try:
+                entries = sorted(os.scandir(os.path.join(self.build_dir, directory)), key=lambda entry: entry.name)
+            except OSError as e:
+                print("[WARN] Could not read %s for the build context: %s" % (directory, e))
+                continue
+            subdirectories = []
+            for entry in entries:
+                path = os.path.join(directory, entry.name) if directory else entry.name
+                is_dir = entry.is_dir(follow_symlinks=False)
+                if is_dir and self.ignore.can_prune(path):
+                    continue
+                if not self.ignore.excluded(path):
+                    found.append(path)
+                if is_dir:
+                    subdirectories.append(path)
+            pending.extend(reversed(subdirectories))
+        return found
+
+    def _header(self, path, st, headers, seen):
+        key = (st.st_ino, st.st_mtime_ns, st.st_size, st.st_mode, st.st_uid, st.st_gid)
+        cached = headers.get(path)
+        if cached is not None and cached[0] == key:
+            seen[path] = cached
+            return cached[1]
+
+        info = tarfile.TarInfo(path)
+        info.mode = stat.S_IMODE(st.st_mode)
+        info.mtime = int(st.st_mtime)
+        info.uid = st.st_uid
+        info.gid = st.st_gid
+        if stat.S_ISDIR(st.st_mode):
+            info.type = tarfile.DIRTYPE
+        elif stat.S_ISLNK(st.st_mode):
+            info.type = tarfile.SYMTYPE
+            info.linkname = os.readlink(os.path.join(self.build_dir, path))
+        else:
+            info.type = tarfile.REGTYPE
+            info.size = st.st_size
+
+        header = info.tobuf(tarfile.PAX_FORMAT, "utf-8", "surrogateescape")
+        seen[path] = (key, header)
+        return header
+
+    def _file_data(self, full_path, size):
+        remaining = size
+        with open(full_path, 'rb') as f:
+            while remaining > 0:
+                chunk = f.read(min(CHUNK_SIZE, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                yield chunk
+        # The file shrank while we were sending it, keep the archive consistent
+        while remaining > 0:
+            padding = min(CHUNK_SIZE, remaining)
+            remaining -= padding
+            yield b"\0" * padding
+        if size % BLOCK_SIZE:
+            yield b"\0" * (BLOCK_SIZE - size % BLOCK_SIZE)
+
+    def _stream(self):
+        started = time.monotonic()
+        headers = self.header_cache.get(self.build_dir, {})
+        seen = {}
+
+        for path in self.files():
+            full_path = os.path.join(self.build_dir, path)
+            try:
+                st = os.lstat(full_path)
+            except FileNotFoundError:
+                continue
+            if not (stat.S_ISDIR(st.st_mode) or stat.S_ISLNK(st.st_mode) or stat.S_ISREG(st.st_mode)):
+                continue
+
+            header = self._header(path, st, headers, seen)
+            self.files_sent += 1
+            self.bytes_sent += len(header)
+            yield header
+
+            if stat.S_ISREG(st.st_mode):
+                for chunk in self._file_data(full_path, st.st_size):
+                    self.bytes_sent += len(chunk)
+                    yield chunk
+
+        if self.inline_dockerfile is not None:
+            info = tarfile.TarInfo(self.dockerfile)
+            info.size = len(self.inline_dockerfile)
+            info.mtime = int(time.time())
+            data = info.tobuf(tarfile.PAX_FORMAT, "utf-8", "surrogateescape") + self.inline_dockerfile
+            if len(self.inline_dockerfile) % BLOCK_SIZE:
+                data += b"\0" * (BLOCK_SIZE - len(self.inline_dockerfile) % BLOCK_SIZE)
+            self.files_sent += 1
+            self.bytes_sent += len(data)
+            yield data
+
+        self.bytes_sent += 2 * BLOCK_SIZE
+        yield b"\0" * (2 * BLOCK_SIZE)
+
+        if self.inline_dockerfile is None:
+            # Nothing was walked, keep the headers for the next regular build
+            self.header_cache.set(self.build_dir, seen)
+        self.elapsed = time.monotonic() - started
+        print("Build context: %d files, %.1f MB streamed in %.1fs" % (self.files_sent, self.bytes_sent / 1048576, self.elapsed))
+
+    def stream(self):
+        return self._stream()
@@ -1,42 +1,185 @@
-from collections import defaultdict
+import re
+from collections import deque
+
+# Build graph. Nodes are image names ("linux/firefox:latest"), kept in an index
+# so edges are plain integer adjacency lists. A node without a build attached is
+# an external image (e.g. a distro base) that we only depend on.
+
+class CycleError(ValueError):
+    def __init__(self, cycle):
+        self.cycle = cycle
+        ValueError.__init__(self, "The input files have a circular dependency: %s" % " -> ".join(cycle))
 
 class DAG:
     def __init__(self):
-        self.builds = defaultdict(str)
-        self.nodes = set()
-        self.edges = defaultdict(list)
-        self.dep_count = defaultdict(int)
-
-    def add_edge(self, from_node, to_node, build):
-        self.nodes.add(from_node)
-        self.nodes.add(to_node)
-        self.edges[from_node].append(to_node)
-        self.dep_count[to_node] += 1
-        self.builds[to_node] = build
+        self.index = {}
+        self.names = []
+        self.children = []
+        self.parents = []
+        self.builds = {}
 
-    def topological_sort(self):
-        # list of nodes with no incoming edges
-        queue = [node for node in self.nodes if self.dep_count[node] == 0]
+    def add_node(self, node, build=None):
+        if node not in self.index:
+            self.index[node] = len(self.names)
+            self.names.append(node)
+            self.children.append([])
+            self.parents.append([])
+        if build is not None:
+            self.builds[node] = build
+        return self.index[node]
 
-        # list to store the sorted nodes
-        result = []
+    def add_edge(self, from_node, to_node, build=None):
+        from_id = self.add_node(from_node)
+        to_id = self.add_node(to_node, build)
+        if to_id not in self.children[from_id]:
+            self.children[from_id].append(to_id)
+            self.parents[to_id].append(from_id)
+
+    @property
+    def nodes(self):
+        return list(self.names)
+
+    def children_of(self, node):
+        return [self.names[child] for child in self.children[self.index[node]]]
+
+    def parents_of(self, node):
+        return [self.names[parent] for parent in self.parents[self.index[node]]]
+
+    def in_degree(self, node):
+        return len(self.parents[self.index[node]])
+
+    def _order(self):
+        # Kahn's algorithm over the index, O(V+E)
+        remaining = [len(parents) for parents in self.parents]
+        queue = deque(node for node, count in enumerate(remaining) if count == 0)
+        order = []
 
-        # process nodes without incoming edges
         while queue:
-            node = queue.pop(0)
+            node = queue.popleft()
+            order.append(node)
+            for child in self.children[node]:
+                remaining[child] -= 1
+                if remaining[child] == 0:
+                    queue.append(child)
+
+        if len(order) != len(self.names):
+            raise CycleError(self.find_cycle())
+        return order
+
+    def topological_order(self):
+        return [self.names[node] for node in self._order()]
+
+    def topological_sort(self):
+        result = []
+        for node in self.topological_order():
             if node in self.builds:
                 result.append(self.builds[node])
             else:
                 print("Assuming %s is an external dependency because it has no config defined!" % node)
-            for neighbor in self.edges[node]:
-                self.dep_count[neighbor] -= 1
-                if self.dep_count[neighbor] == 0:
-                    queue.append(neighbor)
-
-        # ensure that the graph does not have a cyclic dependency
-        # note: This doesn't work yet
-        circular_nodes = [node for node in self.nodes if self.dep_count[node] != 0 and node in self.config]
-        if circular_nodes:
-            raise ValueError('The input files have a circular dependency: %s' % circular_nodes)
         return result
 
+    def find_cycle(self):
+        # Iterative DFS, returns the exact path of the first cycle found (first node repeated at the end)
+        WHITE, GREY, BLACK = 0, 1, 2
+        colour = [WHITE] * len(self.names)
+
+        for root in range(len(self.names)):
+            if colour[root] != WHITE:
+                continue
+            path = [root]
+            stack = [iter(self.children[root])]
+            colour[root] = GREY
+
+            while stack:
+                child = next(stack[-1], None)
+                if child is None:
+                    colour[path.pop()] = BLACK
+                    stack.pop()
+                elif colour[child] == GREY:
+                    cycle = path[path.index(child):] + [child]
+                    return [self.names[node] for node in cycle]
+                elif colour[child] == WHITE:
+                    colour[child] = GREY
+                    path.append(child)
+                    stack.append(iter(self.children[child]))
+        return []
+
+    def depths(self):
+        # Longest distance from any root, i.e. how many builds have to happen before this one
+        depth = [0] * len(self.names)
+        for node in self._order():
+            for child in self.children[node]:
+                depth[child] = max(depth[child], depth[node] + 1)
+        return { self.names[node] : depth[node] for node in range(len(self.names)) }
+
+    def _weight(self, node, durations, default):
+        name = self.names[node]
+        if name not in self.builds:
+            return 0
+        if durations and durations.get(name) is not None:
+            return durations[name]
+        return default
+
+    def remaining_costs(self, durations=None, default=1.0):
+        # Weight of the heaviest path from each node down to a leaf, including the node itself
+        cost = [0] * len(self.names)
+        for node in reversed(self._order()):
+            below = max((cost[child] for child in self.children[node]), default=0)
+            cost[node] = self._weight(node, durations, default) + below
+        return { self.names[node] : cost[node] for node in range(len(self.names)) }
+
+    def critical_path(self, durations=None, default=1.0):
+        # Heaviest root-to-leaf chain, weighted by (historical) build durations
+        costs = self.remaining_costs(durations, default)
+        if not costs:
+            return 0, []
+
+        roots = [node for node in range(len(self.names)) if not self.parents[node]]
+        node = max(roots, key=lambda node: costs[self.names[node]])
+        total = costs[self.names[node]]
+        path = [self.names[node]]
+
+        while self.children[node]:
+            node = max(self.children[node], key=lambda child: costs[self.names[child]])
+            path.append(self.names[node])
+
+        return total, [name for name in path if name in self.builds]
+
+    def match(self, selector):
+        # "linux/firefox" matches every tag of that image, "linux/firefox:beta" only that tag
+        matches = []
+        for name in self.names:
+            if name == selector or (":" not in selector.rsplit("/", 1)[-1] and re.sub(r":[^:/]+$", "", name) == selector):
+                matches.append(name)
+        return matches
+
+    def _walk(self, start, edges):
+        seen = set(start)
+        pending = list(start)
+        while pending:
+            node = pending.pop()
+            for neighbour in edges[node]:
+                if neighbour not in seen:
+                    seen.add(neighbour)
+                    pending.append(neighbour)
+        return seen
+
+    def subgraph(self, selected, dependents=False, dependencies=False):
+        # Restricts the graph to the selected nodes, optionally widened to everything
+        # below (dependents) and/or above (dependencies) them. Parents outside of the
+        # selection are treated as already built.
+        start = [self.index[node] for node in selected]
+        keep = set(start)
+        if dependents:
+            keep |= self._walk(start, self.children)
+        if dependencies:
+            keep |= self._walk(start, self.parents)
+
+        graph = DAG()
+        for node in sorted(keep):
+            graph.add_node(self.names[node], self.builds.get(self.names[node]))
+        for node in sorted(keep):
+            for child in self.children[node]:
+                if child in keep:
+                    graph.add_edge(self.names[node], self.names[child])
+        return graph
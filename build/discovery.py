@@ -0,0 +1,123 @@
+import os
+from util.cache import DiskCache
+from .build import parse_app_config
+
+# Finds app configs under a builds checkout without re-reading it every run. The
+# listing of every directory is cached under its mtime (adding, removing or
+# renaming an entry changes it), and every parsed config is cached under the stat
+# of the config file and its Dockerfile. An unchanged tree costs one stat() per
+# directory and per config.
+
+APP_CONFIG_NAMES = ("app_config.yaml", "app_config.yml")
+
+# Never contain app configs: VCS data, download caches. Git dependency checkouts
+# are pruned too, by the local_path the configs declare for them.
+PRUNE_DIRS = { ".git", "cache", "node_modules", "__pycache__" }
+
+def _stamp(path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_mtime_ns, st.st_size, st.st_ino)
+
+def _under(path, directories):
+    return any(path == directory or path.startswith(directory + os.sep) for directory in directories)
+
+class DiscoveryIndex:
+    def __init__(self):
+        self.cache = DiskCache("discovery")
+        self.directories = self.cache.get("directories", {})
+        self.configs = self.cache.get("configs", {})
+        self.seen_directories = {}
+        self.seen_configs = {}
+        self.roots = []
+        self.parsed = 0
+
+    def _list(self, directory):
+        try:
+            mtime = os.stat(directory).st_mtime_ns
+        except OSError:
+            return [], []
+
+        cached = self.directories.get(directory)
+        if cached is not None and cached[0] == mtime:
+            self.seen_directories[directory] = cached
+            return cached[1], cached[2]
+
+        subdirectories = []
+        candidates = []
+        try:
+            entries = list(os.scandir(directory))
+        except OSError as e:
+            print("[WARN] Could not read %s: %s" % (directory, e))
+            return [], []
+
+        is_configs_dir = os.path.basename(directory) == "configs"
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                if entry.name not in PRUNE_DIRS:
+                    subdirectories.append(entry.name)
+            elif entry.name in APP_CONFIG_NAMES or (is_configs_dir and entry.name.endswith((".yaml", ".yml"))):
+                candidates.append(entry.name)
+
+        subdirectories.sort()
+        candidates.sort()
+        self.seen_directories[directory] = (mtime, subdirectories, candidates)
+        return subdirectories, candidates
+
+    def _dependency_paths(self, app_config_file):
+        # Where the config's git dependencies are checked out
+        try:
+            parsed = self.parse(app_config_file)
+            dependencies = (parsed["app_config"].get("build") or {}).get("dependencies") or {}
+            repositories = (dependencies.get("git") or {}).get("repositories") or []
+        except Exception:
+            # Not an app config, or a broken one: the build reports it
+            return []
+        return [os.path.normpath(os.path.join(parsed["build_dir"], repository["local_path"]))
+                for repository in repositories if repository.get("local_path")]
+
+    def find(self, path):
+        root = os.path.abspath(path)
+        self.roots.append(root)
+        found = []
+        checkouts = set()
+        pending = [root]
+        while pending:
+            directory = pending.pop()
+            if _under(directory, checkouts):
+                continue
+            subdirectories, candidates = self._list(directory)
+            for name in candidates:
+                app_config_file = os.path.join(directory, name)
+                found.append(app_config_file)
+                checkouts.update(self._dependency_paths(app_config_file))
+            pending.extend(os.path.join(directory, name) for name in reversed(subdirectories))
+        # A checkout can be walked before the config declaring it (configs/ next to it)
+        return [app_config_file for app_config_file in found if not _under(app_config_file, checkouts)]
+
+    def parse(self, app_config_file):
+        cached = self.configs.get(app_config_file)
+        if cached is not None:
+            stamps, parsed = cached
+            if stamps == (_stamp(app_config_file), _stamp(parsed["dockerfile"])):
+                self.seen_configs[app_config_file] = cached
+                return parsed
+
+        parsed = parse_app_config(app_config_file)
+        self.parsed += 1
+        self.seen_configs[app_config_file] = ((_stamp(app_config_file), _stamp(parsed["dockerfile"])), parsed)
+        return parsed
+
+    def _outside_roots(self, path):
+        return not _under(path, self.roots)
+
+    def save(self):
+        # Entries under the scanned roots that weren't seen again are gone, everything else is kept
+        directories = { path : entry for path, entry in self.directories.items() if self._outside_roots(path) }
+        directories.update(self.seen_directories)
+        configs = { path : entry for path, entry in self.configs.items() if self._outside_roots(path) }
+        configs.update(self.seen_configs)
+        self.cache.set("directories", directories)
+        self.cache.set("configs", configs)
@@ -0,0 +1,91 @@
+import os
+import hashlib
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+
+# Streaming HTTP downloads shared by the dependency resolvers. Files are written
+# to a .part file in chunks, interrupted downloads resume with a Range request,
+# and the result is checked against the expected size/sha256 before it replaces
+# the destination.
+
+CHUNK_SIZE = 1024 * 1024
+TIMEOUT = (10, 60)
+
+_session = None
+_session_lock = threading.Lock()
+
+class DownloadError(Exception):
+    pass
+
+def get_session():
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=16, pool_maxsize=16, max_retries=3)
+            _session.mount("https://", adapter)
+            _session.mount("http://", adapter)
+            _session.headers["User-Agent"] = "py-docker-x11"
+        return _session
+
+def sha256_file(path):
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+def _verify(path, size=None, sha256=None):
+    if size is not None and os.path.getsize(path) != size:
+        return "expected %d bytes, got %d" % (size, os.path.getsize(path))
+    if sha256 is not None and sha256_file(path) != sha256:
+        return "sha256 mismatch"
+    return None
+
+def download(url, path, size=None, sha256=None, headers=None, session=None):
+    # Returns True if something was downloaded, False if path was already complete
+    if session is None:
+        session = get_session()
+
+    if os.path.exists(path):
+        problem = _verify(path, size, sha256)
+        if problem is None:
+            return False
+        print("[WARN] Existing %s is not the expected file (%s), downloading it again." % (path, problem))
+
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    part_path = path + ".part"
+    offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+
+    if size is not None and offset > size:
+        offset = 0
+
+    request_headers = dict(headers or {})
+    if offset:
+        request_headers["Range"] = "bytes=%d-" % offset
+
+    with session.get(url, headers=request_headers, stream=True, timeout=TIMEOUT) as response:
+        if offset and response.status_code == 416:
+            # The .part file already holds everything the server has, let verification decide
+            pass
+        elif response.status_code in (200, 206):
+            if offset and response.status_code == 200:
+                print("Server ignored the resume request for %s, starting over." % url)
+                offset = 0
+            elif offset:
+                print("Resuming download of %s at %d bytes" % (url, offset))
+            with open(part_path, 'ab' if offset else 'wb') as f:
+                for chunk in response.iter_content(CHUNK_SIZE):
+                    f.write(chunk)
+        else:
+            # Leave any .part file alone, a later attempt can still resume it
+            raise DownloadError("Error %d while downloading %s" % (response.status_code, url))
+
+    problem = _verify(part_path, size, sha256)
+    if problem:
+        os.unlink(part_path)
+        raise DownloadError("Downloaded file %s failed verification: %s" % (path, problem))
+
+    os.replace(part_path, path)
+    return True
@@ -0,0 +1,201 @@
+import re
+import json
+import time
+import queue
+import threading
+
+# Turns the decoded JSON stream of a docker build into typed events and hands them
+# to sinks on a separate thread, so a slow terminal or log file never stalls the
+# build stream. Progress events are dropped when the queue is full, everything
+# else waits for room.
+
+STEP_REGEX = re.compile(r"^Step (\d+)/(\d+) : (.*)$")
+
+class BuildFailed(Exception):
+    pass
+
+class Event:
+    def __init__(self):
+        self.time = time.monotonic()
+
+    def to_dict(self):
+        data = dict(vars(self))
+        data["event"] = type(self).__name__
+        return data
+
+class StepEvent(Event):
+    def __init__(self, number, total, instruction):
+        Event.__init__(self)
+        self.number = number
+        self.total = total
+        self.instruction = instruction
+
+class CacheHitEvent(Event):
+    pass
+
+class OutputEvent(Event):
+    def __init__(self, text):
+        Event.__init__(self)
+        self.text = text
+
+class ProgressEvent(Event):
+    def __init__(self, layer, status, current=None, total=None):
+        Event.__init__(self)
+        self.layer = layer
+        self.status = status
+        self.current = current
+        self.total = total
+
+class ErrorEvent(Event):
+    def __init__(self, message, code=None):
+        Event.__init__(self)
+        self.message = message
+        self.code = code
+
+class ImageEvent(Event):
+    def __init__(self, image_id):
+        Event.__init__(self)
+        self.image_id = image_id
+
+def parse(log):
+    # One decoded chunk of the build stream -> list of events
+    if "errorDetail" in log or "error" in log:
+        detail = log.get("errorDetail") or {}
+        return [ErrorEvent(detail.get("message") or log.get("error"), detail.get("code"))]
+
+    if "aux" in log:
+        image_id = (log["aux"] or {}).get("ID")
+        return [ImageEvent(image_id)] if image_id else []
+
+    if "status" in log:
+        detail = log.get("progressDetail") or {}
+        return [ProgressEvent(log.get("id"), log["status"], detail.get("current"), detail.get("total"))]
+
+    events = []
+    for line in (log.get("stream") or "").splitlines():
+        if not line.strip():
+            continue
+        step = STEP_REGEX.match(line)
+        if step:
+            events.append(StepEvent(int(step[1]), int(step[2]), step[3]))
+        elif line.strip() == "---> Using cache":
+            events.append(CacheHitEvent())
+        else:
+            events.append(OutputEvent(line))
+    return events
+
+class Sink:
+    def handle(self, event):
+        pass
+
+    def close(self):
+        pass
+
+class ConsoleSink(Sink):
+    # Step lines and build output, without the progress and intermediate container noise
+    QUIET_REGEX = re.compile(r"^\s*(---> |Removing intermediate container )")
+
+    def handle(self, event):
+        if isinstance(event, StepEvent):
+            print("[%d/%d] %s" % (event.number, event.total, event.instruction))
+        elif isinstance(event, CacheHitEvent):
+            print("  (cached)")
+        elif isinstance(event, OutputEvent) and not self.QUIET_REGEX.match(event.text):
+            print("  " + event.text)
+        elif isinstance(event, ErrorEvent):
+            print("[ERROR] %s" % event.message)
+        elif isinstance(event, ImageEvent):
+            print("Built %s" % event.image_id)
+
+class JsonLinesSink(Sink):
+    def __init__(self, path):
+        self.file = open(path, "w")
+        self.started = time.monotonic()
+
+    def handle(self, event):
+        data = event.to_dict()
+        data["time"] = round(data["time"] - self.started, 3)
+        self.file.write(json.dumps(data) + "\n")
+
+    def close(self):
+        self.file.close()
+
+class MetricsSink(Sink):
+    def __init__(self):
+        self.started = time.monotonic()
+        self.steps = []
+        self.current = None
+        self.cache_hits = 0
+        self.image_id = None
+        self.elapsed = None
+
+    def _finish_step(self, end):
+        if self.current is not None:
+            self.current["duration"] = end - self.current["started"]
+            self.steps.append(self.current)
+            self.current = None
+
+    def handle(self, event):
+        if isinstance(event, StepEvent):
+            self._finish_step(event.time)
+            self.current = { "number" : event.number, "instruction" : event.instruction, "started" : event.time, "cached" : False }
+        elif isinstance(event, CacheHitEvent):
+            self.cache_hits += 1
+            if self.current is not None:
+                self.current["cached"] = True
+        elif isinstance(event, ImageEvent):
+            self.image_id = event.image_id
+
+    def cache_ratio(self):
+        return self.cache_hits / len(self.steps) if self.steps else 0.0
+
+    def close(self):
+        end = time.monotonic()
+        self._finish_step(end)
+        self.elapsed = end - self.started
+        if not self.steps:
+            return
+
+        print("Build took %.1fs, %d steps, %d cached (%.0f%%)" % (self.elapsed, len(self.steps), self.cache_hits, self.cache_ratio() * 100))
+        for step in sorted(self.steps, key=lambda step: step["duration"], reverse=True)[:3]:
+            if step["cached"] or step["duration"] < 1:
+                break
+            print("  %6.1fs  step %d: %s" % (step["duration"], step["number"], step["instruction"][:80]))
+
+class EventPipeline:
+    def __init__(self, sinks, maxsize=1000, wrap=None):
+        self.sinks = sinks
+        self.queue = queue.Queue(maxsize=maxsize)
+        self.dropped = 0
+        self.closed = False
+        consume = self._consume if wrap is None else wrap(self._consume)
+        self.thread = threading.Thread(target=consume, daemon=True)
+        self.thread.start()
+
+    def _consume(self):
+        while True:
+            event = self.queue.get()
+            if event is None:
+                break
+            for sink in self.sinks:
+                try:
+                    sink.handle(event)
+                except Exception as e:
+                    print("[WARN] Build log sink %s failed: %s" % (type(sink).__name__, e))
+        for sink in self.sinks:
+            sink.close()
+
+    def put(self, event):
+        if isinstance(event, ProgressEvent):
+            try:
+                self.queue.put_nowait(event)
+            except queue.Full:
+                self.dropped += 1
+        else:
+            self.queue.put(event)
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.queue.put(None)
+            self.thread.join()
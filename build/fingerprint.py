@@ -0,0 +1,100 @@
+import os
+import stat
+import hashlib
+import git
+from util.cache import DiskCache
+from .context import BuildContext
+
+# Content-addressed description of everything that goes into an image build.
+# The digest is stored on the image as a label, a build whose inputs hash to the
+# same value as the existing image is skipped. Parent images are included by ID,
+# so rebuilding a parent changes the fingerprint of all of its children.
+
+FINGERPRINT_LABEL = "pdx-build-fingerprint"
+
+class Fingerprint:
+    def __init__(self, client, build_dir):
+        self.client = client
+        self.build_dir = build_dir
+        self.digest = hashlib.sha256()
+        self.parts = {}
+        # Per build directory: relative path -> ((inode, mtime, size), sha256)
+        self.hash_cache = DiskCache("file_hashes")
+        self.file_hashes = self.hash_cache.get(build_dir, {})
+        self.seen_files = {}
+
+    def add(self, name, data):
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        part = hashlib.sha256(data).hexdigest()
+        self.parts[name] = part
+        self.digest.update(name.encode('utf-8') + b"\0" + part.encode('utf-8') + b"\n")
+
+    def _hash_file(self, path):
+        st = os.lstat(path)
+        key = os.path.relpath(path, self.build_dir)
+
+        if stat.S_ISLNK(st.st_mode):
+            return "link:" + os.readlink(path)
+
+        stamp = (st.st_ino, st.st_mtime_ns, st.st_size)
+        cached = self.file_hashes.get(key)
+        if cached is not None and cached[0] == stamp:
+            file_hash = cached[1]
+        else:
+            sha = hashlib.sha256()
+            with open(path, 'rb') as f:
+                for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                    sha.update(chunk)
+            file_hash = sha.hexdigest()
+
+        self.seen_files[key] = (stamp, file_hash)
+        # The executable bit ends up in the image, so it's part of the input
+        return "%s:%o" % (file_hash, stat.S_IMODE(st.st_mode) & 0o111)
+
+    def add_file(self, name, path):
+        if os.path.exists(path):
+            self.add(name, self._hash_file(path))
+        else:
+            self.add(name, "missing")
+
+    def add_files(self, name, paths):
+        listing = []
+        for path in sorted(paths):
+            full_path = os.path.join(self.build_dir, path)
+            if os.path.isdir(full_path) and not os.path.islink(full_path):
+                listing.append(path + "/")
+            else:
+                listing.append(path + " " + self._hash_file(full_path))
+        self.add(name, "\n".join(listing))
+
+    def add_context(self, dockerfile=None):
+        # Exactly the files that will be streamed to the daemon
+        self.add_files("context", BuildContext(self.build_dir, dockerfile).files())
+
+    def add_directory(self, name, path):
+        paths = []
+        for root, dirs, files in os.walk(path):
+            for file in files:
+                paths.append(os.path.relpath(os.path.join(root, file), self.build_dir))
+        self.add_files(name, paths)
+
+    def add_git_head(self, name, path):
+        try:
+            self.add(name, git.Repo(path).head.commit.hexsha)
+        except Exception as e:
+            print("[WARN] Could not read git HEAD of %s: %s" % (path, e))
+            self.add(name, "unknown")
+
+    def add_parent_image(self, image):
+        try:
+            self.add("parent:" + image, self.client.inspect_image(image)["Id"])
+        except Exception:
+            # Not available locally yet, the build will pull it
+            self.add("parent:" + image, "missing")
+
+    def save(self):
+        self.hash_cache.set(self.build_dir, self.seen_files)
+
+    def hexdigest(self):
+        return self.digest.hexdigest()
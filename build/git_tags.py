@@ -0,0 +1,70 @@
+import os
+import re
+import threading
+from util.cache import DiskCache
+
+# Index of a repository's tags with their commit dates and parsed versions, built
+# from a single `git for-each-ref` call. Cached per repository until packed-refs or
+# anything under refs/tags changes, so picking the latest tag is a lookup.
+
+SYMVER_REGEX = re.compile(r'^\d+(\.\d+)*$')
+
+_tag_cache = DiskCache("git_tags")
+_tag_indexes = {}
+_tag_indexes_lock = threading.Lock()
+
+class TagIndex:
+    def __init__(self, tags):
+        self.dates = dict(tags)
+        self.by_regex = {}
+
+        versions = [(tuple(int(part) for part in name.split(".")), name) for name in self.dates if SYMVER_REGEX.match(name)]
+        self.latest_symver = max(versions)[1] if versions else None
+
+    def latest_by_date(self, tag_regex):
+        if tag_regex not in self.by_regex:
+            matching = [name for name in self.dates if re.match(tag_regex, name)]
+            self.by_regex[tag_regex] = max(matching, key=lambda name: self.dates[name]) if matching else None
+        return self.by_regex[tag_regex]
+
+    def latest_by_symver(self):
+        return self.latest_symver
+
+def _refs_stamp(git_dir):
+    stamp = []
+    packed_refs = os.path.join(git_dir, "packed-refs")
+    stamp.append(os.stat(packed_refs).st_mtime_ns if os.path.exists(packed_refs) else None)
+    for root, dirs, files in os.walk(os.path.join(git_dir, "refs", "tags")):
+        dirs.sort()
+        stamp.append((root, os.stat(root).st_mtime_ns))
+    return stamp
+
+def _read_tags(repo):
+    # Annotated tags carry the commit date on the dereferenced object (*committerdate)
+    output = repo.git.for_each_ref("--format=%(refname:strip=2)%09%(committerdate:unix)%09%(*committerdate:unix)", "refs/tags")
+    tags = []
+    for line in output.splitlines():
+        name, date, dereferenced_date = (line.split("\t") + ["", ""])[:3]
+        tags.append((name, int(dereferenced_date or date or 0)))
+    return tags
+
+def get_tag_index(repo):
+    git_dir = os.path.abspath(repo.git_dir)
+    stamp = _refs_stamp(git_dir)
+
+    with _tag_indexes_lock:
+        cached = _tag_indexes.get(git_dir)
+        if cached is not None and cached[0] == stamp:
+            return cached[1]
+
+    entry = _tag_cache.get(git_dir)
+    if entry is not None and entry["stamp"] == stamp:
+        tags = entry["tags"]
+    else:
+        tags = _read_tags(repo)
+        _tag_cache.set(git_dir, { "stamp" : stamp, "tags" : tags })
+
+    index = TagIndex(tags)
+    with _tag_indexes_lock:
+        _tag_indexes[git_dir] = (stamp, index)
+    return index
@@ -0,0 +1,113 @@
+import os
+import sqlite3
+import threading
+import statistics
+
+# Local record of every build buildimage.py ran: when, how long each phase took,
+# how much context was sent and how much of the Dockerfile came from cache. Used
+# for --report and to give the scheduler realistic costs for ordering builds.
+
+DEFAULT_HISTORY_PATH = os.path.join(os.path.expanduser("~"), ".py-docker-x11", "build_history.sqlite")
+
+PHASES = ("dependencies", "context_upload", "docker_build", "push")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS builds (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    image TEXT NOT NULL,
+    fingerprint TEXT,
+    result TEXT NOT NULL,
+    started REAL NOT NULL,
+    finished REAL NOT NULL,
+    dependencies REAL,
+    context_upload REAL,
+    docker_build REAL,
+    push REAL,
+    context_bytes INTEGER,
+    cache_ratio REAL
+);
+CREATE INDEX IF NOT EXISTS builds_image ON builds (image, started);
+"""
+
+class BuildHistory:
+    def __init__(self, path=DEFAULT_HISTORY_PATH):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Builds finish on worker threads, all access goes through the lock
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()
+        with self.lock, self.connection:
+            self.connection.executescript(SCHEMA)
+
+    def record(self, image, result, started, finished, fingerprint=None, phases=None, context_bytes=None, cache_ratio=None):
+        phases = phases or {}
+        with self.lock, self.connection:
+            cursor = self.connection.execute(
+                "INSERT INTO builds (image, fingerprint, result, started, finished, %s, context_bytes, cache_ratio) "
+                "VALUES (?, ?, ?, ?, ?, %s, ?, ?)" % (", ".join(PHASES), ", ".join("?" for _ in PHASES)),
+                [image, fingerprint, result, started, finished] + [phases.get(phase) for phase in PHASES] + [context_bytes, cache_ratio])
+            return cursor.lastrowid
+
+    def set_phase(self, build_id, phase, duration):
+        # For phases that finish after the build itself was recorded (push)
+        if phase not in PHASES:
+            raise ValueError("Unknown build phase %s" % phase)
+        with self.lock, self.connection:
+            self.connection.execute("UPDATE builds SET %s = ? WHERE id = ?" % phase, (duration, build_id))
+
+    def _query(self, sql, parameters=()):
+        with self.lock:
+            return self.connection.execute(sql, parameters).fetchall()
+
+    def recent_durations(self, image, limit=5):
+        # Newest first, only builds that actually ran docker build
+        rows = self._query("SELECT finished - started FROM builds WHERE image = ? AND result = 'built' ORDER BY started DESC LIMIT ?", (image, limit))
+        return [row[0] for row in rows]
+
+    def durations(self, limit=5):
+        # Typical duration per image, the median of its recent builds
+        images = [row[0] for row in self._query("SELECT DISTINCT image FROM builds WHERE result = 'built'")]
+        return { image : statistics.median(self.recent_durations(image, limit)) for image in images }
+
+    def slowest(self, limit=10):
+        return sorted(self.durations().items(), key=lambda item: item[1], reverse=True)[:limit]
+
+    def trend(self, image, limit=10):
+        rows = self._query("SELECT started, finished - started, dependencies, context_upload, docker_build, push, context_bytes, cache_ratio "
+                           "FROM builds WHERE image = ? AND result = 'built' ORDER BY started DESC LIMIT ?", (image, limit))
+        return list(reversed(rows))
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+def print_report(history, dag=None, limit=10):
+    slowest = history.slowest(limit)
+    if not slowest:
+        print("No builds recorded yet.")
+        return
+
+    print("Slowest images (median of recent builds):")
+    for image, duration in slowest:
+        durations = list(reversed(history.recent_durations(image)))
+        trend = ""
+        if len(durations) > 1 and durations[0] > 0:
+            trend = "%+.0f%% over the last %d builds" % ((durations[-1] - durations[0]) / durations[0] * 100, len(durations))
+        print("  %8.1fs  %-50s %s" % (duration, image, trend))
+
+    print("")
+    print("Phases of the latest build:")
+    print("  %-50s %8s %8s %8s %8s %9s %6s" % ("image", "deps", "upload", "build", "push", "context", "cache"))
+    for image, _ in slowest:
+        rows = history.trend(image, 1)
+        if not rows:
+            continue
+        _, _, dependencies, context_upload, docker_build, push, context_bytes, cache_ratio = rows[-1]
+        phases = ["%7.1fs" % value if value is not None else "       -" for value in (dependencies, context_upload, docker_build, push)]
+        context = "%7.1fMB" % (context_bytes / 1048576) if context_bytes is not None else "        -"
+        cache = "%5.0f%%" % (cache_ratio * 100) if cache_ratio is not None else "     -"
+        print("  %-50s %s %s %s" % (image, " ".join(phases), context, cache))
+
+    if dag is not None:
+        total, path = dag.critical_path(history.durations())
+        print("")
+        print("Critical path (%.0fs): %s" % (total, " -> ".join(path)))
@@ -1,55 +1,112 @@
 import re, os
+import sys
+import json
+import functools
+import threading
 import subprocess
-import hashlib
-import shutil
+from build import download
+from util.fileclone import clone_file
 
-def pull(driver_cache_path, docker_build_path):
-    modinfo_output = subprocess.check_output(["modinfo", "nvidia"]).decode('utf-8').splitlines()
-    BUF_SIZE = 65536
-    md5_current = hashlib.md5()
-    md5_latest = hashlib.md5()
+# The driver cache keeps a sidecar manifest next to every .run file with its size,
+# mtime and sha256, plus the same for every copy placed in a build directory. As
+# long as a stat() agrees with the manifest nothing has to be hashed again.
+
+DRIVER_URL = "https://us.download.nvidia.com/XFree86/Linux-x86_64/{0}/NVIDIA-Linux-x86_64-{0}.run"
+
+# Concurrent builds share the cache and its manifests
+_pull_lock = threading.Lock()
+
+@functools.lru_cache(maxsize=None)
+def get_driver_version():
+    # The loaded module reports its version in sysfs, modinfo is the fallback
+    try:
+        with open("/sys/module/nvidia/version") as f:
+            return f.read().strip()
+    except OSError:
+        pass
 
+    modinfo_output = subprocess.check_output(["modinfo", "nvidia"]).decode('utf-8').splitlines()
     for line in modinfo_output:
-        if re.match("^version\:\s+([0-9.]+)", line):
-            driver_version = re.match("^version\:\s+([0-9.]+)", line)[1]
-            current_driver_path = os.path.join(driver_cache_path, "NVIDIA-Linux-x86_64-" + driver_version + ".run")
-            docker_build_driver_path = os.path.join(docker_build_path, "files", "nvidia-driver.run")
-
-            if not os.path.exists(current_driver_path):
-                print("Pulling driver %s:" % driver_version)
-                try:
-                    subprocess.check_output(["wget", "-O", current_driver_path,
-                                             "https://us.download.nvidia.com/XFree86/Linux-x86_64/" + driver_version +
-                                             "/NVIDIA-Linux-x86_64-" + driver_version + ".run"])
-                    shutil.copy2(current_driver_path, docker_build_driver_path)
-                    break
-                except Exception as e:
-                    print("Unable to pull the latest nVidia driver for the image! Aborting.")
-                    print("Error: %s" % e)
-                    sys.exit(1)
-
-            if not os.path.exists(docker_build_driver_path):
-                shutil.copy2(current_driver_path, docker_build_driver_path)
-                break
-            else:
-                with open(current_driver_path, 'rb') as current_driver:
-                    while True:
-                        data = current_driver.read(BUF_SIZE)
-                        if not data:
-                            break
-                        md5_current.update(data)
-                with open(docker_build_driver_path, 'rb') as docker_driver:
-                    while True:
-                        data = docker_driver.read(BUF_SIZE)
-                        if not data:
-                            break
-                        md5_latest.update(data)
-                print("md5sum of current driver: {0}".format(md5_current.hexdigest()))
-                print("md5sum of present driver: {0}".format(md5_latest.hexdigest()))
-
-                if md5_current.hexdigest() != md5_latest.hexdigest():
-                    shutil.copy2(current_driver_path, docker_build_driver_path)
-                else:
-                    print("Checksums match, nothing to do.")
-                break
+        version = re.match(r"^version:\s+([0-9.]+)", line)
+        if version:
+            return version[1]
+    return None
+
+def _stat(path):
+    st = os.stat(path)
+    return { "size" : st.st_size, "mtime_ns" : st.st_mtime_ns, "inode" : st.st_ino }
+
+def _manifest_path(driver_path):
+    return driver_path + ".json"
+
+def _load_manifest(driver_path):
+    try:
+        with open(_manifest_path(driver_path)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def _save_manifest(driver_path, manifest):
+    tmp = _manifest_path(driver_path) + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp, _manifest_path(driver_path))
+
+def _matches(record, path):
+    if not record or not os.path.exists(path):
+        return False
+    state = _stat(path)
+    return all(record.get(field) == state[field] for field in ("size", "mtime_ns", "inode"))
+
+def _record(path, sha256=None):
+    record = _stat(path)
+    record["sha256"] = sha256 or download.sha256_file(path)
+    return record
+
+def pull(driver_cache_path, docker_build_path):
+    with _pull_lock:
+        _pull(driver_cache_path, docker_build_path)
+
+def _pull(driver_cache_path, docker_build_path):
+    driver_version = get_driver_version()
+    if driver_version is None:
+        print("Unable to determine the nVidia driver version! Aborting.")
+        sys.exit(1)
+
+    os.makedirs(driver_cache_path, exist_ok=True)
+    current_driver_path = os.path.join(driver_cache_path, "NVIDIA-Linux-x86_64-" + driver_version + ".run")
+    docker_build_driver_path = os.path.join(docker_build_path, "files", "nvidia-driver.run")
+
+    if not os.path.exists(current_driver_path):
+        print("Pulling driver %s:" % driver_version)
+        try:
+            download.download(DRIVER_URL.format(driver_version), current_driver_path)
+        except Exception as e:
+            print("Unable to pull the latest nVidia driver for the image! Aborting.")
+            print("Error: %s" % e)
+            sys.exit(1)
+
+    manifest = _load_manifest(current_driver_path)
+    if not _matches(manifest.get("driver"), current_driver_path):
+        manifest = { "version" : driver_version, "driver" : _record(current_driver_path), "copies" : {} }
+        _save_manifest(current_driver_path, manifest)
+    sha256 = manifest["driver"]["sha256"]
+
+    copies = manifest.setdefault("copies", {})
+    copy = copies.get(docker_build_driver_path)
+    if _matches(copy, docker_build_driver_path) and copy["sha256"] == sha256:
+        print("Driver %s in the build directory is up to date." % driver_version)
+        return
+
+    if copy is None and os.path.exists(docker_build_driver_path) and download.sha256_file(docker_build_driver_path) == sha256:
+        # Placed by an older version without a manifest, just start tracking it
+        print("Checksums match, nothing to do.")
+        copies[docker_build_driver_path] = _record(docker_build_driver_path, sha256)
+        _save_manifest(current_driver_path, manifest)
+        return
 
+    os.makedirs(os.path.dirname(docker_build_driver_path), exist_ok=True)
+    method = clone_file(current_driver_path, docker_build_driver_path)
+    print("Placed driver %s in the build directory (%s)" % (driver_version, method))
+    copies[docker_build_driver_path] = _record(docker_build_driver_path, sha256)
+    _save_manifest(current_driver_path, manifest)
@@ -0,0 +1,103 @@
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from . import events
+
+# Pushes images while the rest of the DAG is still building. An image's push waits
+# for the pushes of its parents from the same run, so shared parent layers are
+# already in the registry and get skipped instead of being uploaded twice.
+
+class PushStage:
+    def __init__(self, client, jobs=2):
+        self.client = client
+        self.executor = ThreadPoolExecutor(max_workers=max(1, jobs))
+        self.futures = {}
+        self.lock = threading.Lock()
+        # Layer ID -> size, as seen while pushing, to account for layers skipped later
+        self.layer_sizes = {}
+        self.results = {}
+
+    def submit(self, image, parents=(), on_done=None):
+        # Jobs run in submission order and parents are always submitted first, so waiting never deadlocks
+        with self.lock:
+            waits_for = [self.futures[parent] for parent in parents if parent in self.futures]
+            self.futures[image] = self.executor.submit(self._push, image, waits_for, on_done)
+
+    def _push(self, image, waits_for, on_done):
+        for future in waits_for:
+            try:
+                future.result()
+            except Exception:
+                pass
+
+        repository, tag = image.rsplit(":", 1)
+        started = time.monotonic()
+        # Layer ID -> last status and size seen; a layer counts by how it ended up,
+        # whether or not any progress was reported for it along the way
+        statuses = {}
+        sizes = {}
+        error = None
+
+        print("[push] Pushing %s" % image)
+        try:
+            for log in self.client.push(repository, tag=tag, stream=True, decode=True):
+                for event in events.parse(log):
+                    if isinstance(event, events.ErrorEvent):
+                        error = event.message
+                    elif isinstance(event, events.ProgressEvent) and event.layer:
+                        statuses[event.layer] = event.status
+                        if event.total:
+                            sizes[event.layer] = event.total
+                        if event.status == "Pushed":
+                            print("[push] %s: layer %s pushed" % (image, event.layer))
+                if error:
+                    break
+        except Exception as e:
+            error = str(e)
+
+        pushed = [layer for layer, status in statuses.items() if status == "Pushed"]
+        # Mounted layers came from another repository on the same registry, nothing was uploaded
+        skipped = [layer for layer, status in statuses.items() if status == "Layer already exists" or status.startswith("Mounted from")]
+
+        duration = time.monotonic() - started
+        with self.lock:
+            self.layer_sizes.update(sizes)
+            pushed_bytes = sum(self.layer_sizes.get(layer, 0) for layer in pushed)
+            skipped_bytes = sum(self.layer_sizes.get(layer, 0) for layer in skipped)
+            result = {
+                "error" : error,
+                "duration" : duration,
+                "layers_pushed" : len(pushed),
+                "bytes_pushed" : pushed_bytes,
+                "layers_skipped" : len(skipped),
+                "bytes_skipped" : skipped_bytes,
+            }
+            self.results[image] = result
+
+        if error:
+            print("[ERROR] Push of %s failed after %.1fs: %s" % (image, duration, error))
+        else:
+            print("[push] Pushed %s in %.1fs: %d layers (%.1f MB) uploaded, %d already present (%.1f MB known)" %
+                  (image, duration, result["layers_pushed"], result["bytes_pushed"] / 1048576, result["layers_skipped"], skipped_bytes / 1048576))
+
+        if on_done is not None:
+            on_done(image, result)
+
+        if error:
+            raise events.BuildFailed(error)
+        return result
+
+    def close(self):
+        # Waits for every push, True if all of them succeeded
+        self.executor.shutdown(wait=True)
+        if not self.results:
+            return True
+
+        failed = [image for image, result in self.results.items() if result["error"]]
+        print("Pushed %d images: %.1f MB uploaded, %.1f MB skipped as already present" % (
+            len(self.results) - len(failed),
+            sum(result["bytes_pushed"] for result in self.results.values()) / 1048576,
+            sum(result["bytes_skipped"] for result in self.results.values()) / 1048576))
+        if failed:
+            print("[ERROR] Failed to push: %s" % ", ".join(failed))
+        return not failed
@@ -0,0 +1,119 @@
+import os
+import sys
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from util.output import ThreadStdout
+
+# Runs builds from a DAG as soon as all of their parents have finished, using a
+# bounded worker pool. A failed build only skips its own descendants.
+
+class Scheduler:
+    def __init__(self, dag, run_build, jobs=1, log_dir=None, durations=None):
+        self.dag = dag
+        self.run_build = run_build
+        self.jobs = max(1, jobs)
+        self.log_dir = log_dir
+        # With known durations, the ready build heading the longest remaining chain starts first
+        self.costs = dag.remaining_costs(durations) if durations else None
+        self.results = {}
+        self.durations = {}
+
+    def _log_path(self, node):
+        return os.path.join(self.log_dir, node.replace("/", "_").replace(":", "-") + ".log")
+
+    def _run(self, node, build, stdout):
+        started = time.monotonic()
+        if self.log_dir:
+            stdout.local.log = open(self._log_path(node), "w", buffering=1)
+            # With a single worker there's no interleaving, so keep the console output too
+            stdout.local.echo = self.jobs == 1
+        try:
+            self.run_build(build)
+        finally:
+            self.durations[node] = time.monotonic() - started
+            if self.log_dir:
+                stdout.local.log.close()
+                stdout.local.log = None
+
+    def _skip_descendants(self, node):
+        skipped = []
+        pending = self.dag.children_of(node)
+        while pending:
+            child = pending.pop()
+            if child in self.results:
+                continue
+            self.results[child] = "skipped"
+            skipped.append(child)
+            pending.extend(self.dag.children_of(child))
+        return skipped
+
+    def run(self):
+        if self.log_dir:
+            os.makedirs(self.log_dir, exist_ok=True)
+
+        remaining = { node : self.dag.in_degree(node) for node in self.dag.nodes }
+        ready = deque(node for node, count in remaining.items() if count == 0)
+        running = {}
+
+        stdout = ThreadStdout(sys.stdout)
+        sys.stdout = stdout
+
+        def release(node):
+            for child in self.dag.children_of(node):
+                remaining[child] -= 1
+                if remaining[child] == 0 and child not in self.results:
+                    ready.append(child)
+
+        try:
+            with ThreadPoolExecutor(max_workers=self.jobs) as executor:
+                while ready or running:
+                    # Only hand out as many builds as there are workers, so priorities still apply to whatever becomes ready later
+                    while ready and len(running) < self.jobs:
+                        if self.costs:
+                            node = max(ready, key=lambda node: self.costs[node])
+                            ready.remove(node)
+                        else:
+                            node = ready.popleft()
+                        if node not in self.dag.builds:
+                            print("Assuming %s is an external dependency because it has no config defined!" % node)
+                            self.results[node] = "external"
+                            release(node)
+                            continue
+
+                        if self.log_dir:
+                            print("[INFO] Starting build of %s, logging to %s" % (node, self._log_path(node)))
+                        else:
+                            print("[INFO] Starting build of %s" % node)
+                        running[executor.submit(self._run, node, self.dag.builds[node], stdout)] = node
+
+                    if not running:
+                        break
+
+                    finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                    for future in finished:
+                        node = running.pop(future)
+                        try:
+                            future.result()
+                        except BaseException as e:
+                            # Builds bail out with sys.exit() on errors, so SystemExit counts as a failure too
+                            self.results[node] = "failed"
+                            skipped = self._skip_descendants(node)
+                            print("[ERROR] Build of %s failed after %.1fs: %r" % (node, self.durations.get(node, 0), e))
+                            if skipped:
+                                print("[ERROR] Skipping dependent builds: %s" % ", ".join(skipped))
+                            continue
+
+                        self.results[node] = "success"
+                        print("[INFO] Finished build of %s in %.1fs" % (node, self.durations.get(node, 0)))
+                        release(node)
+        finally:
+            sys.stdout = stdout.stream
+
+        # Anything we never reached is part of a dependency cycle
+        for node in self.dag.nodes:
+            if node not in self.results:
+                self.results[node] = "blocked"
+                print("[ERROR] %s was never built, it is part of a circular dependency." % node)
+
+        return self.results
@@ -0,0 +1,162 @@
+import os
+import time
+import hashlib
+import subprocess
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from util.cache import DiskCache, hash_key
+from .dag import DAG, CycleError
+
+# Runs the "scripts" build dependencies of an app. Scripts run in order unless
+# they say otherwise: "parallel: true" lets a script start alongside the ones
+# before it, "depends_on" names the scripts that have to finish first. Either
+# way, the next script in order waits for all of them again. Output of
+# each script goes to its own log file. A script that succeeded is not run again
+# until the script itself or its arguments change.
+#
+#   scripts:
+#     - script: fetch_assets.sh
+#       name: assets
+#     - script: fetch_fonts.sh
+#       parallel: true
+#     - script: unpack.sh
+#       depends_on: [assets, fetch_fonts.sh]
+
+DEFAULT_LOG_DIR = os.path.join(os.path.expanduser("~"), ".py-docker-x11", "logs", "scripts")
+
+class ScriptRunner:
+    def __init__(self, scripts, build_dir, log_dir=None, jobs=4, force=False):
+        self.build_dir = build_dir
+        self.log_dir = log_dir or os.path.join(DEFAULT_LOG_DIR, os.path.basename(os.path.normpath(build_dir)))
+        self.jobs = max(1, jobs)
+        self.force = force
+        self.cache = DiskCache("script_runs")
+        self.env = { "PATH" : os.environ.get("PATH", os.defpath), "HOME" : os.path.expanduser("~") }
+        self.results = {}
+        self.durations = {}
+
+        self.scripts = {}
+        self.dag = DAG()
+        # The last script that ran in order, and the scripts that opted out of
+        # the order since then: the next script in order waits for all of them
+        previous = None
+        unordered = []
+        for script in scripts:
+            name = script.get("name", script.get("script"))
+            self.scripts[name] = script
+            self.dag.add_node(name)
+            if "depends_on" in script:
+                for dependency in script["depends_on"]:
+                    self.dag.add_edge(dependency, name)
+                unordered.append(name)
+            elif script.get("parallel", False):
+                unordered.append(name)
+            else:
+                for dependency in ([previous] if previous is not None else []) + unordered:
+                    self.dag.add_edge(dependency, name)
+                previous = name
+                unordered = []
+
+    def _script_path(self, script):
+        return os.path.join(self.build_dir, "scripts", script.get("script"))
+
+    def _input_hash(self, name, script):
+        sha = hashlib.sha256()
+        with open(self._script_path(script), 'rb') as f:
+            sha.update(f.read())
+        sha.update(repr((name, script.get("args", []), sorted(self.env.items()))).encode('utf-8'))
+        return sha.hexdigest()
+
+    def _log_path(self, name):
+        return os.path.join(self.log_dir, name.replace("/", "_") + ".log")
+
+    def _run(self, name):
+        script = self.scripts[name]
+        command = [self._script_path(script)] + script.get("args", [])
+        cache_key = hash_key(self.build_dir, name)
+        input_hash = self._input_hash(name, script)
+
+        if not self.force and script.get("cache", True) and self.cache.get(cache_key) == input_hash:
+            return "cached"
+
+        started = time.monotonic()
+        with open(self._log_path(name), "w") as log:
+            returncode = subprocess.call(command, cwd=self.build_dir, env=self.env, stdout=log, stderr=subprocess.STDOUT)
+        self.durations[name] = time.monotonic() - started
+
+        if returncode != 0:
+            self.cache.delete(cache_key)
+            return "failed"
+
+        self.cache.set(cache_key, input_hash)
+        return "success"
+
+    def _skip_descendants(self, name):
+        pending = self.dag.children_of(name)
+        while pending:
+            child = pending.pop()
+            if child not in self.results:
+                self.results[child] = "skipped"
+                pending.extend(self.dag.children_of(child))
+
+    def run(self):
+        try:
+            self.dag.topological_order()
+        except CycleError as e:
+            print("[ERROR] Script dependencies: %s" % e)
+            return False
+
+        os.makedirs(self.log_dir, exist_ok=True)
+        remaining = { name : self.dag.in_degree(name) for name in self.dag.nodes }
+        ready = deque(name for name, count in remaining.items() if count == 0)
+        running = {}
+
+        def release(name):
+            for child in self.dag.children_of(name):
+                remaining[child] -= 1
+                if remaining[child] == 0 and child not in self.results:
+                    ready.append(child)
+
+        with ThreadPoolExecutor(max_workers=self.jobs) as executor:
+            while ready or running:
+                while ready:
+                    name = ready.popleft()
+                    if name not in self.scripts:
+                        print("[ERROR] Script dependency %s is not declared." % name)
+                        self.results[name] = "failed"
+                        self._skip_descendants(name)
+                    elif not os.path.exists(self._script_path(self.scripts[name])):
+                        print("Script %s not found in scripts in app_config scripts entry. Skipping." % name)
+                        self.results[name] = "missing"
+                        release(name)
+                    else:
+                        running[executor.submit(self._run, name)] = name
+
+                if not running:
+                    break
+
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    name = running.pop(future)
+                    try:
+                        result = future.result()
+                    except OSError as e:
+                        print("[ERROR] Could not execute %s: %s" % (name, e))
+                        result = "failed"
+                    self.results[name] = result
+
+                    if result == "cached":
+                        print("Script %s is unchanged since its last successful run, skipping." % name)
+                    elif result == "success":
+                        print("Script %s finished in %.1fs" % (name, self.durations[name]))
+                    else:
+                        print("[ERROR] Script %s failed after %.1fs, see %s" % (name, self.durations.get(name, 0), self._log_path(name)))
+                        self._skip_descendants(name)
+                        continue
+
+                    release(name)
+
+        skipped = [name for name, result in self.results.items() if result == "skipped"]
+        if skipped:
+            print("[ERROR] Skipped scripts depending on failed ones: %s" % ", ".join(skipped))
+        return all(result in ("success", "cached", "missing") for result in self.results.values())
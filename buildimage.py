@@ -4,20 +4,22 @@ import docker
 import argparse
 import yaml
 import os, sys
+import time
 import re
-from build.dag import DAG
+from build.dag import DAG, CycleError
 from build.build import Build
+from build.discovery import DiscoveryIndex
 from build.builder import Builder
+from build.scheduler import Scheduler
+from build.history import BuildHistory, print_report
+from build.push import PushStage
 
-def find_yaml_files(path, recurse=True):
+def find_yaml_files(path, recurse=True, index=None):
     found_files = []
     if recurse:
-        for root, dirs, files in os.walk(path):
-            for file in files:
-                if file == "app_config.yaml" or file == "app_config.yml":
-                    found_files.append(os.path.join(root, file))
-                elif file.endswith((".yaml", ".yml")) and "config" in root:
-                    found_files.append(os.path.join(root, file))
+        if index is None:
+            index = DiscoveryIndex()
+        found_files = index.find(path)
     else:
         if os.path.exists(os.path.join(path, "app_config.yaml")):
             found_files.append(os.path.join(path, "app_config.yaml"))
@@ -57,8 +59,13 @@ def parseArgs():
     parser.add_argument("--dry-run", action="store_true", default=False, help="Only show builds that would have occurred.")
     parser.add_argument("--force", action='store_true', default=False, help="Force build even if images are too new")
     parser.add_argument("--full", action='store_true', default=False, help="Enables pull and nocache")
+    parser.add_argument("-j", "--jobs", type=int, default=1, help="Number of builds to run concurrently")
     parser.add_argument("--nocache", action='store_true', default=False, help="Do not use cache during build")
+    parser.add_argument("--only", action='append', default=[], help="Only build this image (repeatable), e.g. linux/firefox or linux/firefox:latest")
+    parser.add_argument("--with-dependents", action='store_true', default=False, help="With --only, also build every image that depends on the selected ones")
+    parser.add_argument("--with-dependencies", action='store_true', default=False, help="With --only, also build the selected images' own dependencies")
     parser.add_argument("--pull", action='store_true', default=False, help="Pull image before build")
+    parser.add_argument("--report", action='store_true', default=False, help="Show the slowest images, their trends and the critical path from the build history")
     parser.add_argument("--push", action='store_true', help="Push image after build")
     parser.add_argument("--update", action='store_true', help="Run update builds")
     return parser.parse_args()
@@ -79,31 +86,86 @@ def main(args):
     if build_type == "local":
         dag = DAG()
 
-        if args.auto:
-            app_config_files = find_yaml_files(os.path.expanduser(base_config["build"]["build_dir"]))
+        index = DiscoveryIndex()
+        if args.auto or args.only or args.report:
+            app_config_files = find_yaml_files(os.path.expanduser(base_config["build"]["build_dir"]), index=index)
         else:
             app_config_files = find_yaml_files(cwd, recurse=False)
 
             if os.path.exists(os.path.join(cwd, "configs")):
-                found_yaml_files = find_yaml_files(os.path.join(cwd, "configs"))
-                app_config_files.extend(find_yaml_files(os.path.join(cwd, "configs")))
+                app_config_files.extend(find_yaml_files(os.path.join(cwd, "configs"), index=index))
         
         if app_config_files:
             builds = []
             for app_config_file in app_config_files:
-                builds.append(Build(app_config_file, args, base_config, client))
+                builds.append(Build(app_config_file, args, base_config, client, parsed=index.parse(app_config_file)))
+            index.save()
+            print("Found %d build configs, %d of them changed since the last run" % (len(builds), index.parsed))
 
             for build in builds:
-                if args.auto and not build.automatic:
+                if args.auto and not args.only and not build.automatic:
                     continue
                 for dependency in build.depends_on:
                     dag.add_edge(dependency, build.full_image_name, build)
 
-            for build in dag.topological_sort():
+            if args.only:
+                selected = []
+                for selector in args.only:
+                    matches = [node for node in dag.match(selector) if node in dag.builds]
+                    if not matches:
+                        print("[ERROR] No build config found for %s" % selector)
+                        sys.exit(1)
+                    selected.extend(matches)
+                dag = dag.subgraph(selected, dependents=args.with_dependents, dependencies=args.with_dependencies)
+
+            try:
+                dag.topological_order()
+            except CycleError as e:
+                print("[ERROR] %s" % e)
+                sys.exit(1)
+
+            history = BuildHistory()
+            durations = history.durations()
+
+            if args.report:
+                print_report(history, dag)
+                return
+
+            if args.dry_run:
+                depths = dag.depths()
+                for build in dag.topological_sort():
+                    print("Building %s (depth %d)" % (build.app_config_file, depths[build.full_image_name]))
+                total, path = dag.critical_path(durations)
+                print("Critical path (%.0fs): %s" % (total, " -> ".join(path)))
+                return
+
+            def run_build(build):
                 print("Building %s" % build.app_config_file)
-                if not args.dry_run:
-                    builder = Builder(args, base_config, build, client)
+                builder = Builder(args, base_config, build, client)
+                started = time.time()
+                result = "failed"
+                try:
                     builder.run_build()
+                    result = builder.outcome or "built"
+                finally:
+                    cache_ratio = builder.metrics.cache_ratio() if builder.metrics is not None else None
+                    build_id = history.record(build.full_image_name, result, started, time.time(), fingerprint=builder.fingerprint,
+                                              phases=builder.phases, context_bytes=builder.context_bytes, cache_ratio=cache_ratio)
+
+                builder.push_image(push_stage, on_done=lambda image, push: history.set_phase(build_id, "push", push["duration"]))
+
+            log_dir = os.path.expanduser(base_config["build"].get("log_dir", "~/.py-docker-x11/logs/build"))
+            push_stage = PushStage(client, jobs=base_config["build"].get("push_jobs", 2))
+            scheduler = Scheduler(dag, run_build, jobs=args.jobs, log_dir=log_dir, durations=durations)
+            results = scheduler.run()
+            pushed = push_stage.close()
+            history.close()
+
+            if not pushed:
+                sys.exit(1)
+
+            if "failed" in results.values() or "blocked" in results.values():
+                sys.exit(1)
 
 if __name__ == '__main__':
     main(parseArgs())
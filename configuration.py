@@ -1,17 +1,35 @@
-import os, sys
+import os, sys, pwd
 import jinja2, yaml
 import functools
 import collections
 import importlib
 import re
+from util import imagecache, configcache, user
+
+# Environments are reused across renders rather than rebuilt for every template
+_jinja_environments = {}
+_jinja_string_environment = jinja2.Environment()
+
+def _jinja_environment(template_dir):
+    if template_dir not in _jinja_environments:
+        _jinja_environments[template_dir] = jinja2.Environment(loader=jinja2.FileSystemLoader(template_dir))
+    return _jinja_environments[template_dir]
 
 class YamlReaderError(Exception):
     pass
 
 class Config:
-    def __init__(self, args, client):
+    def __init__(self, args, client, images=None):
         base_dir = os.path.join(os.path.expanduser("~"), ".py-docker-x11")
-        current_user = os.getlogin()
+        # py-docker-x11d passes in one cache shared by all of its launches
+        self.images = images if images is not None else imagecache.ImageCache(client)
+        self.render_cache = configcache.RenderCache()
+        self.render_keys = []
+        self.render_templates = []
+        # Proxy sockets opened by the platform, they live as long as the launch
+        self.sockets = []
+        # Not os.getlogin(), py-docker-x11d has no controlling terminal
+        current_user = pwd.getpwuid(os.getuid()).pw_name
 
         if args.profile is not None:
             profile_user = args.profile
@@ -49,10 +67,11 @@ class Config:
             except IndexError:
                 tag = "latest"
 
-            if not client.images(name=image):
+            if not self.images.find(image, tag):
                 try:
                     print("Image not found locally, attempting pull from remote.")
                     client.pull(image, tag=tag)
+                    self.images.invalidate(image, tag)
                 except:
                     print("Requested image not found, and no local image found. Exiting.")
                     sys.exit(255)
@@ -61,12 +80,13 @@ class Config:
                     print("Pulling latest image from remote.")
                     print("tag is %s" % tag)
                     client.pull(image, tag=tag)
+                    self.images.invalidate(image, tag)
                 except:
                     print("Requested image found locally but not found in remote. Continuing.")
 
-            if client.inspect_image(image + ":" + tag)["ContainerConfig"]["Entrypoint"]:
-                print("Entrypoint is %s" % client.inspect_image(image + ":" + tag)["ContainerConfig"]["Entrypoint"])
-                entrypoint = client.inspect_image(image + ":" + tag)["ContainerConfig"]["Entrypoint"]
+            entrypoint = self.images.getConfigValue(image, tag, "Entrypoint", section="ContainerConfig")
+            if entrypoint:
+                print("Entrypoint is %s" % entrypoint)
             else:
                 entrypoint = None
 
@@ -74,8 +94,10 @@ class Config:
             image = None
             entrypoint = None
 
-        if image is not None and self._getDockerImageAppConfig(client, image, tag):
-            app_config = self._renderConfig(self._getDockerImageAppConfig(client, image, tag), **jinja_render_args)
+        image_app_config = self._getDockerImageAppConfig(image, tag) if image is not None else False
+
+        if image_app_config:
+            app_config = self._renderConfig(image_app_config, **jinja_render_args)
         else:
             app_dir = base_config["appDirs"].get("default", os.path.join(os.path.expanduser("~"), ".py-docker-x11", "apps"))
             app_config_yamlfile = self._getAppConfig(app_dir, args.app, args.platform)
@@ -103,7 +125,19 @@ class Config:
             profile_user = self.config["profileUser"]
             self.__init__(self, args.app, args.platform, profile_user)
 
-        self.config = self._mergeConfig(base_config, app_config, profile_config)
+        if None in self.render_keys:
+            # Something wasn't cacheable, so neither is the merge
+            merged_config = self._mergeConfig(base_config, app_config, profile_config)
+        else:
+            merge_key = self.render_cache.mergeKey(*self.render_keys)
+            cached, merged_config = self.render_cache.get(merge_key)
+            if not cached:
+                merged_config = self._mergeConfig(base_config, app_config, profile_config)
+                self.render_cache.set(merge_key, merged_config)
+                # Dropped along with the renders once any of the templates changes
+                for template in self.render_templates:
+                    self.render_cache.track(template, merge_key)
+        self.config = merged_config
 
         for name, dir in self.config["appDirs"].items():
             self.config["appDirs"][name] = os.path.expanduser(dir)
@@ -158,10 +192,17 @@ class Config:
 
         try:
             platform = importlib.import_module("platforms." + self.getPlatform())
-            platform.configure(self)
         except ModuleNotFoundError:
             print("Could not find the platform module for your platform! Please check the platforms directory and your configuration.")
             print("Continuing without configuring for the %s platform." % config.getPlatform())
+        else:
+            try:
+                platform.configure(self)
+            except BaseException:
+                # Apply what was queued while the proxy sockets still exist
+                user.flush_chown_batch()
+                self.closeSockets()
+                raise
 
     ### Based on https://stackoverflow.com/questions/7204805/how-to-merge-dictionaries-of-dictionaries/7205107#7205107
     def _mergeConfig(self, a, b, c=None):
@@ -196,14 +237,27 @@ class Config:
 
     def _renderConfig(self, yamlFile, **kwargs):
         # TODO: Validate for valid jinja2 + yaml
+        environment = _jinja_environment(os.path.dirname(os.path.abspath(yamlFile))) if isinstance(yamlFile, str) else None
+        source_key = self.render_cache.sourceKey(yamlFile, environment)
+        render_key = self.render_cache.renderKey(source_key, kwargs) if source_key is not None else None
+        self.render_keys.append(render_key)
+        self.render_templates.append(yamlFile)
+
+        if render_key is not None:
+            cached, rendered_yaml = self.render_cache.get(render_key)
+            if cached:
+                return rendered_yaml
+
         if isinstance(yamlFile, str):
-            template = jinja2.Environment(loader=jinja2.FileSystemLoader(os.path.dirname(os.path.abspath(yamlFile))))
-            rendered_jinja = template.get_template(os.path.basename(yamlFile)).render(kwargs)
+            rendered_jinja = environment.get_template(os.path.basename(yamlFile)).render(kwargs)
         elif isinstance(yamlFile, dict):
-            template = jinja2.Environment(loader=jinja2.DictLoader(yamlFile))
-            rendered_jinja = template.get_template("jinja").render(kwargs)
+            rendered_jinja = _jinja_string_environment.from_string(yamlFile["jinja"]).render(kwargs)
 
         rendered_yaml = yaml.load(rendered_jinja, Loader=yaml.SafeLoader)
+
+        if render_key is not None:
+            self.render_cache.set(render_key, rendered_yaml)
+            self.render_cache.track(yamlFile, render_key)
         return rendered_yaml
     
     def _getBaseConfig(self, base_dir):
@@ -220,23 +274,23 @@ class Config:
             print("[ERROR] Base config not found! Please put base_config.yaml in your ~/.py-docker-x11 directory.")
             sys.exit(1)
 
-    def _getDockerImageAppConfig(self, client, image, tag):
-        image_name = image + ":" + tag
+    def _getDockerImageAppConfig(self, image, tag):
         try:
-            for image in client.images(name=image_name):
-                if image_name in image["RepoTags"]:
-                    print("[INFO] Using attached Docker jinja template.")
-                    return { "jinja" : image["Labels"]["pdx-app-config"] }
+            app_config = self.images.getAppConfig(image, tag)
         except Exception as e:
             print("An error occured looking for the Docker image. Exiting.")
             print(str(e))
             sys.exit(1)
 
+        if app_config:
+            print("[INFO] Using attached Docker jinja template.")
+            return { "jinja" : app_config, "source" : "image:%s:%s" % (image, tag) }
+
         print("[INFO] Could not find jinja template attached to Docker image.")
         return False
   
-    def _getDockerInspect(self, client, image, tag):
-        return client.inspect_image(image + ":" + tag)
+    def _getDockerInspect(self, image, tag):
+        return self.images.inspect(image, tag)
 
     def _getAppConfig(self, app_dir, app="None", platform="None"):
     
@@ -350,6 +404,23 @@ class Config:
             print("Incorrect value passed to setMount. Check your configuration.")
             print("Exception: %s" % e)
 
+    def addSocket(self, socket):
+        self.sockets.append(socket)
+
+    def closeSockets(self):
+        for socket in self.sockets:
+            socket.close()
+        self.sockets = []
+
+    def getVolumes(self):
+        return self.config["container"].get("volumes") or {}
+
+    def setVolume(self, name, driver_opts):
+        # Named volumes of the "local" driver, created before the container
+        if self.config["container"].get("volumes") is None:
+            self.config["container"]["volumes"] = {}
+        self.config["container"]["volumes"][name] = driver_opts
+
     def setEnvironment(self, env):
         if self.config["container"].get("environment") is None:
             self.config["container"]["environment"] = {}
@@ -1,14 +1,17 @@
 import os, sys, time
 import stat
+import threading
 import docker
-import tarfile
-import io
-import glob, evdev
+import glob
 import re
-import dockerpty
-import subprocess
 from pathlib import Path
-from util import user
+from util import user, readiness, startup
+
+# Enumerating joysticks opens every evdev node. Plugging or unplugging a device
+# changes /dev/input, so the result is reused (by py-docker-x11d across
+# launches) until it does.
+_joysticks = None
+_joysticks_lock = threading.Lock()
 
 class Container:
     def __init__(self):
@@ -21,6 +24,7 @@ class Container:
         self.joystick = { "enabled": False }
         self.webcam = { "enabled": False }
         self.other_devices = {}
+        self.timings = {}
 
     def buildMounts(self):
 
@@ -52,7 +56,10 @@ class Container:
                 elif isinstance(mountpoint, dict):
                     print("Dict mount is %s" % str(mount))
                     self.mounts[mount] = mountpoint
-                    if mountpoint.get("type") == "file":
+                    if mountpoint.get("type") == "volume":
+                        # A named volume, created in createVolumes rather than on the host
+                        pass
+                    elif mountpoint.get("type") == "file":
                         # Prevents inability to start container because we're mounting a directory over a file
                         if not os.path.exists(str(mount)):
                                 mountfile = Path(str(mount))
@@ -147,7 +154,8 @@ class Container:
             for device in self.config.getDeviceConfig("other"):
                 self.mounts[device] = device
 
-    def runContainer(self, client):
+    def buildContainerArgs(self, client):
+        # Everything create_container needs, without touching the daemon
         self.container_config = self.config.getContainerConfig()
         container_args = {}
         container_config = {}
@@ -156,7 +164,9 @@ class Container:
         network_config = {}
 
         container_args["image"] = self.container_config["image"] + ":" + self.container_config.get("tag", "latest")
-        container_entrypoint = client.inspect_image(container_args["image"])["Config"]["Entrypoint"]
+        with startup.phase("image lookup"):
+            image_config = self.config.images.inspect(self.container_config["image"], self.container_config.get("tag", "latest")).get("Config") or {}
+        container_entrypoint = image_config.get("Entrypoint")
 
         if container_entrypoint and not self.container_config.get("entrypoint"):
             self.container_config["entrypoint"] = container_entrypoint
@@ -174,7 +184,7 @@ class Container:
             container_args["entrypoint"] = [ "/bin/sh", "-v", "-c" ]
             shell_entrypoint = True
 
-        container_command = client.inspect_image(container_args["image"])["Config"]["Cmd"]
+        container_command = image_config.get("Cmd")
 
         if container_command and not self.container_config.get("command"):
             self.container_config["command"] = container_command
@@ -291,8 +301,18 @@ class Container:
                 })
 
         print("Container args is %s" % container_args)
+        return container_args, host_config, networking_config
+
+    def createContainer(self, client, container_args, host_config, networking_config, name=None, labels=None):
+        self.createVolumes(client)
         print("Building container")
 
+        container_args = dict(container_args)
+        if name is not None:
+            container_args["name"] = name
+        if labels:
+            container_args["labels"] = labels
+
         # This is gross, FIXME
         if networking_config:
             container = client.create_container(**container_args, host_config=client.create_host_config(**host_config), networking_config=networking_config)
@@ -304,37 +324,80 @@ class Container:
         #     client.connect_container_to_network(container=container.get('Id'), **network_config)
 
         self.injectConfigs(client, container)
+        return container
+
+    def runContainer(self, client):
+        container_args, host_config, networking_config = self.buildContainerArgs(client)
+        container = self.createContainer(client, container_args, host_config, networking_config)
+        self.startContainer(client, container, container_args)
+
+    def startContainer(self, client, container, container_args, on_event=None):
+        # on_event("started") once the container runs, on_event("ready") once running_executable showed up
         # print("Running container with entrypoint %s: " % container_args["entrypoint"])
-        client.start(container=container.get('Id'))
+        with startup.phase("start"):
+            client.start(container=container.get('Id'))
+        self.timings["started"] = time.monotonic()
+        if on_event is not None:
+            on_event("started")
 
         # Check for the process
         if self.config.getAppConfig().get("running_executable") is not None and not self.container_config.get("stdin_open"):
 
-            while(True):
-                print("Waiting on the process %s to run post_run script..." % self.config.getAppConfig().get("running_executable"))
-                try:
-                    subprocess.check_output(["pgrep", self.config.getAppConfig().get("running_executable")])
-                    print("Found process, running script.")
-                    break
-                except Exception as e:
-                    print("Still waiting... %s" % e)
-                    time.sleep(5)
-                    continue
+            running_executable = self.config.getAppConfig().get("running_executable")
+            timeout = self.config.getAppConfig().get("running_executable_timeout", 300)
+            print("Waiting on the process %s to run post_run script..." % running_executable)
 
-            print("Running post_run script")
-            post_run_exec = client.exec_create(container=container.get('Id'), cmd=["/bin/bash", "-c", "${HOME}/post_run.sh"])
-            exec_start = client.exec_start(exec_id=post_run_exec, stream=True)
-
-            for msg in exec_start:
-                print(msg)
+            watcher = readiness.ContainerProcessWatcher(client, container.get('Id'))
+            started = time.monotonic()
+            if not watcher.wait_for_process(running_executable, timeout=timeout):
+                print("[WARN] Process %s did not appear within %ss or the container exited, skipping post_run script." % (running_executable, timeout))
+            else:
+                self.timings["ready"] = time.monotonic()
+                print("Found process after %.3fs, running script." % (time.monotonic() - started))
+                if on_event is not None:
+                    on_event("ready")
+                self.runPostRun(client, container)
 
         if container_args.get("stdin_open"):
             print("Entering interactive mode.")
+            import dockerpty
             dockerpty.start(client, container=container.get('Id'))
 
         client.wait(container=container.get('Id'))
 
+    def createVolumes(self, client):
+        for name, driver_opts in self.config.getVolumes().items():
+            try:
+                existing = client.inspect_volume(name)
+            except docker.errors.NotFound:
+                existing = None
+
+            if existing is not None and (existing.get("Options") or {}) == driver_opts:
+                continue
+
+            if existing is not None:
+                # Layers moved (e.g. a different base), the daemon only reads options at creation
+                print("Recreating volume %s with new options" % name)
+                try:
+                    client.remove_volume(name)
+                except docker.errors.APIError as e:
+                    print("[ERROR] Volume %s is still in use, can't update it: %s" % (name, e))
+                    sys.exit(1)
+
+            print("Creating volume %s" % name)
+            client.create_volume(name=name, driver="local", driver_opts=driver_opts, labels={ "pdx-managed" : "true" })
+
+    def runPostRun(self, client, container):
+        print("Running post_run script")
+        post_run_exec = client.exec_create(container=container.get('Id'), cmd=["/bin/bash", "-c", "${HOME}/post_run.sh"])
+        exec_start = client.exec_start(exec_id=post_run_exec, stream=True)
+
+        for msg in exec_start:
+            print(msg)
+
     def injectConfigs(self, client, container):
+        import io, tarfile
+
         for file, script in self.config.getScripts().items():
 
             current_script = script
@@ -375,6 +438,18 @@ class Container:
             return True
 
     def getJoysticks(self):
+        global _joysticks
+        try:
+            stamp = os.stat("/dev/input").st_mtime_ns
+        except OSError:
+            stamp = None
+        with _joysticks_lock:
+            if _joysticks is not None and _joysticks[0] == stamp:
+                return list(_joysticks[1]), list(_joysticks[2])
+
+        # evdev is only needed when joysticks are enabled
+        import evdev
+
         js_devices = glob.glob("/dev/input/js*")
         js_devices.sort()
 
@@ -395,6 +470,8 @@ class Container:
                 print("Found playstation joystick device at %s" % device.fn)
                 ev_devices.append(device.fn)
 
+        with _joysticks_lock:
+            _joysticks = (stamp, list(js_devices), list(ev_devices))
         return js_devices, ev_devices
 
     def get_device_cgroup_rule(self, device, mode="rmw"):
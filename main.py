@@ -1,9 +1,13 @@
 #!/usr/bin/env python3 
 import os
+import sys
+import time
 import argparse
-import pprint
-import configuration, supervisor 
-import docker
+from util import control, startup
+
+# Only what's needed to hand the launch to py-docker-x11d is imported up front.
+# docker, configuration (jinja2, yaml) and supervisor (container, psutil) are
+# imported once we know this process does the launch itself.
 
 def checkUser(user):
     # TODO: Ensure that the user specified is a user with appropriate subuid/gids, and is running Docker.
@@ -21,10 +25,12 @@ def parseArguments():
     parser.add_argument("-m", "--maintenance", action='store_true', help="Enter container in maintenance mode - changes any R/O mounts to R/W. Use for updating or installing software within a new bind mount")
     parser.add_argument("-n", "--norm", action='store_true', help="Do not remove container after termination.")
     parser.add_argument("--network", default=None, help="Specify the network to connect the container to.")
+    parser.add_argument("--no-daemon", action='store_true', help="Launch from this process even if py-docker-x11d is running.")
     parser.add_argument("--no-mount", action='store_true', help="Do not mount auxillary directories.")
     parser.add_argument("--no-state", action='store_true', help="Do not mount user state directory.")
     parser.add_argument("-p", "--profile", default=None, help="Specify the profile to run the program under.")
     parser.add_argument("--platform", default=None, help="Specify the platform that the application runs under")
+    parser.add_argument("--profile-startup", action='store_true', help="Launch from this process and report import time and the wall time of each startup phase.")
     parser.add_argument("--profiledir", default=None, help="Specify the directory that profiles are kept under")
     parser.add_argument("-s", "--subprofile", help="Specify the subprofile to run under for applications with subprofiles.")
     parser.add_argument("--socket", action='store_true', help="Specify Docker socket to run container under.")
@@ -39,39 +45,104 @@ def parseArguments():
 
     return args
 
+def dockerSocket(args):
+    if args.socket:
+        return args.socket
+    # return config.get("docker_socket")
+    # return "unix:///run/user/1001/docker.sock"
+    return "unix:///home/docker/sandbox/socket/docker.sock"
+
+def launch(args, client, listener=None, images=None, launched=None):
+    with startup.phase("import configuration"):
+        import configuration
+    with startup.phase("import supervisor"):
+        import supervisor
+    from util import user
+
+    # Profile setup queues its ownership changes, the supervisor applies them in one
+    # batch. A launch that bails out before that still gets them applied on the way out.
+    user.begin_chown_batch()
+    try:
+        with startup.phase("config render"):
+            config = configuration.Config(args, client, images=images)
+
+        try:
+            if args.debug == True:
+                import pprint
+                print("Run complete. Below is the complete config.")
+                pp = pprint.PrettyPrinter(indent=4)
+                pp.pprint(config)
+
+            for _, dir in config.get("appDirs").items():
+                if not os.path.exists(dir):
+                    print("Making directory %s" % dir)
+                    os.makedirs(dir)
+            if not os.path.exists(config.get("profileDir")):
+                os.makedirs(config.get("profileDir"))
+            if not os.path.exists(config.get("workDir")):
+                os.makedirs(config.get("workDir"))
+
+            print("Spawning new supervisor")
+            app = supervisor.Supervisor(config, client, launched=launched)
+            print("Running supervisor")
+            app.run(listener=listener)
+        finally:
+            # Before the proxy sockets it may have queued are removed
+            user.flush_chown_batch()
+            # Proxy listeners are shared with every other launch in py-docker-x11d
+            config.closeSockets()
+    finally:
+        user.flush_chown_batch()
+
+def forwardToDaemon(args):
+    # Returns the exit status if py-docker-x11d handled the launch, None to launch locally
+    if args.no_daemon or args.interactive or args.tty or args.profile_startup:
+        # Needs this terminal, or this process is what's being profiled
+        return None
+    if os.path.exists(os.path.join(os.getcwd(), "base_config.yaml")) or os.path.exists(os.path.join(os.getcwd(), "app_config.yaml")):
+        # Configs next to us take precedence, the daemon can't see our working directory
+        return None
+
+    sock = control.connect()
+    if sock is None:
+        return None
+
+    with sock:
+        control.send(sock, { "command" : "launch", "args" : vars(args) })
+        for reply in control.replies(sock):
+            if reply.get("output") is not None:
+                sys.stdout.write(reply["output"])
+            elif reply.get("event") == "started":
+                print("Started %s via py-docker-x11d" % reply["name"])
+            elif reply.get("event") == "exited":
+                return reply.get("status", 0)
+            elif reply.get("error"):
+                print("[ERROR] py-docker-x11d: %s" % reply["error"])
+                return 1
+    print("[ERROR] Lost the connection to py-docker-x11d")
+    return 1
+
 def main():
+    launched = time.monotonic()
 
-    print("Using docker-py version %s" % docker.version)
     args = parseArguments()
+    if args.profile_startup:
+        startup.enable()
 
-    if args.socket:
-        socket = args.socket
-    else:
-        # socket = config.get("docker_socket")
-        socket = "unix:///home/docker/sandbox/socket/docker.sock"
-        # socket = "unix:///run/user/1001/docker.sock"
-
-    client = docker.APIClient(base_url=socket)
-    config = configuration.Config(args, client)
-
-    if args.debug == True:
-        print("Run complete. Below is the complete config.")
-        pp = pprint.PrettyPrinter(indent=4)
-        pp.pprint(config)
-
-    for _, dir in config.get("appDirs").items():
-        if not os.path.exists(dir):
-            print("Making directory %s" % dir)
-            os.makedirs(dir)
-    if not os.path.exists(config.get("profileDir")):
-        os.makedirs(config.get("profileDir"))
-    if not os.path.exists(config.get("workDir")):
-        os.makedirs(config.get("workDir"))
-
-    print("Spawning new supervisor")
-    app = supervisor.Supervisor(config, client)
-    print("Running supervisor")
-    app.run()
+    status = forwardToDaemon(args)
+    if status is not None:
+        sys.exit(status)
+
+    with startup.phase("import docker"):
+        import docker
+    print("Using docker-py version %s" % docker.version)
+    client = docker.APIClient(base_url=dockerSocket(args))
+
+    def listener(event, name, container_id):
+        if event == "started":
+            startup.report()
+
+    launch(args, client, listener=listener if args.profile_startup else None, launched=launched)
 
 if __name__ == '__main__':
     main()
@@ -1,15 +1,13 @@
 import os
-import threading
 import time
-import shutil
-from util import user
+from util import user, provision
 from util import proxysocket 
 
 def create_socket(work_dir, socket_name, target_path, container_uid, container_gid):
 
+    # Connections are served from the shared proxy loop, listen() only binds and registers the socket
     socket = proxysocket.ProxySocket(os.path.join(work_dir, socket_name), target_path, container_uid, container_gid)
-    socket_thread = threading.Thread(target = socket.listen)
-    socket_thread.start()
+    socket.listen()
     return socket
 
 def configure(config):
@@ -77,7 +75,7 @@ def configure(config):
 
         if not os.path.exists(user_profile_directory):
             if default_profile_directory:
-                shutil.copytree(default_profile_directory, user_profile_directory, symlinks=True)
+                provision.provision_tree(default_profile_directory, user_profile_directory, config.get("profile_provisioning"))
                 if not os.path.exists(os.path.join(user_profile_directory, "state")):
                     os.makedirs(os.path.join(user_profile_directory, "state"))
                 user.chown(user_profile_directory, container_uid, container_gid, recursive=True, no_root_chown=True)
@@ -87,7 +85,7 @@ def configure(config):
 
         elif os.path.exists(user_profile_directory) and not os.path.exists(user_state_directory):
             if os.path.exists(os.path.join(default_state_directory)):
-                shutil.copytree(default_state_directory, user_state_directory, symlinks=True)
+                provision.provision_tree(default_state_directory, user_state_directory, config.get("profile_provisioning"))
                 user.chown(user_state_directory, container_uid, container_gid, recursive=True)
             else:
                 os.makedirs(user_state_directory)
@@ -105,21 +103,19 @@ def configure(config):
     else:
         work_dir = os.getenv("HOME")
 
-    sockets = []
-
     if config.get("platform_options", "socket_binds"):
         print("[DEBUG] - Got passed the platform options / socket binds check")
 
         if config.get("platform_options", "socket_binds", "docker"):
             print("[DEBUG] - Setting up Docker socket")
-            sockets.append(create_socket(work_dir, "docker-socket", "/var/run/docker.sock", 
-                                         container_uid, container_gid))
+            config.addSocket(create_socket(work_dir, "docker-socket", "/var/run/docker.sock", 
+                                           container_uid, container_gid))
             config.setMount({ os.path.join(work_dir, "docker-socket"): { "bind" : "/var/run/docker.sock", 
                               "mode" : "rw" }})
 
         if config.get("platform_options", "socket_binds", "system_dbus"):
             print("[DEBUG] - Setting up system dbus socket")
-            sockets.append(create_socket(work_dir, "system-dbus-socket", "/run/dbus/system_bus_socket", 
-                                         container_uid, container_gid))
+            config.addSocket(create_socket(work_dir, "system-dbus-socket", "/run/dbus/system_bus_socket", 
+                                           container_uid, container_gid))
             config.setMount({ os.path.join(work_dir, "system-dbus-socket"): { "bind" : "/run/dbus/system_bus_socket", 
                               "mode" : "rw" }})
@@ -1,7 +1,7 @@
 import os
 import sys
 import shutil
-from util import user
+from util import user, provision, overlay
 from pathlib import Path
 
 def convert_wine_to_profile(application_dir, user_wine_directory):
@@ -74,6 +74,14 @@ def configure(config):
         entrypoint = [ os.path.join(app_config["internal_app_dir"], app_config["exepath"], app_config["executable"]), 
                        app_config["programArgs"] ]
 
+    # One shared read-only wine-base plus a writable layer per profile, instead of a full copy each
+    layered_wine_base = False
+    if config.get("platform_options", "per_profile_wine_base") and config.get("platform_options", "layered_wine_base"):
+        if default_wine_directory:
+            layered_wine_base = True
+        else:
+            print("[WARN] layered_wine_base is set, but there is no default wine-base to layer on. Using a full copy.")
+
     if config.get("platform_options", "per_profile_wine_base"):
         if config.get("subprofileUser"):
             user_profile_directory = os.path.join(profile_directory, config.safe_get("profileUser"), platform_app_dir, config.safe_get("subprofileUser"))
@@ -82,13 +90,28 @@ def configure(config):
             user_profile_directory = os.path.join(profile_directory, config.safe_get("profileUser"), platform_app_dir)
             user_wine_directory = os.path.join(profile_directory, config.safe_get("profileUser"), platform_app_dir, "wine-base")
     
-        if not os.path.exists(user_wine_directory):
+        if layered_wine_base:
+            wine_upper_directory, wine_work_directory = overlay.layer_dirs(user_profile_directory)
+            for directory in (wine_upper_directory, wine_work_directory):
+                if not os.path.exists(directory):
+                    os.makedirs(directory)
+            user.chown(wine_upper_directory, container_uid, container_gid)
+
+            usage = overlay.layer_usage(wine_upper_directory)
+            print("WINE layer of %s: %d files (%.1f MB) written, %d deleted on top of %s" %
+                  (user_profile_directory, usage["files"], usage["bytes"] / 1048576, usage["deleted"], default_wine_directory))
+
+            # Mounted by the daemon when the container starts, see Container.createVolumes
+            wine_volume = overlay.volume_name(user_profile_directory)
+            config.setVolume(wine_volume, overlay.volume_options(default_wine_directory, wine_upper_directory, wine_work_directory))
+
+        elif not os.path.exists(user_wine_directory):
             if default_profile_directory and os.path.exists(default_profile_directory) and not os.path.exists(user_profile_directory) and os.path.exists(os.path.join(default_profile_directory, "wine-base")):
                 print("[DEBUG] - Not copying default wine directory from default wine directory as directory in default profile exists.")
             elif default_wine_directory:
                 print("[DEBUG] - Copying default wine directory to user wine directory for initial setup")
-                shutil.copytree(default_wine_directory, user_wine_directory, symlinks=True)
-                user.chown(default_wine_directory, user_wine_directory, recursive=True)
+                provision.provision_tree(default_wine_directory, user_wine_directory, config.get("profile_provisioning"))
+                user.chown(user_wine_directory, container_uid, container_gid, recursive=True)
             else:
                 print("[DEBUG] - Converting wine directory to new profile")
                 os.makedirs(user_wine_directory)
@@ -97,7 +120,12 @@ def configure(config):
 
     if config.get("appconfig", "app_data_src") == "mount".lower():
         if config.get("platform_options", "per_profile_wine_base") and not config.get("install"):
-            if config.get("platform_options", "protect_wine_base") and not config.get("maintenance"):
+            if layered_wine_base:
+                config.setMount({wine_volume :
+                                { "bind" : app_config["internal_app_dir"],
+                                  "mode" : "ro" if config.get("platform_options", "protect_wine_base") and not config.get("maintenance") else "rw",
+                                  "type" : "volume" }})
+            elif config.get("platform_options", "protect_wine_base") and not config.get("maintenance"):
                 config.setMount({user_wine_directory : 
                                 { "bind" : app_config["internal_app_dir"],
                                   "mode" : "ro" }})
@@ -188,7 +216,7 @@ def configure(config):
             if not os.path.exists(user_profile_directory):
                 if default_profile_directory:
                     print("[DEBUG] - Creating new user profile directory from default")
-                    shutil.copytree(default_profile_directory, user_profile_directory, symlinks=True)
+                    provision.provision_tree(default_profile_directory, user_profile_directory, config.get("profile_provisioning"))
                     if not os.path.exists(os.path.join(user_profile_directory, "state")):
                         os.makedirs(os.path.join(user_profile_directory, "state"))
                     user.chown(user_profile_directory, container_uid, container_gid, recursive=True)
@@ -200,7 +228,7 @@ def configure(config):
             elif os.path.exists(user_profile_directory) and not os.path.exists(user_state_directory):
                 if default_profile_directory and os.path.exists(os.path.join(default_profile_directory, "state")):
                     print("[DEBUG] - Copying state into existing user directory")
-                    shutil.copytree(default_state_directory, user_state_directory, symlinks=True)
+                    provision.provision_tree(default_state_directory, user_state_directory, config.get("profile_provisioning"))
                     user.chown(user_state_directory, container_uid, container_gid, recursive=True)
                 else:
                     print("[DEBUG] - Creating new state in existing user directory")
@@ -0,0 +1,78 @@
+import os
+import json
+import threading
+import docker
+from util.cache import hash_key
+
+# Pre-created containers for an app/profile, so that a launch only has to start
+# one. Pool containers are created with everything a cold launch would use
+# (mounts, devices, injected scripts) under a placeholder name and labelled with
+# a hash of that spec. Claiming one renames it to the real name; anything whose
+# spec no longer matches (new image, changed mounts, ...) is thrown away.
+
+POOL_LABEL = "pdx-pool"
+POOL_FOR_LABEL = "pdx-pool-for"
+
+class ContainerPool:
+    def __init__(self, client, container, size):
+        self.client = client
+        self.container = container
+        self.size = size
+        self.thread = None
+
+    def key(self, config, container_args, host_config, networking_config):
+        image, tag = config.get("container", "image"), config.get("container", "tag") or "latest"
+        spec = {
+            "image" : config.images.inspect(image, tag).get("Id"),
+            "container_args" : container_args,
+            "host_config" : host_config,
+            "networking_config" : networking_config,
+            "scripts" : config.getScripts(),
+        }
+        return hash_key(json.dumps(spec, sort_keys=True, default=str))
+
+    def _pooled(self, name):
+        containers = self.client.containers(all=True, filters={ "label" : POOL_FOR_LABEL + "=" + name })
+        return [container for container in containers if container.get("State") == "created" and container["Names"] != ["/" + name]]
+
+    def claim(self, name, key):
+        for container in self._pooled(name):
+            if (container.get("Labels") or {}).get(POOL_LABEL) != key:
+                continue
+            try:
+                # Only one launcher can rename it to the real name, that's the claim
+                self.client.rename(container["Id"], name)
+            except docker.errors.APIError:
+                continue
+            print("Claimed pre-warmed container %s" % container["Id"][:12])
+            return { "Id" : container["Id"] }
+        return None
+
+    def replenish(self, name, key, container_args, host_config, networking_config):
+        fresh = 0
+        for container in self._pooled(name):
+            if (container.get("Labels") or {}).get(POOL_LABEL) == key:
+                fresh += 1
+                continue
+            print("Removing stale pre-warmed container %s" % container["Id"][:12])
+            try:
+                self.client.remove_container(container["Id"], force=True)
+            except docker.errors.APIError as e:
+                print("[WARN] Could not remove stale pre-warmed container: %s" % e)
+
+        for _ in range(self.size - fresh):
+            try:
+                self.container.createContainer(self.client, container_args, host_config, networking_config,
+                                               name=name + "-pool-" + os.urandom(4).hex(),
+                                               labels={ POOL_LABEL : key, POOL_FOR_LABEL : name })
+            except docker.errors.APIError as e:
+                print("[WARN] Could not pre-warm a container for %s: %s" % (name, e))
+                break
+
+    def replenish_async(self, *args):
+        self.thread = threading.Thread(target=self.replenish, args=args)
+        self.thread.start()
+
+    def join(self):
+        if self.thread is not None:
+            self.thread.join()
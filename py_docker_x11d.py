@@ -0,0 +1,203 @@
+#!/usr/bin/env python3
+import os
+import sys
+import json
+import time
+import argparse
+import threading
+import traceback
+import socketserver
+import docker
+import main as launcher
+# main.py defers these until it has to launch itself, the daemon pays for them once
+import configuration, supervisor
+from util.output import ThreadStdout
+from util import control, imagecache
+
+# py-docker-x11d: keeps the interpreter, the docker connection, the jinja
+# environments and the image/config caches warm, and launches apps for main.py
+# over a unix socket. Every request is one JSON line:
+#
+#   {"command": "launch", "args": {...main.py arguments...}}
+#       -> {"output": "..."} ... {"event": "started", "name": ..., "id": ...} ... {"event": "exited", "status": 0}
+#   {"command": "stop", "name": "linux-firefox-user"}
+#   {"command": "list"}
+#   {"command": "status"}
+#
+# Errors come back as {"error": "..."}. Launches are supervised concurrently, one
+# thread per connection, and whatever a launch prints is relayed to its client
+# (and kept in the daemon's own output).
+
+class _ReplyOutput:
+    # Written to by the launch's thread, sent to the client a line at a time
+    def __init__(self, handler):
+        self.handler = handler
+        self.buffer = ""
+
+    def write(self, data):
+        self.buffer += data
+        if "\n" in self.buffer:
+            lines, self.buffer = self.buffer.rsplit("\n", 1)
+            self.handler.reply({ "output" : lines + "\n" })
+        return len(data)
+
+    def flush(self):
+        if self.buffer:
+            self.handler.reply({ "output" : self.buffer })
+            self.buffer = ""
+
+class ControlHandler(socketserver.StreamRequestHandler):
+    def reply(self, message):
+        try:
+            self.wfile.write((json.dumps(message) + "\n").encode('utf-8'))
+            self.wfile.flush()
+        except OSError:
+            # The client went away, the launch carries on regardless
+            pass
+
+    def handle(self):
+        try:
+            request = json.loads(self.rfile.readline())
+        except ValueError:
+            self.reply({ "error" : "Invalid request" })
+            return
+
+        command = getattr(self.server, "command_" + str(request.get("command")), None)
+        if command is None:
+            self.reply({ "error" : "Unknown command %s" % request.get("command") })
+            return
+
+        try:
+            command(self, request)
+        except Exception as e:
+            traceback.print_exc()
+            self.reply({ "error" : str(e) })
+
+class Daemon(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path, client):
+        self.client = client
+        self.images = imagecache.ImageCache(client)
+        self.started = time.time()
+        self.launches = {}
+        self.launch_count = 0
+        self.lock = threading.Lock()
+        # Only the owner may connect; a chmod after bind() would leave a window
+        umask = os.umask(0o177)
+        try:
+            socketserver.UnixStreamServer.__init__(self, path, ControlHandler)
+        finally:
+            os.umask(umask)
+
+    def command_launch(self, handler, request):
+        launched = time.monotonic()
+        args = argparse.Namespace(**request["args"])
+        current = {}
+
+        def listener(event, name, container_id):
+            with self.lock:
+                self.launches[name] = { "name" : name, "id" : container_id, "image" : args.image, "started" : time.time(), "status" : event }
+            current["name"] = name
+            if event == "started":
+                handler.reply({ "event" : "started", "name" : name, "id" : container_id })
+
+        with self.lock:
+            self.launch_count += 1
+
+        stdout = sys.stdout
+        stdout.local.log = _ReplyOutput(handler)
+        stdout.local.echo = True
+        status = 0
+        try:
+            launcher.launch(args, self.client, listener=listener, images=self.images, launched=launched)
+        except SystemExit as e:
+            status = e.code if isinstance(e.code, int) else 1
+        finally:
+            stdout.local.log.flush()
+            stdout.local.log = None
+            with self.lock:
+                self.launches.pop(current.get("name"), None)
+        handler.reply({ "event" : "exited", "status" : status })
+
+    def watch_images(self):
+        # Builds, pulls and removals move tags, the cached tag lookups go with them
+        while True:
+            try:
+                for event in self.client.events(decode=True, filters={ "type" : "image" }):
+                    self.images.clear()
+            except Exception as e:
+                print("[WARN] Lost the docker event stream, retrying: %s" % e)
+            self.images.clear()
+            time.sleep(1)
+
+    def command_stop(self, handler, request):
+        with self.lock:
+            launch = self.launches.get(request.get("name"))
+        target = launch["id"] if launch else request.get("name")
+        self.client.stop(target)
+        handler.reply({ "stopped" : request.get("name") })
+
+    def command_list(self, handler, request):
+        with self.lock:
+            launches = list(self.launches.values())
+        handler.reply({ "launches" : launches })
+
+    def command_status(self, handler, request):
+        with self.lock:
+            running = len(self.launches)
+        handler.reply({
+            "pid" : os.getpid(),
+            "uptime" : time.time() - self.started,
+            "running" : running,
+            "launches" : self.launch_count,
+            "docker" : self.client.version().get("Version"),
+        })
+
+def serve(args):
+    path = control.socket_path()
+    if os.path.exists(path):
+        sock = control.connect(path)
+        if sock is not None:
+            sock.close()
+            print("py-docker-x11d is already running on %s" % path)
+            sys.exit(1)
+        # Left behind by a daemon that didn't shut down cleanly
+        os.unlink(path)
+
+    # Launch output goes back to whoever asked for the launch
+    sys.stdout = ThreadStdout(sys.stdout)
+    client = docker.APIClient(base_url=launcher.dockerSocket(args))
+    server = Daemon(path, client)
+    threading.Thread(target=server.watch_images, daemon=True).start()
+    print("py-docker-x11d listening on %s" % path)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.unlink(path)
+
+def main():
+    parser = argparse.ArgumentParser(prog="py-docker-x11d")
+    parser.add_argument("--socket", default=None, help="Docker socket to use.")
+    parser.add_argument("command", nargs="?", default="serve", choices=["serve", "list", "status", "stop"], help="Run the daemon, or query a running one")
+    parser.add_argument("name", nargs="?", default=None, help="Container to stop")
+    args = parser.parse_args()
+
+    if args.command == "serve":
+        serve(args)
+        return
+
+    replies = control.request(args.command, name=args.name)
+    if replies is None:
+        print("py-docker-x11d is not running")
+        sys.exit(1)
+    for reply in replies:
+        print(json.dumps(reply, indent=2))
+        if reply.get("error"):
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -1,35 +1,117 @@
+import os
+import time
+import signal
+import subprocess
+import psutil
 import container
-import daemon
+from pool import ContainerPool
+from util import user, readiness, startup
+from util.cache import DiskCache
 
 class Supervisor:
-    def __init__(self, config, client):
+    def __init__(self, config, client, launched=None):
         self.client = client
         self.config = config
+        # time.monotonic() when the launch was asked for, latencies are measured from it
+        self.launched = launched if launched is not None else time.monotonic()
         self.container = container.Container()
-        self.htpc_enabled, self_htpc_binary = config.getHTPCConfig()
+        self.htpc_enabled, self.htpc_binary = config.getHTPCConfig()
 
-    def controlHTPC(self, command):
+    def controlHTPC(self, command, timeout=5):
         try:
             # Some versions of some HTPC software still receive events when they lose focus
             # So let's stop/start the process to get around this.
-            pid = int(subprocess.check_output(["pidof", self.htpc_binary]))
+            pid = int(subprocess.check_output(["pidof", "-s", self.htpc_binary]))
             signals = { "stop" : signal.SIGSTOP, "start" : signal.SIGCONT }
             os.kill(pid, signals[command])
         except:
             print("HTPC process not found. Ignoring control command: %s" % command)
+            return False
 
-    def run(self):
+        # Don't hand the screen over (or back) until the signal has actually taken effect
+        if command == "stop":
+            condition = lambda: process.status() == psutil.STATUS_STOPPED
+        else:
+            condition = lambda: process.status() != psutil.STATUS_STOPPED
+
+        try:
+            process = psutil.Process(pid)
+            if not readiness.wait_for(condition, timeout=timeout):
+                print("[WARN] HTPC process did not %s within %ss" % (command, timeout))
+                return False
+        except psutil.NoSuchProcess:
+            print("HTPC process exited while handling control command: %s" % command)
+            return False
+        return True
+
+    def poolSize(self, container_args):
+        # Interactive and maintenance sessions always get a fresh container
+        if container_args.get("stdin_open") or container_args.get("tty") or self.config.get("maintenance") or self.config.get("install"):
+            return 0
+        return self.config.get("container", "prewarm") or 0
+
+    def reportLatency(self, name, mode, event):
+        launched = self.launched
+        latency = self.container.timings[event] - launched
+        running_executable = self.config.getAppConfig().get("running_executable")
+        if event == "ready":
+            print("[INFO] %s launch: %s running %.2fs after launch (container started after %.2fs)" %
+                  (mode, running_executable, latency, self.container.timings["started"] - launched))
+        else:
+            print("[INFO] %s launch: container started %.2fs after launch" % (mode, latency))
+
+        history = DiskCache("launch_latency")
+        entries = (history.get(name, []) + [(mode, event, latency)])[-20:]
+        history.set(name, entries)
+        for other in ("cold", "pooled"):
+            samples = [entry[2] for entry in entries if entry[0] == other and entry[1] == event]
+            if samples and other != mode:
+                print("[INFO] %s launches of %s averaged %.2fs over the last %d" % (other, name, sum(samples) / len(samples), len(samples)))
+
+    def run(self, listener=None):
+        # listener(event, name, container_id) is told when the container "started" and is "ready"
         self.container.setConfig(self.config)
-        self.container.buildMounts()
+        with startup.phase("mount setup"):
+            self.container.buildMounts()
+            user.flush_chown_batch()
         # self.container.buildWrapper()
 
         if self.htpc_enabled == True:
             self.controlHTPC("stop")
 
-        # with daemon.DaemonContext():
-        self.container.runContainer(self.client)
+        container_args, host_config, networking_config = self.container.buildContainerArgs(self.client)
+        name = container_args["name"]
+        pool = None
+        mode = "cold"
+        container = None
+
+        pool_size = self.poolSize(container_args)
+        if pool_size:
+            pool = ContainerPool(self.client, self.container, pool_size)
+            with startup.phase("pool claim"):
+                key = pool.key(self.config, container_args, host_config, networking_config)
+                container = pool.claim(name, key)
+            if container is not None:
+                mode = "pooled"
+
+        if container is None:
+            with startup.phase("create"):
+                container = self.container.createContainer(self.client, container_args, host_config, networking_config)
+
+        def on_event(event):
+            if event == "started" and pool is not None:
+                # Refill while the app runs, the next launch finds its container waiting
+                pool.replenish_async(name, key, container_args, host_config, networking_config)
+            if event == "ready" or self.config.getAppConfig().get("running_executable") is None:
+                self.reportLatency(name, mode, event)
+            if listener is not None:
+                listener(event, name, container["Id"])
+
+        self.container.startContainer(self.client, container, container_args, on_event=on_event)
         # self.monitorContainer(self.container)
         
         if self.htpc_enabled == True:
             self.controlHTPC("start")
 
+        if pool is not None:
+            pool.join()
@@ -0,0 +1,161 @@
+import os
+import json
+import hashlib
+import tempfile
+import threading
+import unittest
+from unittest import mock
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from build import download
+
+# Run from the repository root: python -m unittest discover tests
+
+PAYLOAD = bytes(range(256)) * 4096
+PAYLOAD_SHA256 = hashlib.sha256(PAYLOAD).hexdigest()
+
+class _Handler(BaseHTTPRequestHandler):
+    # What the server does is set per test on the server object
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server
+        server.requests.append((self.path, dict(self.headers)))
+
+        if self.path.startswith("/repos/"):
+            return self._release()
+        if server.status is not None:
+            self.send_response(server.status)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+
+        body = PAYLOAD
+        range_header = self.headers.get("Range")
+        if range_header and server.honour_range:
+            start = int(range_header[len("bytes="):].rstrip("-"))
+            if start >= len(PAYLOAD):
+                self.send_response(416)
+                self.send_header("Content-Range", "bytes */%d" % len(PAYLOAD))
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            body = PAYLOAD[start:]
+            self.send_response(206)
+            self.send_header("Content-Range", "bytes %d-%d/%d" % (start, len(PAYLOAD) - 1, len(PAYLOAD)))
+        else:
+            self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _release(self):
+        if self.headers.get("If-None-Match") == '"v1"':
+            self.send_response(304)
+            self.end_headers()
+            return
+        body = json.dumps({ "tag_name" : "v1", "assets" : [] }).encode()
+        self.send_response(200)
+        self.send_header("ETag", '"v1"')
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+class DownloadTest(unittest.TestCase):
+    def setUp(self):
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), _Handler)
+        self.server.requests = []
+        self.server.status = None
+        self.server.honour_range = True
+        self.thread = threading.Thread(target=self.server.serve_forever, kwargs={ "poll_interval" : 0.05 }, daemon=True)
+        self.thread.start()
+        self.url = "http://127.0.0.1:%d/file.bin" % self.server.server_address[1]
+
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, "file.bin")
+        self.part_path = self.path + ".part"
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.tmp.cleanup()
+
+    def _write(self, path, data):
+        with open(path, 'wb') as f:
+            f.write(data)
+
+    def _read(self, path):
+        with open(path, 'rb') as f:
+            return f.read()
+
+    def test_fresh_download(self):
+        self.assertTrue(download.download(self.url, self.path, size=len(PAYLOAD), sha256=PAYLOAD_SHA256))
+        self.assertEqual(self._read(self.path), PAYLOAD)
+        self.assertFalse(os.path.exists(self.part_path))
+
+    def test_resume_with_206(self):
+        self._write(self.part_path, PAYLOAD[:1000])
+        self.assertTrue(download.download(self.url, self.path, size=len(PAYLOAD), sha256=PAYLOAD_SHA256))
+        self.assertEqual(self.server.requests[-1][1].get("Range"), "bytes=1000-")
+        self.assertEqual(self._read(self.path), PAYLOAD)
+
+    def test_restart_when_range_is_ignored(self):
+        self.server.honour_range = False
+        self._write(self.part_path, b"stale" * 100)
+        self.assertTrue(download.download(self.url, self.path, size=len(PAYLOAD), sha256=PAYLOAD_SHA256))
+        self.assertEqual(self._read(self.path), PAYLOAD)
+
+    def test_416_with_complete_part(self):
+        self._write(self.part_path, PAYLOAD)
+        self.assertTrue(download.download(self.url, self.path, sha256=PAYLOAD_SHA256))
+        self.assertEqual(self.server.requests[-1][1].get("Range"), "bytes=%d-" % len(PAYLOAD))
+        self.assertEqual(self._read(self.path), PAYLOAD)
+
+    def test_404_raises_and_keeps_part(self):
+        self.server.status = 404
+        self._write(self.part_path, PAYLOAD[:1000])
+        with self.assertRaises(download.DownloadError):
+            download.download(self.url, self.path)
+        self.assertFalse(os.path.exists(self.path))
+        self.assertEqual(self._read(self.part_path), PAYLOAD[:1000])
+
+    def test_404_without_part(self):
+        self.server.status = 404
+        with self.assertRaises(download.DownloadError):
+            download.download(self.url, self.path, size=len(PAYLOAD))
+        self.assertFalse(os.path.exists(self.path))
+        self.assertFalse(os.path.exists(self.part_path))
+
+    def test_checksum_mismatch(self):
+        with self.assertRaises(download.DownloadError):
+            download.download(self.url, self.path, sha256="0" * 64)
+        self.assertFalse(os.path.exists(self.path))
+        self.assertFalse(os.path.exists(self.part_path))
+
+    def test_existing_file_is_kept_when_it_verifies(self):
+        self._write(self.path, PAYLOAD)
+        self.assertFalse(download.download(self.url, self.path, size=len(PAYLOAD), sha256=PAYLOAD_SHA256))
+        self.assertEqual(self.server.requests, [])
+
+    def test_existing_file_with_wrong_hash_is_replaced(self):
+        # Same size, different content: only the hash can tell
+        self._write(self.path, bytes(len(PAYLOAD)))
+        self.assertTrue(download.download(self.url, self.path, size=len(PAYLOAD), sha256=PAYLOAD_SHA256))
+        self.assertEqual(self._read(self.path), PAYLOAD)
+
+    def test_release_metadata_uses_etag(self):
+        from build import build_deps
+        from util.cache import DiskCache
+
+        api = "http://127.0.0.1:%d" % self.server.server_address[1]
+        cache = DiskCache("github_releases", self.tmp.name)
+        with mock.patch.object(build_deps, "GITHUB_API", api), mock.patch.object(build_deps, "_release_cache", cache):
+            first = build_deps.get_github_release("owner/repo", "latest")
+            second = build_deps.get_github_release("owner/repo", "latest")
+
+        self.assertEqual(first, second)
+        self.assertNotIn("If-None-Match", self.server.requests[0][1])
+        self.assertEqual(self.server.requests[1][1].get("If-None-Match"), '"v1"')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,127 @@
+import json
+import threading
+import unittest
+from urllib.parse import urlparse, parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import docker
+from build.push import PushStage
+
+# Run from the repository root: python -m unittest discover tests
+
+class _Handler(BaseHTTPRequestHandler):
+    # Stands in for the docker daemon's push endpoint, replaying the progress
+    # stream set per image on the server object
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        # docker-py sends a JSON body and keeps the connection open for the next push
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        url = urlparse(self.path)
+        parts = url.path.split("/")
+        if parts[-1] != "push" or "images" not in parts:
+            self.send_response(404)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+
+        repository = "/".join(parts[parts.index("images") + 1:-1])
+        image = repository + ":" + parse_qs(url.query)["tag"][0]
+        self.server.requests.append(image)
+
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        for message in self.server.streams[image]:
+            data = (json.dumps(message) + "\r\n").encode()
+            self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+        self.wfile.write(b"0\r\n\r\n")
+
+def _progress(layer, current, total):
+    return { "status" : "Pushing", "id" : layer, "progressDetail" : { "current" : current, "total" : total } }
+
+class PushStageTest(unittest.TestCase):
+    def setUp(self):
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), _Handler)
+        self.server.requests = []
+        self.server.streams = {}
+        self.thread = threading.Thread(target=self.server.serve_forever, kwargs={ "poll_interval" : 0.05 }, daemon=True)
+        self.thread.start()
+        self.client = docker.APIClient(base_url="tcp://127.0.0.1:%d" % self.server.server_address[1], version="1.41")
+
+    def tearDown(self):
+        self.client.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_layers_count_by_final_status(self):
+        self.server.streams["registry.local/app:latest"] = [
+            { "status" : "The push refers to repository [registry.local/app]" },
+            { "status" : "Preparing", "id" : "aaa" },
+            { "status" : "Preparing", "id" : "bbb" },
+            { "status" : "Preparing", "id" : "ccc" },
+            { "status" : "Preparing", "id" : "ddd" },
+            _progress("bbb", 512, 1000),
+            _progress("bbb", 1000, 1000),
+            # Small layers often finish without a single progress event
+            { "status" : "Pushed", "id" : "aaa" },
+            { "status" : "Pushed", "id" : "bbb" },
+            { "status" : "Layer already exists", "id" : "ccc" },
+            { "status" : "Mounted from library/base", "id" : "ddd" },
+            { "status" : "latest: digest: sha256:0 size: 1234" },
+        ]
+        stage = PushStage(self.client)
+        stage.submit("registry.local/app:latest")
+        self.assertTrue(stage.close())
+
+        result = stage.results["registry.local/app:latest"]
+        self.assertIsNone(result["error"])
+        self.assertEqual(result["layers_pushed"], 2)
+        self.assertEqual(result["bytes_pushed"], 1000)
+        self.assertEqual(result["layers_skipped"], 2)
+
+    def test_child_skips_layers_pushed_by_parent(self):
+        self.server.streams["registry.local/base:latest"] = [
+            { "status" : "Preparing", "id" : "aaa" },
+            _progress("aaa", 4096, 4096),
+            { "status" : "Pushed", "id" : "aaa" },
+        ]
+        self.server.streams["registry.local/app:latest"] = [
+            { "status" : "Preparing", "id" : "aaa" },
+            { "status" : "Preparing", "id" : "bbb" },
+            { "status" : "Layer already exists", "id" : "aaa" },
+            _progress("bbb", 10, 10),
+            { "status" : "Pushed", "id" : "bbb" },
+        ]
+        stage = PushStage(self.client, jobs=2)
+        stage.submit("registry.local/base:latest")
+        stage.submit("registry.local/app:latest", parents=["registry.local/base:latest"])
+        self.assertTrue(stage.close())
+
+        self.assertEqual(self.server.requests, ["registry.local/base:latest", "registry.local/app:latest"])
+        result = stage.results["registry.local/app:latest"]
+        self.assertEqual(result["layers_pushed"], 1)
+        self.assertEqual(result["bytes_pushed"], 10)
+        self.assertEqual(result["layers_skipped"], 1)
+        self.assertEqual(result["bytes_skipped"], 4096)
+
+    def test_error_fails_the_push(self):
+        self.server.streams["registry.local/app:latest"] = [
+            { "status" : "Preparing", "id" : "aaa" },
+            { "errorDetail" : { "message" : "denied: requested access to the resource is denied" },
+              "error" : "denied: requested access to the resource is denied" },
+        ]
+        done = []
+        stage = PushStage(self.client)
+        stage.submit("registry.local/app:latest", on_done=lambda image, result: done.append(image))
+        self.assertFalse(stage.close())
+
+        self.assertEqual(done, ["registry.local/app:latest"])
+        self.assertIn("denied", stage.results["registry.local/app:latest"]["error"])
+        self.assertEqual(stage.results["registry.local/app:latest"]["layers_pushed"], 0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,79 @@
+import os
+import tempfile
+import unittest
+from build.scripts import ScriptRunner
+from util.cache import DiskCache
+
+# Run from the repository root: python -m unittest discover tests
+
+class ScriptOrderTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.build_dir = os.path.join(self.tmp.name, "app")
+        os.makedirs(os.path.join(self.build_dir, "scripts"))
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def _script(self, name, body):
+        path = os.path.join(self.build_dir, "scripts", name)
+        with open(path, "w") as f:
+            f.write("#!/bin/sh\nset -e\n" + body + "\n")
+        os.chmod(path, 0o755)
+
+    def _runner(self, scripts):
+        runner = ScriptRunner(scripts, self.build_dir, log_dir=os.path.join(self.tmp.name, "logs"), jobs=4, force=True)
+        runner.cache = DiskCache("script_runs", os.path.join(self.tmp.name, "cache"))
+        return runner
+
+    def _parents(self, runner, name):
+        return sorted(parent for parent in runner.dag.nodes if name in runner.dag.children_of(parent))
+
+    def test_parallel_script_does_not_reorder_the_next_one(self):
+        self._script("fetch.sh", "sleep 0.3\ntouch fetched")
+        self._script("fonts.sh", "touch fonts")
+        self._script("unpack.sh", "test -f fetched\ntest -f fonts")
+        runner = self._runner([
+            { "script" : "fetch.sh" },
+            { "script" : "fonts.sh", "parallel" : True },
+            { "script" : "unpack.sh" },
+        ])
+
+        self.assertEqual(self._parents(runner, "fonts.sh"), [])
+        self.assertEqual(self._parents(runner, "unpack.sh"), ["fetch.sh", "fonts.sh"])
+        self.assertTrue(runner.run())
+        self.assertEqual(runner.results, { "fetch.sh" : "success", "fonts.sh" : "success", "unpack.sh" : "success" })
+
+    def test_depends_on_script_is_waited_for_by_the_next_one(self):
+        self._script("a.sh", "touch a")
+        self._script("b.sh", "sleep 0.2\ntouch b")
+        self._script("c.sh", "touch c")
+        self._script("d.sh", "test -f b\ntest -f c")
+        runner = self._runner([
+            { "script" : "a.sh" },
+            { "script" : "b.sh" },
+            { "script" : "c.sh", "depends_on" : ["a.sh"] },
+            { "script" : "d.sh" },
+        ])
+
+        self.assertEqual(self._parents(runner, "c.sh"), ["a.sh"])
+        self.assertEqual(self._parents(runner, "d.sh"), ["b.sh", "c.sh"])
+        self.assertTrue(runner.run())
+
+    def test_failure_skips_later_scripts(self):
+        self._script("fetch.sh", "exit 1")
+        self._script("fonts.sh", "true")
+        self._script("unpack.sh", "true")
+        runner = self._runner([
+            { "script" : "fetch.sh" },
+            { "script" : "fonts.sh", "parallel" : True },
+            { "script" : "unpack.sh" },
+        ])
+
+        self.assertFalse(runner.run())
+        self.assertEqual(runner.results["fetch.sh"], "failed")
+        self.assertEqual(runner.results["fonts.sh"], "success")
+        self.assertEqual(runner.results["unpack.sh"], "skipped")
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,55 @@
+import os
+import pickle
+import hashlib
+import tempfile
+
+# Small on-disk key/value store for things that are expensive to look up on every
+# launch (image metadata, rendered configs, ...). One pickle per key, written
+# atomically so that a crashed run never leaves a half-written entry behind.
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".py-docker-x11", "cache")
+
+def hash_key(*parts):
+    digest = hashlib.sha256()
+    for part in parts:
+        if isinstance(part, bytes):
+            digest.update(part)
+        else:
+            digest.update(str(part).encode('utf-8'))
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+class DiskCache:
+    def __init__(self, name, cache_dir=None):
+        if cache_dir is None:
+            cache_dir = DEFAULT_CACHE_DIR
+        self.path = os.path.join(os.path.expanduser(cache_dir), name)
+
+    def _entry_path(self, key):
+        return os.path.join(self.path, hash_key(key))
+
+    def get(self, key, default=None):
+        try:
+            with open(self._entry_path(key), 'rb') as f:
+                return pickle.load(f)
+        except FileNotFoundError:
+            return default
+        except Exception as e:
+            print("[WARN] Ignoring unreadable cache entry in %s: %s" % (self.path, e))
+            return default
+
+    def set(self, key, value):
+        try:
+            os.makedirs(self.path, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=self.path, prefix=".tmp-")
+            with os.fdopen(fd, 'wb') as f:
+                pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, self._entry_path(key))
+        except OSError as e:
+            print("[WARN] Unable to write cache entry to %s: %s" % (self.path, e))
+
+    def delete(self, key):
+        try:
+            os.unlink(self._entry_path(key))
+        except FileNotFoundError:
+            pass
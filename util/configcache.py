@@ -0,0 +1,151 @@
+import os
+import jinja2
+import jinja2.meta
+from util.cache import DiskCache, hash_key
+
+# Caches the output of Config._renderConfig (and the merged config built from it)
+# so that an unchanged base/app/profile combination skips Jinja and YAML entirely.
+# Rendered entries are keyed by the template source hash, the hashes of every
+# template it pulls in ({% include %}, {% import %}, {% extends %}) and the
+# render arguments. Source hashes of template files are indexed by path and only
+# recomputed when the file's mtime/size/inode change, at which point every entry
+# rendered or merged from the old source is dropped. Templates attached to images
+# are indexed by image name the same way, so a rebuilt image replaces its entries.
+
+class RenderCache:
+    def __init__(self, cache_dir=None):
+        self.rendered = DiskCache("rendered_configs", cache_dir)
+        self.sources = DiskCache("config_sources", cache_dir)
+
+    def _stamp(self, path):
+        st = os.stat(path)
+        return (st.st_mtime_ns, st.st_size, st.st_ino)
+
+    def _invalidate(self, name, entry):
+        print("[DEBUG] %s changed since it was last rendered, invalidating cached configs." % name)
+        for key in entry["keys"]:
+            self.rendered.delete(key)
+
+    def _references(self, source, root, environment):
+        # Paths of the templates source pulls in, None if one is only known at render time
+        if environment is None:
+            return []
+        try:
+            names = list(jinja2.meta.find_referenced_templates(environment.parse(source.decode('utf-8'))))
+        except (jinja2.TemplateSyntaxError, UnicodeDecodeError):
+            # Rendering reports it
+            return []
+        if None in names:
+            return None
+        # The loader resolves every name against the top-level template's directory
+        return sorted(set(os.path.join(root, name) for name in names))
+
+    def _fileEntry(self, path, root, environment):
+        stamp = self._stamp(path)
+        entry = self.sources.get(path)
+
+        if entry is not None and entry["stamp"] == stamp:
+            if entry.get("root") == root:
+                return entry
+            # Same file reached from another template directory, only its references move
+            with open(path, 'rb') as f:
+                entry["deps"] = self._references(f.read(), root, environment)
+            entry["root"] = root
+            self.sources.set(path, entry)
+            return entry
+
+        if entry is not None:
+            self._invalidate(path, entry)
+
+        with open(path, 'rb') as f:
+            source = f.read()
+
+        entry = {
+            "stamp" : stamp,
+            "digest" : hash_key("file", path, source),
+            "root" : root,
+            "deps" : self._references(source, root, environment),
+            "keys" : [],
+        }
+        self.sources.set(path, entry)
+        return entry
+
+    def _fileKey(self, path, root, environment, visiting):
+        # Digest of a template and everything it pulls in, None if that can't be known up front
+        if path in visiting:
+            return None
+        try:
+            entry = self._fileEntry(path, root, environment)
+        except OSError:
+            # A missing include, rendering reports it
+            return None
+        if entry["deps"] is None:
+            return None
+
+        parts = [entry["digest"]]
+        for dep in entry["deps"]:
+            dep_key = self._fileKey(dep, root, environment, visiting | { path })
+            if dep_key is None:
+                return None
+            parts.append(dep_key)
+        return hash_key("tree", *parts)
+
+    def _stringKey(self, template):
+        digest = hash_key("dict", *sorted(template.items()))
+        name = template.get("source")
+        if name is not None:
+            entry = self.sources.get(name)
+            if entry is not None and entry["digest"] != digest:
+                self._invalidate(name, entry)
+                entry = None
+            if entry is None:
+                self.sources.set(name, { "stamp" : digest, "digest" : digest, "root" : None, "deps" : [], "keys" : [] })
+        return digest
+
+    def sourceKey(self, template, environment=None):
+        # None when the template can't be cached (dynamic or missing includes)
+        if isinstance(template, dict):
+            return self._stringKey(template)
+        path = os.path.abspath(template)
+        return self._fileKey(path, os.path.dirname(path), environment, set())
+
+    def renderKey(self, source_key, render_args):
+        return hash_key("render", source_key, *sorted(render_args.items()))
+
+    def mergeKey(self, *render_keys):
+        return hash_key("merge", *render_keys)
+
+    def _sourceNames(self, template):
+        if isinstance(template, dict):
+            return [template["source"]] if template.get("source") else []
+
+        names = []
+        pending = [os.path.abspath(template)]
+        while pending:
+            path = pending.pop()
+            if path in names:
+                continue
+            names.append(path)
+            entry = self.sources.get(path)
+            if entry is not None:
+                pending.extend(entry["deps"] or [])
+        return names
+
+    def track(self, template, key):
+        # Remember which cached entries came from a template and the templates it
+        # includes, so they can be dropped explicitly once any of them changes.
+        for name in self._sourceNames(template):
+            entry = self.sources.get(name)
+            if entry is not None and key not in entry["keys"]:
+                entry["keys"].append(key)
+                self.sources.set(name, entry)
+
+    def get(self, key):
+        entry = self.rendered.get(key)
+        if entry is None:
+            return False, None
+        return True, entry[0]
+
+    def set(self, key, value):
+        # Wrapped in a tuple so that an empty (None) render is still a cache hit
+        self.rendered.set(key, (value,))
@@ -0,0 +1,46 @@
+import os
+import json
+import socket
+
+# Client side of the py-docker-x11d control socket. Requests and replies are
+# single JSON objects, one per line. Kept free of heavy imports, main.py uses it
+# before it knows whether it has to do the launch itself.
+
+def socket_path():
+    runtime_dir = os.environ.get("XDG_RUNTIME_DIR")
+    if runtime_dir and os.path.isdir(runtime_dir):
+        return os.path.join(runtime_dir, "py-docker-x11d.sock")
+    return os.path.join(os.path.expanduser("~"), ".py-docker-x11", "py-docker-x11d.sock")
+
+def connect(path=None, timeout=None):
+    # None if no daemon is listening
+    path = path or socket_path()
+    if not os.path.exists(path):
+        return None
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    try:
+        sock.connect(path)
+    except OSError:
+        sock.close()
+        return None
+    return sock
+
+def send(sock, message):
+    sock.sendall((json.dumps(message) + "\n").encode('utf-8'))
+
+def replies(sock):
+    with sock.makefile("r", encoding="utf-8") as stream:
+        for line in stream:
+            if line.strip():
+                yield json.loads(line)
+
+def request(command, path=None, **kwargs):
+    # One request, the list of every reply until the daemon closes the connection
+    sock = connect(path, timeout=10)
+    if sock is None:
+        return None
+    with sock:
+        kwargs["command"] = command
+        send(sock, kwargs)
+        return list(replies(sock))
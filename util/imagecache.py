@@ -0,0 +1,70 @@
+from util.cache import DiskCache
+
+# Image metadata shared by Config and Container for a single launch.
+# Every image is looked up with one images() call per run, and the (large) inspect
+# payload is persisted on disk keyed by image ID. Image IDs are content addressed,
+# so a cached inspect result can never go stale for an unchanged image.
+
+APP_CONFIG_LABEL = "pdx-app-config"
+
+class ImageCache:
+    def __init__(self, client, cache_dir=None):
+        self.client = client
+        self.disk_cache = DiskCache("images", cache_dir)
+        self.summaries = {}
+        self.inspects = {}
+
+    def _name(self, image, tag):
+        return image + ":" + (tag or "latest")
+
+    def find(self, image, tag="latest"):
+        name = self._name(image, tag)
+
+        if name not in self.summaries:
+            candidates = self.client.images(name=name)
+            summary = None
+            for candidate in candidates:
+                if name in (candidate.get("RepoTags") or []):
+                    summary = candidate
+                    break
+            if summary is None and candidates:
+                summary = candidates[0]
+            self.summaries[name] = summary
+
+        return self.summaries[name]
+
+    def invalidate(self, image, tag="latest"):
+        self.summaries.pop(self._name(image, tag), None)
+
+    def clear(self):
+        # Tags moved (build, pull, tag, rmi). Inspect results are keyed by ID and stay valid.
+        self.summaries = {}
+
+    def inspect(self, image, tag="latest"):
+        summary = self.find(image, tag)
+
+        if summary is None:
+            # Let the daemon raise its own ImageNotFound
+            return self.client.inspect_image(self._name(image, tag))
+
+        image_id = summary["Id"]
+        if image_id not in self.inspects:
+            inspect = self.disk_cache.get(image_id)
+            if inspect is None:
+                inspect = self.client.inspect_image(image_id)
+                self.disk_cache.set(image_id, inspect)
+            self.inspects[image_id] = inspect
+
+        return self.inspects[image_id]
+
+    def getConfigValue(self, image, tag, key, section="Config"):
+        return (self.inspect(image, tag).get(section) or {}).get(key)
+
+    def getLabel(self, image, tag, label):
+        summary = self.find(image, tag)
+        if summary is None:
+            return None
+        return (summary.get("Labels") or {}).get(label)
+
+    def getAppConfig(self, image, tag):
+        return self.getLabel(image, tag, APP_CONFIG_LABEL)
@@ -0,0 +1,48 @@
+import sys
+import threading
+
+# Per-thread stdout redirection, shared by the build scheduler (one log per build)
+# and py-docker-x11d (one client per launch).
+
+class ThreadStdout:
+    # Routes print() output of each thread to the log it has set in .local.log
+    # (a build's log file, a daemon client, ...), everything else still goes to
+    # the real stdout. With .local.echo set it goes to both.
+    def __init__(self, stream):
+        self.stream = stream
+        self.local = threading.local()
+
+    def write(self, data):
+        log = getattr(self.local, "log", None)
+        if log is None:
+            return self.stream.write(data)
+        if getattr(self.local, "echo", False):
+            self.stream.write(data)
+        return log.write(data)
+
+    def flush(self):
+        log = getattr(self.local, "log", None)
+        if log is not None:
+            log.flush()
+        self.stream.flush()
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+def inherit_output(function):
+    # Wraps function so that when a build hands it to its own worker threads, their
+    # output still lands in that build's log
+    stdout = sys.stdout
+    if not isinstance(stdout, ThreadStdout):
+        return function
+    log = getattr(stdout.local, "log", None)
+    echo = getattr(stdout.local, "echo", False)
+
+    def wrapper(*args, **kwargs):
+        stdout.local.log = log
+        stdout.local.echo = echo
+        try:
+            return function(*args, **kwargs)
+        finally:
+            stdout.local.log = None
+    return wrapper
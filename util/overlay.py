@@ -0,0 +1,45 @@
+import os
+import re
+import stat
+
+# Layered WINE prefixes: one read-only base shared by every subprofile of an app,
+# plus a thin writable layer per subprofile. The layers are mounted by the docker
+# daemon as a "local" volume with overlay options, so nothing has to be mounted
+# on the host and twenty subprofiles cost one base plus twenty deltas, on disk
+# and in the page cache.
+
+def layer_dirs(profile_dir):
+    # upperdir and workdir have to be on the same filesystem, outside of lowerdir
+    layer_dir = os.path.join(profile_dir, "wine-layer")
+    return os.path.join(layer_dir, "upper"), os.path.join(layer_dir, "work")
+
+def volume_name(profile_dir):
+    return "pdx-wine-" + re.sub(r"[^A-Za-z0-9_.-]+", "-", os.path.normpath(profile_dir).strip("/"))
+
+def volume_options(lower, upper, work):
+    for path in (lower, upper, work):
+        # overlay's option parser splits on these
+        if "," in path or ":" in path:
+            raise ValueError("Can't use %s as an overlay layer, it contains ',' or ':'" % path)
+    return { "type" : "overlay", "device" : "overlay", "o" : "lowerdir=%s,upperdir=%s,workdir=%s" % (lower, upper, work) }
+
+def layer_usage(upper):
+    # What the subprofile changed relative to the base: files written and files deleted (whiteouts)
+    usage = { "files" : 0, "deleted" : 0, "bytes" : 0 }
+    pending = [upper]
+    while pending:
+        directory = pending.pop()
+        try:
+            entries = list(os.scandir(directory))
+        except OSError:
+            continue
+        for entry in entries:
+            st = entry.stat(follow_symlinks=False)
+            if stat.S_ISCHR(st.st_mode) and st.st_rdev == 0:
+                usage["deleted"] += 1
+            elif stat.S_ISDIR(st.st_mode):
+                pending.append(entry.path)
+            else:
+                usage["files"] += 1
+                usage["bytes"] += st.st_blocks * 512
+    return usage
@@ -0,0 +1,71 @@
+import os
+import stat
+import time
+import errno
+import shutil
+from util.fileclone import reflink
+
+# Creates user profiles and WINE prefixes from their defaults. The "reflink"
+# backend clones every file (btrfs, xfs, ...), so a new multi-gigabyte prefix
+# shares its data blocks with the default until one side writes to them. "copy"
+# is the plain shutil.copytree behaviour, "auto" clones where the filesystem can
+# and copies where it can't. Selected by the base config option:
+#
+#   profile_provisioning: auto   # auto | reflink | copy
+
+BACKENDS = ("auto", "reflink", "copy")
+
+# Errors meaning the filesystem can't clone, as opposed to the file being unreadable
+_NO_REFLINK = (errno.EOPNOTSUPP, errno.ENOTTY, errno.EXDEV, errno.EINVAL, errno.ENOSYS)
+
+class Provisioner:
+    def __init__(self, backend="auto"):
+        if backend not in BACKENDS:
+            raise ValueError("Unknown profile_provisioning backend %s, expected one of %s" % (backend, ", ".join(BACKENDS)))
+        self.backend = backend
+        self.can_reflink = backend != "copy"
+        self.files = 0
+        self.bytes_cloned = 0
+        self.bytes_written = 0
+
+    def _copy_file(self, src, dst, size):
+        if self.can_reflink:
+            try:
+                reflink(src, dst)
+                self.bytes_cloned += size
+                return
+            except OSError as e:
+                if e.errno not in _NO_REFLINK:
+                    raise
+                if self.backend == "reflink":
+                    print("[WARN] %s does not support reflinks, falling back to copying" % os.path.dirname(dst))
+                # Same filesystem for the rest of the tree, don't keep trying
+                self.can_reflink = False
+        shutil.copy2(src, dst)
+        self.bytes_written += size
+
+    def _copy_tree(self, src, dst):
+        os.makedirs(dst)
+        with os.scandir(src) as entries:
+            for entry in entries:
+                target = os.path.join(dst, entry.name)
+                if entry.is_symlink():
+                    os.symlink(os.readlink(entry.path), target)
+                elif entry.is_dir():
+                    self._copy_tree(entry.path, target)
+                else:
+                    self._copy_file(entry.path, target, entry.stat(follow_symlinks=False).st_size)
+                    self.files += 1
+        shutil.copystat(src, dst)
+
+    def provision(self, src, dst):
+        started = time.monotonic()
+        self._copy_tree(src, dst)
+        elapsed = time.monotonic() - started
+        print("Provisioned %s from %s in %.1fs: %d files, %.1f MB cloned, %.1f MB written" %
+              (dst, src, elapsed, self.files, self.bytes_cloned / 1048576, self.bytes_written / 1048576))
+        return elapsed
+
+def provision_tree(src, dst, backend=None):
+    # Drop-in for shutil.copytree(src, dst, symlinks=True)
+    return Provisioner(backend or "auto").provision(src, dst)
@@ -1,7 +1,9 @@
-import struct
-from socket import socket, AF_UNIX, SOCK_STREAM
-import threading
 import os
+import time
+import errno
+import selectors
+import threading
+from socket import socket, socketpair, AF_UNIX, SOCK_STREAM, SHUT_WR, SOMAXCONN, SOL_SOCKET, SO_ERROR
 from util import user
 
 # This proxies socket requests from Docker and uses the credentials
@@ -9,26 +11,316 @@ from util import user
 # This is obviously dangerous if your application decides to make
 # malicious calls via dbus, Docker or whatever you're proxying!
 
-class ProxySocket(threading.Thread):
+# Every proxied socket shares a single selector loop. On Linux data is moved
+# between the two sockets with splice() through a pipe so it never enters
+# userspace, elsewhere through a reusable buffer per direction.
+
+CHUNK_SIZE = 65536
+USE_SPLICE = hasattr(os, "splice")
+
+# Upstream connects never block the loop. A unix socket with a full backlog
+# answers EAGAIN instead of completing later, so those are retried on a timer.
+CONNECT_RETRY = 0.01
+CONNECT_TIMEOUT = 10
+
+class _Direction:
+    def __init__(self, src, dst):
+        self.src = src
+        self.dst = dst
+        self.pending = 0
+        self.transferred = 0
+        self.eof = False
+        self.shut = False
+
+        if USE_SPLICE:
+            self.pipe_r, self.pipe_w = os.pipe2(os.O_NONBLOCK | os.O_CLOEXEC)
+        else:
+            self.view = memoryview(bytearray(CHUNK_SIZE))
+            self.start = 0
+
+    def space(self):
+        if USE_SPLICE:
+            return CHUNK_SIZE - self.pending
+        return CHUNK_SIZE - self.start - self.pending
+
+    def wants_read(self):
+        return not self.eof and self.space() > 0
+
+    def wants_write(self):
+        return self.pending > 0
+
+    def read(self):
+        if USE_SPLICE:
+            count = os.splice(self.src.fileno(), self.pipe_w, self.space(),
+                              flags=os.SPLICE_F_MOVE | os.SPLICE_F_NONBLOCK)
+        else:
+            end = self.start + self.pending
+            count = self.src.recv_into(self.view[end:])
+
+        if count == 0:
+            self.eof = True
+        self.pending += count
+        return count
+
+    def write(self):
+        if USE_SPLICE:
+            count = os.splice(self.pipe_r, self.dst.fileno(), self.pending,
+                              flags=os.SPLICE_F_MOVE | os.SPLICE_F_NONBLOCK)
+        else:
+            count = self.dst.send(self.view[self.start:self.start + self.pending])
+            self.start += count
+
+        self.pending -= count
+        self.transferred += count
+
+        if not USE_SPLICE and self.pending == 0:
+            self.start = 0
+        return count
+
+    def shutdown(self):
+        # Pass the half-close on once everything read before EOF has been written
+        if self.eof and self.pending == 0 and not self.shut:
+            self.shut = True
+            try:
+                self.dst.shutdown(SHUT_WR)
+            except OSError:
+                pass
+
+    def close(self):
+        if USE_SPLICE:
+            os.close(self.pipe_r)
+            os.close(self.pipe_w)
+
+class _Connection:
+    def __init__(self, proxy, client, upstream):
+        self.proxy = proxy
+        self.client = client
+        self.upstream = upstream
+        self.outbound = _Direction(client, upstream)
+        self.inbound = _Direction(upstream, client)
+        self.masks = { client : 0, upstream : 0 }
+        self.accepted = time.monotonic()
+        self.first_response = None
+
+    def interest(self, sock):
+        mask = 0
+        if sock is self.client:
+            reading, writing = self.outbound, self.inbound
+        else:
+            reading, writing = self.inbound, self.outbound
+        if reading.wants_read():
+            mask |= selectors.EVENT_READ
+        if writing.wants_write():
+            mask |= selectors.EVENT_WRITE
+        return mask
+
+    def handle(self, sock, mask):
+        if mask & selectors.EVENT_READ:
+            direction = self.outbound if sock is self.client else self.inbound
+            try:
+                if direction.read() and direction is self.inbound and self.first_response is None:
+                    self.first_response = time.monotonic()
+            except BlockingIOError:
+                pass
+            # Opportunistically forward what we just read instead of waiting for the next poll
+            if direction.wants_write():
+                self._write(direction)
+            direction.shutdown()
+
+        if mask & selectors.EVENT_WRITE:
+            direction = self.inbound if sock is self.client else self.outbound
+            self._write(direction)
+            direction.shutdown()
+
+    def _write(self, direction):
+        try:
+            direction.write()
+        except BlockingIOError:
+            pass
+
+    def done(self):
+        return self.outbound.shut and self.inbound.shut
+
+    def close(self):
+        for direction in [self.outbound, self.inbound]:
+            direction.close()
+        for sock in [self.client, self.upstream]:
+            sock.close()
+
+        self.proxy.bytes_out += self.outbound.transferred
+        self.proxy.bytes_in += self.inbound.transferred
+
+        if self.first_response is not None:
+            latency = "%.1fms" % ((self.first_response - self.accepted) * 1000)
+        else:
+            latency = "n/a"
+        print("[DEBUG] Proxy %s closed connection: %d bytes sent, %d bytes received, first response after %s, open for %.1fs" %
+              (self.proxy.src, self.outbound.transferred, self.inbound.transferred, latency, time.monotonic() - self.accepted))
+
+class _PendingConnect:
+    def __init__(self, proxy, client, upstream):
+        self.proxy = proxy
+        self.client = client
+        self.upstream = upstream
+        self.started = time.monotonic()
+        self.retry_at = None
+
+    def fail(self, reason):
+        print("[WARN] Proxy %s could not connect to %s: %s" % (self.proxy.src, self.proxy.dst, reason))
+        self.upstream.close()
+        self.client.close()
+
+class ProxyEngine(threading.Thread):
+    def __init__(self):
+        threading.Thread.__init__(self, daemon=True)
+        self.selector = selectors.DefaultSelector()
+        self.lock = threading.Lock()
+        self.queued = []
+        self.retries = []
+        self.wakeup_r, self.wakeup_w = socketpair()
+        self.wakeup_r.setblocking(False)
+        self.selector.register(self.wakeup_r, selectors.EVENT_READ, None)
+
+    def add_listener(self, proxy):
+        with self.lock:
+            self.queued.append((proxy, proxy.src_socket, True))
+        self.wakeup_w.send(b"\0")
+
+    def remove_listener(self, proxy):
+        with self.lock:
+            self.queued.append((proxy, proxy.src_socket, False))
+        self.wakeup_w.send(b"\0")
+
+    def _drain_queue(self):
+        try:
+            self.wakeup_r.recv(4096)
+        except BlockingIOError:
+            pass
+        with self.lock:
+            queued, self.queued = self.queued, []
+        for proxy, listener, add in queued:
+            if add:
+                self.selector.register(listener, selectors.EVENT_READ, proxy)
+            else:
+                self.selector.unregister(listener)
+                listener.close()
+
+    def _accept(self, listener, proxy):
+        try:
+            client, _ = listener.accept()
+        except BlockingIOError:
+            return
+
+        upstream = socket(AF_UNIX, SOCK_STREAM)
+        upstream.setblocking(False)
+        self._connect(_PendingConnect(proxy, client, upstream))
+
+    def _connect(self, pending):
+        result = pending.upstream.connect_ex(pending.proxy.dst)
+        if result == 0:
+            self._established(pending)
+        elif result == errno.EINPROGRESS:
+            # Finishes in the background, the socket turns writable once it has
+            self.selector.register(pending.upstream, selectors.EVENT_WRITE, pending)
+        elif result in (errno.EAGAIN, errno.EWOULDBLOCK):
+            if time.monotonic() - pending.started > CONNECT_TIMEOUT:
+                pending.fail("upstream backlog stayed full for %ss" % CONNECT_TIMEOUT)
+                return
+            pending.retry_at = time.monotonic() + CONNECT_RETRY
+            self.retries.append(pending)
+        else:
+            pending.fail(os.strerror(result))
+
+    def _connect_finished(self, pending):
+        self.selector.unregister(pending.upstream)
+        result = pending.upstream.getsockopt(SOL_SOCKET, SO_ERROR)
+        if result == 0:
+            self._established(pending)
+        else:
+            pending.fail(os.strerror(result))
+
+    def _retry_connects(self):
+        now = time.monotonic()
+        due = [pending for pending in self.retries if pending.retry_at <= now]
+        self.retries = [pending for pending in self.retries if pending.retry_at > now]
+        for pending in due:
+            self._connect(pending)
+
+    def _established(self, pending):
+        pending.client.setblocking(False)
+        pending.proxy.connections += 1
+        self._update(_Connection(pending.proxy, pending.client, pending.upstream))
+
+    def _update(self, connection):
+        if connection.done():
+            for sock, mask in connection.masks.items():
+                if mask:
+                    self.selector.unregister(sock)
+                connection.masks[sock] = 0
+            connection.close()
+            return
+
+        for sock, current in connection.masks.items():
+            mask = connection.interest(sock)
+            if mask == current:
+                continue
+            if current == 0:
+                self.selector.register(sock, mask, connection)
+            elif mask == 0:
+                self.selector.unregister(sock)
+            else:
+                self.selector.modify(sock, mask, connection)
+            connection.masks[sock] = mask
+
+    def run(self):
+        while True:
+            timeout = None
+            if self.retries:
+                timeout = max(0, min(pending.retry_at for pending in self.retries) - time.monotonic())
+            for key, mask in self.selector.select(timeout):
+                if key.data is None:
+                    self._drain_queue()
+                elif isinstance(key.data, ProxySocket):
+                    self._accept(key.fileobj, key.data)
+                elif isinstance(key.data, _PendingConnect):
+                    self._connect_finished(key.data)
+                else:
+                    connection = key.data
+                    if key.fileobj not in connection.masks or connection.masks[key.fileobj] == 0:
+                        # Connection was torn down earlier in this batch of events
+                        continue
+                    try:
+                        connection.handle(key.fileobj, mask)
+                    except OSError as e:
+                        print("[DEBUG] Proxy %s connection error: %s" % (connection.proxy.src, e))
+                        connection.outbound.shut = connection.inbound.shut = True
+                    self._update(connection)
+            if self.retries:
+                self._retry_connects()
+
+_engine = None
+_engine_lock = threading.Lock()
+
+def get_engine():
+    global _engine
+    with _engine_lock:
+        if _engine is None:
+            _engine = ProxyEngine()
+            _engine.start()
+        return _engine
+
+class ProxySocket:
     def __init__(self, src, dst, container_uid, container_gid):
-        threading.Thread.__init__(self)
         self.src = src
         print("self src is %s" % self.src)
         self.dst = dst
         self.container_uid = container_uid
         self.container_gid = container_gid
+        self.src_socket = None
+        self.connections = 0
+        self.bytes_out = 0
+        self.bytes_in = 0
 
-    def _proxy(self, src_socket, dst_socket):
-        while True:
-            try:
-                data = src_socket.recv(4096)
-                if not data:
-                    break
-                else:
-                    dst_socket.sendall(data)
-            except:
-                break
-    
     def listen(self):
 
         print("Creating proxy socket at %s to %s" % (self.src, self.dst))
@@ -36,29 +328,25 @@ class ProxySocket(threading.Thread):
         print("Checking for socket path at %s" % self.src)
         if os.path.exists(self.src):
             print("Unlinking %s" % self.src)
-            user.chown(self.src, self.container_uid, self.container_gid)
             os.unlink(self.src)
 
-        src_socket = socket(AF_UNIX, SOCK_STREAM)
-        src_socket.bind(self.src)
+        self.src_socket = socket(AF_UNIX, SOCK_STREAM)
+        self.src_socket.bind(self.src)
 
         os.chmod(self.src, 0o620)
+        # Queued after the final bind, so the batched chown finds the socket it was queued for
         user.chown(self.src, self.container_uid, self.container_gid)
 
-        while True:
-
-            src_socket.listen(1)
-
-            # This blocks until we receive a connection
-            src_connection, src_addr = src_socket.accept()
-            src_connection.settimeout(5.0)
-
-            dst_socket = socket(AF_UNIX, SOCK_STREAM)
-            dst_socket.connect(self.dst)
-            dst_socket.settimeout(5.0)
-
-            src_thread = threading.Thread(target = self._proxy, args=[src_connection, dst_socket])
-            src_thread.start()
-            dst_thread = threading.Thread(target = self._proxy, args=[dst_socket, src_connection])
-            dst_thread.start()
+        self.src_socket.listen(SOMAXCONN)
+        self.src_socket.setblocking(False)
+        get_engine().add_listener(self)
 
+    def close(self):
+        # The engine closes the listener, the path goes now so the next launch binds cleanly
+        if self.src_socket is not None:
+            get_engine().remove_listener(self)
+            self.src_socket = None
+            try:
+                os.unlink(self.src)
+            except FileNotFoundError:
+                pass
@@ -0,0 +1,124 @@
+import os
+import re
+import time
+
+# Generic "wait for condition" helpers. Conditions are checked straight away and
+# then polled with a short, growing interval capped at a few tens of ms, so a
+# condition that becomes true is noticed within milliseconds however long the
+# wait. There's no event to wait on instead: a process starting or exec()ing
+# inside the container doesn't notify cgroup.procs or cgroup.events watchers,
+# and the docker event stream only reports exec sessions it started itself.
+
+# Reading cgroup.procs and a handful of /proc/<pid>/comm files is cheap
+LOCAL_POLL_INTERVAL = 0.02
+# Every docker top() is a round trip through the daemon
+TOP_POLL_INTERVAL = 0.25
+
+def wait_for(condition, timeout=None, interval=0.005, max_interval=0.05, abort=None):
+    deadline = time.monotonic() + timeout if timeout is not None else None
+
+    while True:
+        result = condition()
+        if result:
+            return result
+
+        if abort is not None and abort():
+            return None
+
+        if deadline is not None:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return None
+            time.sleep(min(interval, remaining))
+        else:
+            time.sleep(interval)
+
+        interval = min(interval * 2, max_interval)
+
+def _cgroup_procs_path(pid):
+    # cgroup v2 has a single "0::/path" entry, under v1 we follow the pids controller
+    try:
+        with open("/proc/%d/cgroup" % pid) as cgroup_file:
+            entries = [line.strip().split(":", 2) for line in cgroup_file]
+    except OSError:
+        return None
+
+    for hierarchy, controllers, path in entries:
+        if hierarchy == "0" and controllers == "":
+            candidate = os.path.join("/sys/fs/cgroup", path.lstrip("/"), "cgroup.procs")
+            if os.path.exists(candidate):
+                return candidate
+        elif "pids" in controllers.split(","):
+            candidate = os.path.join("/sys/fs/cgroup/pids", path.lstrip("/"), "cgroup.procs")
+            if os.path.exists(candidate):
+                return candidate
+    return None
+
+class ContainerProcessWatcher:
+    # Looks for processes inside one container only. Reads the container's own
+    # cgroup.procs and /proc/<pid>/comm where we can, otherwise asks the daemon via top().
+    def __init__(self, client, container_id):
+        self.client = client
+        self.container_id = container_id
+        self.procs_path = None
+
+        try:
+            pid = client.inspect_container(container_id)["State"]["Pid"]
+            if pid:
+                self.procs_path = _cgroup_procs_path(pid)
+        except Exception as e:
+            print("[DEBUG] Could not find the container cgroup, falling back to docker top: %s" % e)
+
+    def _local_commands(self):
+        with open(self.procs_path) as procs_file:
+            pids = [line.strip() for line in procs_file if line.strip()]
+
+        commands = []
+        for pid in pids:
+            try:
+                with open("/proc/%s/comm" % pid) as comm_file:
+                    commands.append(comm_file.read().strip())
+            except OSError:
+                # Raced with the process exiting
+                continue
+        return commands
+
+    def _top_commands(self):
+        top = self.client.top(self.container_id)
+        titles = top.get("Titles") or []
+        column = titles.index("CMD") if "CMD" in titles else len(titles) - 1
+        commands = []
+        for process in top.get("Processes") or []:
+            command = process[column].split()
+            if command:
+                commands.append(os.path.basename(command[0]))
+        return commands
+
+    def commands(self):
+        if self.procs_path is not None:
+            try:
+                return self._local_commands()
+            except OSError:
+                self.procs_path = None
+        return self._top_commands()
+
+    def find(self, pattern):
+        # Same matching rules as pgrep: a regex searched for in the process name
+        return any(re.search(pattern, command) for command in self.commands())
+
+    def exited(self):
+        if self.procs_path is not None:
+            try:
+                with open(self.procs_path) as procs_file:
+                    return not procs_file.read().strip()
+            except OSError:
+                # The cgroup goes away along with the container
+                return True
+        try:
+            return not self.client.inspect_container(self.container_id)["State"]["Running"]
+        except Exception:
+            return True
+
+    def wait_for_process(self, pattern, timeout=None):
+        max_interval = LOCAL_POLL_INTERVAL if self.procs_path is not None else TOP_POLL_INTERVAL
+        return wait_for(lambda: self.find(pattern), timeout=timeout, max_interval=max_interval, abort=self.exited)
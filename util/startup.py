@@ -0,0 +1,36 @@
+import time
+import contextlib
+
+# --profile-startup: wall time of each phase of a launch, printed once the
+# container has started. Phases are no-ops until enable() is called, so the
+# markers cost nothing on a normal launch. Only ever enabled for launches run in
+# this process, never inside py-docker-x11d.
+
+_phases = None
+_began = None
+
+def enable():
+    global _phases, _began
+    _phases = []
+    _began = time.perf_counter()
+
+@contextlib.contextmanager
+def phase(name):
+    if _phases is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        _phases.append((name, time.perf_counter() - started))
+
+def report():
+    if _phases is None:
+        return
+    total = time.perf_counter() - _began
+    print("Startup profile:")
+    for name, duration in _phases:
+        print("  %-24s %7.3fs" % (name, duration))
+    print("  %-24s %7.3fs" % ("other", total - sum(duration for _, duration in _phases)))
+    print("  %-24s %7.3fs" % ("total", total))
@@ -1,35 +1,201 @@
 from subprocess import Popen
 from pathlib import Path
-import os, psutil
+import os, sys, psutil
+import pwd, grp
+import stat
+import threading
 import re
 import glob
+from util.cache import DiskCache
+
+SUBUID_FILE = "/etc/subuid"
+SUBGID_FILE = "/etc/subgid"
+
+def parse_subid_file(path, names):
+    # Returns every start:count range allotted to any of names (user/group name or numeric ID),
+    # in file order. Multiple ranges for one user are concatenated by the kernel in that order.
+    names = [str(name) for name in names if name is not None]
+    ranges = []
+    with open(path) as subid_file:
+        for line in subid_file:
+            fields = line.strip().split(":")
+            if len(fields) != 3 or fields[0].startswith("#"):
+                continue
+            if fields[0] in names:
+                try:
+                    ranges.append((int(fields[1]), int(fields[2])))
+                except ValueError:
+                    print("[WARN] Ignoring malformed line in %s: %s" % (path, line.strip()))
+    return ranges
+
+class NamespaceMap:
+    # Maps container IDs to host IDs for the running Docker daemon.
+    # rootless: container 0 is the daemon owner, container N is the (N-1)th subordinate ID.
+    # userns-remap: container N is the Nth subordinate ID of the remap user.
+    def __init__(self, mode, owner_uid, owner_gid, uid_ranges, gid_ranges):
+        self.mode = mode
+        self.owner_uid = owner_uid
+        self.owner_gid = owner_gid
+        self.uid_ranges = uid_ranges
+        self.gid_ranges = gid_ranges
+
+    def _map(self, container_id, owner_id, ranges):
+        if self.mode == "rootless":
+            if container_id == 0:
+                return owner_id
+            offset = container_id - 1
+        else:
+            offset = container_id
+
+        for start, count in ranges:
+            if offset < count:
+                return start + offset
+            offset -= count
+
+        raise ValueError("Container ID %d is outside of the subordinate ID ranges %s" % (container_id, ranges))
+
+    def host_uid(self, container_uid):
+        return self._map(container_uid, self.owner_uid, self.uid_ranges)
+
+    def host_gid(self, container_gid):
+        return self._map(container_gid, self.owner_gid, self.gid_ranges)
+
+    def to_dict(self):
+        return { "mode" : self.mode, "owner_uid" : self.owner_uid, "owner_gid" : self.owner_gid,
+                 "uid_ranges" : self.uid_ranges, "gid_ranges" : self.gid_ranges }
+
+def _find_docker_daemon():
+    for process in psutil.process_iter(["pid", "name", "cmdline"]):
+        if process.info["name"] == "dockerd":
+            cmdline = process.info["cmdline"] or []
+            for index, argument in enumerate(cmdline):
+                if argument.startswith("--userns-remap"):
+                    if "=" in argument:
+                        remap = argument.split("=", 1)[1]
+                    elif index + 1 < len(cmdline):
+                        remap = cmdline[index + 1]
+                    else:
+                        continue
+                    return process, "userns-remap", remap
+        elif process.info["name"] == "rootlesskit":
+            return process, "rootless", None
+    return None, None, None
+
+def _resolve_namespace_map(process, mode, remap):
+    if not os.path.exists(SUBUID_FILE) or not os.path.exists(SUBGID_FILE):
+        print("No subuid/subgid files found in /etc, something's broke.")
+        return None
+
+    if mode == "rootless":
+        owner_uid = process.uids().real
+        owner_gid = process.gids().real
+        user_name = process.username()
+        group_name = user_name
+    else:
+        if remap == "default":
+            remap = "dockremap:dockremap"
+        user_name, _, group_name = remap.partition(":")
+        group_name = group_name or user_name
+        owner_uid = owner_gid = 0
+
+    uid_names = [user_name]
+    gid_names = [group_name]
+    try:
+        uid_names.append(pwd.getpwnam(user_name).pw_uid)
+    except KeyError:
+        pass
+    try:
+        gid_names.append(grp.getgrnam(group_name).gr_gid)
+    except KeyError:
+        pass
+
+    uid_ranges = parse_subid_file(SUBUID_FILE, uid_names)
+    gid_ranges = parse_subid_file(SUBGID_FILE, gid_names)
+
+    if not uid_ranges or not gid_ranges:
+        print("[WARN] No subordinate IDs found for %s:%s" % (user_name, group_name))
+        return None
+
+    return NamespaceMap(mode, owner_uid, owner_gid, uid_ranges, gid_ranges)
+
+def _namespace_stamp(pid):
+    stamp = { "pid" : pid }
+    try:
+        stamp["create_time"] = psutil.Process(pid).create_time()
+    except psutil.Error:
+        return None
+    for path in [SUBUID_FILE, SUBGID_FILE]:
+        try:
+            stamp[path] = os.stat(path).st_mtime_ns
+        except OSError:
+            stamp[path] = None
+    return stamp
+
+# Resolved once per process, and persisted on disk until the daemon PID or the
+# subuid/subgid files change, so we don't walk the process table on every chown.
+_namespace_map = None
+_namespace_lock = threading.Lock()
+_namespace_cache = DiskCache("namespace")
+
+def get_namespace_map():
+    global _namespace_map
+
+    with _namespace_lock:
+        if _namespace_map is not None:
+            return _namespace_map or None
+
+        cached = _namespace_cache.get("mapping")
+        if cached is not None and _namespace_stamp(cached["stamp"]["pid"]) == cached["stamp"]:
+            _namespace_map = NamespaceMap(**cached["mapping"])
+            return _namespace_map
+
+        process, mode, remap = _find_docker_daemon()
+        namespace_map = _resolve_namespace_map(process, mode, remap) if process else None
+
+        if namespace_map is None:
+            # Remembered for this process only, a daemon may come up before the next run
+            _namespace_map = False
+            return None
+
+        stamp = _namespace_stamp(process.pid)
+        if stamp is not None:
+            _namespace_cache.set("mapping", { "stamp" : stamp, "mapping" : namespace_map.to_dict() })
+
+        _namespace_map = namespace_map
+        return _namespace_map
 
 def get_subids(user, group):
-    if os.path.exists('/etc/subuid') and os.path.exists('/etc/subgid'):
-        with open('/etc/subuid') as subuid_file:
-            for line in subuid_file.readlines():
-                if re.match("^" + user, line):
-                    subuid = re.match("[A-Za-z]+:([0-9]+):", line)
-        with open('/etc/subgid') as subgid_file:
-            for line in subgid_file.readlines():
-                if re.match("^" + group, line):
-                    subgid = re.match("[A-Za-z]+:([0-9]+):", line)
-        return int(subuid.group(1)), int(subgid.group(1))
+    if os.path.exists(SUBUID_FILE) and os.path.exists(SUBGID_FILE):
+        uid_ranges = parse_subid_file(SUBUID_FILE, [user])
+        gid_ranges = parse_subid_file(SUBGID_FILE, [group])
+        if uid_ranges and gid_ranges:
+            return uid_ranges[0][0], gid_ranges[0][0]
+        return False
     else:
         print("No subuid/subgid files found in /etc, something's broke.")
         return False
 
 def get_namespace_ids():
-    for process in psutil.process_iter():
-        if process.name() == "dockerd":
-            for argument in process.cmdline():
-                print(argument)
-                if re.match("--userns-remap.*", argument):
-                    id_match = re.match('--userns-remap=([A-Za-z]+):([A-Za-z]+)', argument)
-                    return get_subids(id_match.group(1), id_match.group(2))
-        elif process.name() == "rootlesskit":
-            return get_subids(process.username(), process.username())
-    return False
+    namespace_map = get_namespace_map()
+    if namespace_map is None:
+        return False
+    return namespace_map.uid_ranges[0][0], namespace_map.gid_ranges[0][0]
+
+# Ownership changes can be collected per thread and applied in one go with
+# flush_chown_batch(), rather than starting a sudo process for every target.
+_chown_batch = threading.local()
+
+# Stay well below ARG_MAX when handing paths to a single chown invocation
+CHOWN_ARG_LIMIT = 100000
+
+def begin_chown_batch():
+    _chown_batch.jobs = []
+
+def flush_chown_batch():
+    jobs = getattr(_chown_batch, "jobs", None)
+    _chown_batch.jobs = None
+    if jobs:
+        apply_chown(jobs)
 
 def chown(target, container_uid=0, container_gid=0, recursive=False, no_root_chown=False):
 
@@ -37,21 +203,13 @@ def chown(target, container_uid=0, container_gid=0, recursive=False, no_root_cho
         print("Trying to operate on something we're defintely not supposed to. Bailing out.")
         sys.exit(1)
 
-    if get_namespace_ids():
-        ns_uid, ns_gid = get_namespace_ids()
-        print("[DEBUG] ns_uid and ns_gid are %s %s" % (container_uid, container_gid))
-
-        uid = container_uid + ns_uid
-        gid = container_gid + ns_gid
-
-        if container_uid != 0:
-            uid = uid - 1
-        if container_gid != 0: 
-            gid = gid - 1
-
+    namespace_map = get_namespace_map()
+    if namespace_map is not None:
+        uid = namespace_map.host_uid(container_uid)
+        gid = namespace_map.host_gid(container_gid)
         print("[DEBUG] uid and gid are %d %d" % (uid, gid))
     else:
-        print("[DEBUG] - get_namespace_ids failed, something is up")
+        print("[DEBUG] - get_namespace_map failed, something is up")
         uid = container_uid
         gid = container_gid
 
@@ -61,30 +219,145 @@ def chown(target, container_uid=0, container_gid=0, recursive=False, no_root_cho
             sys.exit(1)
         elif not os.path.exists(target):
             print("Trying to chown something nonexistent. Exiting.")
-            
-        if recursive == True:
-            try:
-                if no_root_chown == True:
-                    for glob_target in glob.glob(target + "/*"):
-                        result = Popen(["sudo", "/bin/chown", "--preserve-root", "-R", str(uid) + ":" + str(gid), glob_target])
-                        result.wait()
-                else:
-                    result = Popen(["sudo", "/bin/chown", "--preserve-root", "-R", str(uid) + ":" + str(gid), target])
-                    result.wait()
-            except:
-                print("Can't chown file, dying")
-                sys.exit(1)
+
+        job = { "target" : target, "uid" : uid, "gid" : gid, "recursive" : recursive, "skip_root" : recursive and no_root_chown }
+
+        if getattr(_chown_batch, "jobs", None) is not None:
+            _chown_batch.jobs.append(job)
         else:
-            try:
-                result = Popen(["sudo", "/bin/chown", str(uid) + ":" + str(gid), target])
-                result.wait()
-            except:
-                print("Can't chown file, dying")
-                sys.exit(1)
-                return False
+            apply_chown([job])
     else:
         return False
 
+def _scan_directory(directory, uid, gid, paths, subtrees):
+    # Collects what below directory needs changing. Returns how many entries were
+    # checked and whether every one of them needs changing, in which case the
+    # caller can hand the whole directory to a single chown -R instead.
+    checked = 0
+    whole = True
+    found_paths = []
+    found_subtrees = []
+    try:
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                entry_stat = entry.stat(follow_symlinks=False)
+                checked += 1
+                wrong = entry_stat.st_uid != uid or entry_stat.st_gid != gid
+                if entry.is_dir(follow_symlinks=False):
+                    child_paths = []
+                    child_subtrees = []
+                    child_checked, child_whole = _scan_directory(entry.path, uid, gid, child_paths, child_subtrees)
+                    checked += child_checked
+                    if wrong and child_whole:
+                        found_subtrees.append(entry.path)
+                        continue
+                    whole = False
+                    found_paths.extend(child_paths)
+                    found_subtrees.extend(child_subtrees)
+                elif not wrong:
+                    whole = False
+                if wrong:
+                    found_paths.append(entry.path)
+    except PermissionError:
+        # Unreadable, most likely because it already belongs to the namespaced user
+        found_paths = []
+        found_subtrees = [directory]
+        whole = True
+
+    paths.extend(found_paths)
+    subtrees.extend(found_subtrees)
+    return checked, whole
+
+def _scan_chown_targets(job, paths, subtrees):
+    # Walk the target as the current user and only keep paths whose ownership
+    # is actually wrong. Directories we can't read any more (because they
+    # already belong to the namespaced user), and directories where everything
+    # needs changing (a freshly copied tree), are handed to chown -R whole.
+    uid, gid = job["uid"], job["gid"]
+    checked = 0
+
+    try:
+        if job["recursive"]:
+            target_stat = os.lstat(job["target"])
+        else:
+            target_stat = os.stat(job["target"])
+    except FileNotFoundError:
+        print("[WARN] Skipping chown of nonexistent path %s" % job["target"])
+        return checked
+
+    wrong = False
+    if not job["skip_root"]:
+        checked += 1
+        wrong = target_stat.st_uid != uid or target_stat.st_gid != gid
+
+    if not job["recursive"] or not stat.S_ISDIR(target_stat.st_mode):
+        if wrong:
+            paths.append(job["target"] if job["recursive"] else os.path.realpath(job["target"]))
+        return checked
+
+    found_paths = []
+    found_subtrees = []
+    found_checked, whole = _scan_directory(job["target"], uid, gid, found_paths, found_subtrees)
+    checked += found_checked
+    if wrong and whole:
+        subtrees.append(job["target"])
+        return checked
+
+    if wrong:
+        paths.append(job["target"])
+    paths.extend(found_paths)
+    subtrees.extend(found_subtrees)
+    return checked
+
+def _run_chown(arguments, owner, paths):
+    # Batch as many paths as fit on one command line into each chown process
+    batches = [[]]
+    batch_length = 0
+    for path in paths:
+        if batches[-1] and batch_length + len(path) >= CHOWN_ARG_LIMIT:
+            batches.append([])
+            batch_length = 0
+        batches[-1].append(path)
+        batch_length += len(path) + 1
+
+    for batch in batches:
+        if not batch:
+            continue
+        try:
+            result = Popen(["sudo", "/bin/chown"] + arguments + [owner, "--"] + batch)
+            if result.wait() != 0:
+                raise OSError("chown exited with %d" % result.returncode)
+        except Exception as e:
+            print("Can't chown file, dying: %s" % e)
+            sys.exit(1)
+
+def apply_chown(jobs):
+    groups = {}
+    for job in jobs:
+        paths, subtrees, checked = groups.setdefault((job["uid"], job["gid"]), ([], [], [0]))
+        checked[0] += _scan_chown_targets(job, paths, subtrees)
+
+    for (uid, gid), (paths, subtrees, checked) in groups.items():
+        paths = list(dict.fromkeys(paths))
+        print("[DEBUG] chown %d:%d - %d of %d paths need changing, %d whole subtrees" % (uid, gid, len(paths), checked[0], len(subtrees)))
+
+        if os.geteuid() == 0:
+            # Already privileged, so subtrees are only ones where everything needs changing
+            for subtree in subtrees:
+                os.chown(subtree, uid, gid, follow_symlinks=False)
+                for root, directories, files in os.walk(subtree):
+                    for name in directories + files:
+                        os.chown(os.path.join(root, name), uid, gid, follow_symlinks=False)
+            for path in paths:
+                os.chown(path, uid, gid, follow_symlinks=False)
+            continue
+
+        owner = str(uid) + ":" + str(gid)
+        if paths:
+            _run_chown(["-h"], owner, paths)
+        if subtrees:
+            _run_chown(["--preserve-root", "-R", "-h"], owner, subtrees)
+
 def chown_check(uid, gid):
     # This is stupid
     return True